@@ -0,0 +1,384 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+# Admission settings, overridable from the environment. Slots plus queue should stay
+# below gunicorn's --threads, so some threads are always free for cheap endpoints.
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 4))
+UPSTREAM_QUEUE_SIZE = int(os.environ.get('UPSTREAM_QUEUE_SIZE', 2))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 5))
+# Slots background work (batch items) may not take, so interactive requests always find one
+UPSTREAM_INTERACTIVE_RESERVE = int(os.environ.get('UPSTREAM_INTERACTIVE_RESERVE', 1))
+
+# Circuit breaker settings
+CIRCUIT_WINDOW = float(os.environ.get('CIRCUIT_WINDOW', 30))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', 10))
+CIRCUIT_FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', 0.5))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 15))
+
+# Upstream attempt outcomes (retry_policy failure classes) that count against upstream health.
+# Fatal errors are the request's fault and key errors are a configuration problem.
+FAILURE_OUTCOMES = ("transient", "rate_limit")
+
+# Circuit states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of being sent upstream"""
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after  # Whole seconds, for the Retry-After header
+
+class AdmissionController:
+    def __init__(self, latency_percentile, enabled=ADMISSION_ENABLED,
+                 max_concurrency=UPSTREAM_MAX_CONCURRENCY, queue_size=UPSTREAM_QUEUE_SIZE,
+                 queue_timeout=UPSTREAM_QUEUE_TIMEOUT, reserve=UPSTREAM_INTERACTIVE_RESERVE,
+                 window=CIRCUIT_WINDOW,
+                 min_calls=CIRCUIT_MIN_CALLS, failure_rate=CIRCUIT_FAILURE_RATE,
+                 open_seconds=CIRCUIT_OPEN_SECONDS):
+        """
+        Initialize the admission controller for upstream-bound requests
+
+        Each worker process admits at most max_concurrency requests at a time.
+        Up to queue_size more may wait for a slot, but only while their
+        expected wait fits in queue_timeout; everything else is rejected
+        straight away with 429. Background requests leave `reserve` slots
+        free for interactive ones. A circuit breaker rejects requests with 503
+        while the share of failed upstream attempts in the last window
+        seconds is at or above failure_rate. After open_seconds, one probe
+        request is let through; its outcome closes or reopens the circuit.
+
+        Args:
+            latency_percentile: Callable(percentile, min_samples) returning recent
+                upstream latency in seconds, or None while there are too few samples
+            enabled: Whether requests are limited at all
+            max_concurrency: Requests admitted at once per process
+            queue_size: Requests that may wait for a slot
+            queue_timeout: Longest wait for a slot, in seconds
+            reserve: Slots only interactive requests may take
+            window: Seconds of attempt outcomes the circuit breaker looks at
+            min_calls: Attempts in the window needed before the circuit can open
+            failure_rate: Failed share of attempts at which the circuit opens
+            open_seconds: Seconds the circuit stays open before a probe
+        """
+        self.latency_percentile = latency_percentile
+        self.enabled = enabled
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.reserve = reserve
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.condition = threading.Condition()
+        self.pid = None
+        self.counters = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "rejected_wait": 0,
+            "rejected_timeout": 0,
+            "rejected_circuit_open": 0,
+            "circuit_opened": 0
+        }
+        self._reset()
+
+    def _reset(self):
+        """Start from an idle, closed state; the caller holds the lock or is __init__"""
+        self.active = 0
+        self.waiting = 0
+        self.outcomes = deque()  # (monotonic time, failed)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.async_waiters = deque()  # (event loop, future) of coroutines waiting for a slot
+
+    def _check_pid(self):
+        """Discard slots and outcomes inherited through a fork; the caller holds the lock"""
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            self._reset()
+
+    def _expected_wait(self, position):
+        """
+        Estimate the seconds until the request at queue position (1-based) gets a slot
+
+        Returns:
+            float: The estimate, or None until enough upstream calls were timed
+        """
+        call_seconds = self.latency_percentile(50, 5)
+        if call_seconds is None:
+            return None
+        return math.ceil(position / self.max_concurrency) * call_seconds
+
+    def _retry_after(self, position):
+        expected = self._expected_wait(position)
+        return self.queue_timeout if expected is None else expected
+
+    def _reject(self, counter, message, status_code, retry_after):
+        self.counters[counter] += 1
+        raise Overloaded(message, status_code, max(1, math.ceil(retry_after)))
+
+    def _check_circuit(self, now):
+        """
+        Reject the request if the circuit is open; the caller holds the lock
+
+        Returns:
+            bool: True if the request is the half-open probe
+        """
+        if self.state == CLOSED:
+            return False
+        remaining = self.opened_at + self.open_seconds - now
+        if self.state == OPEN and remaining <= 0:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self._reject("rejected_circuit_open", "Upstream is failing, try again later", 503,
+                     max(remaining, 1))
+
+    def check_circuit(self):
+        """
+        Fail fast while the circuit is open, for work that is queued elsewhere
+
+        Raises:
+            Overloaded: With status 503 while the circuit is open
+        """
+        if not self.enabled:
+            return
+        with self.condition:
+            self._check_pid()
+            now = time.monotonic()
+            if self.state == OPEN and self.opened_at + self.open_seconds > now:
+                self._reject("rejected_circuit_open", "Upstream is failing, try again later", 503,
+                             self.opened_at + self.open_seconds - now)
+
+    def _slots(self, background):
+        """Slots a request may use; background requests leave the reserve free"""
+        if background:
+            return max(1, self.max_concurrency - self.reserve)
+        return self.max_concurrency
+
+    def _enter(self, background=False):
+        """
+        Take a slot, or register as waiting for one; the caller holds the lock
+
+        Returns:
+            tuple: (whether this is the half-open probe, whether the caller must wait)
+        """
+        self._check_pid()
+        probe = self._check_circuit(time.monotonic())
+        if self.active < self._slots(background):
+            self.active += 1
+            self.counters["admitted"] += 1
+            return probe, False
+        try:
+            if self.waiting >= self.queue_size:
+                self._reject("rejected_queue_full", "Too many requests in progress, try again later",
+                             429, self._retry_after(self.waiting + 1))
+            expected = self._expected_wait(self.waiting + 1)
+            if expected is not None and expected > self.queue_timeout:
+                # Waiting would only use up the client's time and a thread
+                self._reject("rejected_wait", "Too many requests in progress, try again later",
+                             429, expected)
+        except Overloaded:
+            if probe:
+                self.probing = False
+            raise
+        self.waiting += 1
+        self.counters["queued"] += 1
+        return probe, True
+
+    def _end_wait(self, probe, admitted):
+        """Take the slot a waiter was waiting for, or reject it; the caller holds the lock"""
+        self.waiting -= 1
+        if admitted:
+            self.active += 1
+            self.counters["admitted"] += 1
+            return
+        if probe:
+            self.probing = False
+        self._reject("rejected_timeout", "Too many requests in progress, try again later",
+                     429, self._retry_after(self.waiting + 1))
+
+    def _forget_waiter(self, waiter):
+        """Take a coroutine's future out of async_waiters; the caller holds the lock"""
+        try:
+            self.async_waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _leave(self, probe):
+        """Give a slot back and wake the next waiter"""
+        with self.condition:
+            self.active -= 1
+            if probe:
+                self.probing = False
+            # Wake every waiter (at most queue_size), since a background waiter
+            # may not be allowed the freed slot while an interactive one is
+            self.condition.notify_all()
+            # Wake every waiting coroutine (at most queue_size); those that lose the race wait again
+            while self.async_waiters:
+                loop, future = self.async_waiters.popleft()
+                loop.call_soon_threadsafe(_wake, future)
+
+    @contextmanager
+    def admit(self, background=False):
+        """
+        Hold an upstream slot for the duration of a with block
+
+        Args:
+            background: Whether the request is background work, which may not
+                take the slots reserved for interactive requests
+
+        Raises:
+            Overloaded: With status 503 while the circuit is open, or 429 when
+                no slot can be had within the queue timeout
+        """
+        if not self.enabled:
+            yield
+            return
+
+        with self.condition:
+            probe, must_wait = self._enter(background)
+            if must_wait:
+                slots = self._slots(background)
+                admitted = self.condition.wait_for(
+                    lambda: self.active < slots, self.queue_timeout
+                )
+                self._end_wait(probe, admitted)
+        try:
+            yield
+        finally:
+            self._leave(probe)
+
+    @asynccontextmanager
+    async def admit_async(self):
+        """
+        Like admit, for coroutines; waiting for a slot does not block the event loop
+
+        Raises:
+            Overloaded: With status 503 while the circuit is open, or 429 when
+                no slot can be had within the queue timeout
+        """
+        if not self.enabled:
+            yield
+            return
+
+        with self.condition:
+            probe, must_wait = self._enter()
+        if must_wait:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.queue_timeout
+            admitted = False
+            waiter = None
+            try:
+                while True:
+                    with self.condition:
+                        self._forget_waiter(waiter)
+                        if self.active < self.max_concurrency:
+                            admitted = True
+                            break
+                        waiter = (loop, loop.create_future())
+                        self.async_waiters.append(waiter)
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(waiter[1], remaining)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                # Cancelled while queued: leave the queue without taking a slot
+                with self.condition:
+                    self._forget_waiter(waiter)
+                    self.waiting -= 1
+                    if probe:
+                        self.probing = False
+                raise
+            with self.condition:
+                self._forget_waiter(waiter)
+                self._end_wait(probe, admitted)
+        try:
+            yield
+        finally:
+            self._leave(probe)
+
+    def record(self, outcomes):
+        """
+        Feed upstream attempt outcomes to the circuit breaker
+
+        Args:
+            outcomes: The "outcomes" list of a retryInfo dict
+        """
+        if not self.enabled:
+            return
+
+        with self.condition:
+            self._check_pid()
+            now = time.monotonic()
+            for outcome in outcomes:
+                if outcome["outcome"] == "success":
+                    failed = False
+                elif outcome["outcome"] in FAILURE_OUTCOMES:
+                    failed = True
+                else:
+                    continue
+
+                if self.state == HALF_OPEN:
+                    # The probe decides: close and forget the old failures, or open again
+                    if failed:
+                        self._open(now)
+                    else:
+                        self.state = CLOSED
+                        self.outcomes.clear()
+                        print("🔍 Upstream circuit closed")
+                    continue
+                self.outcomes.append((now, failed))
+
+            while self.outcomes and self.outcomes[0][0] < now - self.window:
+                self.outcomes.popleft()
+            if self.state == CLOSED and len(self.outcomes) >= self.min_calls:
+                failures = sum(1 for _, failed in self.outcomes if failed)
+                if failures / len(self.outcomes) >= self.failure_rate:
+                    self._open(now)
+
+    def _open(self, now):
+        """Open the circuit; the caller holds the lock"""
+        self.state = OPEN
+        self.opened_at = now
+        self.outcomes.clear()
+        self.counters["circuit_opened"] += 1
+        print(f"🔍 Upstream circuit opened for {self.open_seconds:g}s")
+
+    def stats(self):
+        """Return slot usage, the circuit state and rejection counters"""
+        with self.condition:
+            self._check_pid()
+            stats = dict(self.counters)
+            stats["active"] = self.active
+            stats["waiting"] = self.waiting
+            stats["circuit"] = self.state
+            stats["recent_attempts"] = len(self.outcomes)
+            stats["recent_failures"] = sum(1 for _, failed in self.outcomes if failed)
+        stats["enabled"] = self.enabled
+        stats["max_concurrency"] = self.max_concurrency
+        stats["interactive_reserve"] = self.reserve
+        stats["queue_size"] = self.queue_size
+        return stats
@@ -128,7 +128,7 @@ function RecentImagesGallery({ onImageSelected, refreshTrigger = 0 }) {
           >
             <div className="aspect-square bg-gray-100 dark:bg-gray-900 overflow-hidden">
               <img 
-                src={`data:image/jpeg;base64,${image.imageData}`}
+                src={`data:${image.mimeType || 'image/jpeg'};base64,${image.imageData}`}
                 alt="Generated fashion model" 
                 className="w-full h-full object-cover"
                 loading="lazy"
@@ -1,16 +1,28 @@
 import os
 import base64
+import binascii
 import json
-import requests
-import time
+import shutil
 import logging
-from io import BytesIO
-from flask import Flask, request, jsonify
+import tempfile
+import time
+from flask import Flask, Response, g, request, jsonify, redirect, send_file, stream_with_context
 from flask_cors import CORS
-from PIL import Image
 from dotenv import load_dotenv
 import storage
-from key_manager import KeyManager
+from key_manager import create_key_manager
+from jobs import JobManager, JobQueueFull, TERMINAL_STATES
+from gemini_client import (
+    GEMINI_MODEL, build_request_body, gemini_client, request_fingerprint
+)
+from retry_policy import RetryError, RetryPolicy
+from admission import AdmissionController, Overloaded
+from batch import BatchRunner
+from hedging import Hedger
+from metrics import metrics
+from preprocessing import preprocess_upload
+from result_cache import ResultCache
+from singleflight import SingleFlight
 
 # Configure logging
 logging.basicConfig(
@@ -25,13 +37,17 @@ load_dotenv()
 # Initialize Flask app
 app = Flask(__name__)
 
+# Largest accepted request body in bytes; uploads bigger than
+# UPLOAD_SPOOL_BYTES are spooled to a temporary file instead of memory
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 32 * 1024 * 1024))
+UPLOAD_SPOOL_BYTES = int(os.environ.get('UPLOAD_SPOOL_BYTES', 1024 * 1024))
+
 # Configure CORS based on environment
 allowed_origins = os.environ.get('ALLOWED_ORIGINS', '*').split(',')
 print(f"Allowing CORS for: {allowed_origins}")
 CORS(app, origins=allowed_origins)
 
 # Configuration
-import random
 
 # Load Gemini API keys from environment variables for security
 GEMINI_API_KEYS = []
@@ -52,17 +68,35 @@ if not GEMINI_API_KEYS:
 else:
     logger.info(f"Loaded {len(GEMINI_API_KEYS)} Gemini API keys")
 
-# Initialize the key manager
-key_manager = KeyManager(GEMINI_API_KEYS)
+# Initialize the key manager (shared between workers when gunicorn runs several)
+key_manager = create_key_manager(GEMINI_API_KEYS, storage.STORAGE_DIR / "key_state.db")
+
+# Shared retry/backoff behaviour for all upstream calls, with optional hedging
+hedger = Hedger(gemini_client.latency_percentile)
+retry_policy = RetryPolicy(key_manager, hedger=hedger)
+
+# Limits in-flight upstream-bound requests and sheds load while upstream is failing
+admission = AdmissionController(gemini_client.latency_percentile)
+
+# Background executor for /api/jobs; records live next to the images
+job_manager = JobManager(storage.STORAGE_DIR / "jobs")
 
-# Function to get a random API key
-def get_api_key():
-    """Get the best available API key using the key manager"""
-    if not GEMINI_API_KEYS:
-        raise ValueError("No Gemini API keys available. Check your .env file.")
-    return key_manager.get_key()
+# Fans /api/generate-batch items out over a bounded thread pool
+batch_runner = BatchRunner()
 
-BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent"
+# Opt-in cache of upstream results, keyed on the request fingerprint
+result_cache = ResultCache(storage.STORAGE_DIR / "cache")
+
+# Deduplicates concurrent identical upstream calls
+single_flight = SingleFlight(storage.STORAGE_DIR / "inflight")
+
+# Backfill and sync the listing catalog in the background rather than on the first request
+storage.catalog.start()
+
+# Browser/proxy cache lifetime for /api/images/<id>/raw responses. Images can be
+# deleted, so this bounds how long caches keep serving a deleted one; after it,
+# caches revalidate cheaply with the ETag.
+IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 300))
 
 # Helper functions
 def get_image_data(image_data_str):
@@ -74,409 +108,694 @@ def get_image_data(image_data_str):
         image_data_str = image_data_str.split('base64,')[1]
     return base64.b64decode(image_data_str)
 
-def save_image_data(image_data):
+def decode_image_data(image_data_str):
     """
-    Save image data to a temporary file and return the URL
+    Decode base64 image data from a JSON body
+    
+    Raises:
+        ValueError: If the data is not valid base64
     """
     try:
-        # Use PIL to process the image
-        img = Image.open(BytesIO(image_data))
-        
-        # Save as PNG (could be configured as needed)
-        output = BytesIO()
-        img.save(output, format='PNG')
-        return output.getvalue(), 'image/png'
-    except Exception as e:
-        print(f"Error processing image: {e}")
+        return get_image_data(image_data_str)
+    except binascii.Error:
+        raise ValueError("Image data is not valid base64")
+
+def wants_fresh_result(data, headers=None):
+    """Check whether the client asked to skip the result cache for this request"""
+    no_cache = data.get('noCache')
+    # Form fields and query parameters arrive as strings
+    if no_cache is True or str(no_cache).lower() in ('true', '1'):
+        return True
+    headers = request.headers if headers is None else headers
+    return 'no-cache' in headers.get('Cache-Control', '').lower()
+
+def spool_request_body():
+    """
+    Copy the raw request body into a temporary file, kept in memory while small
+    
+    Returns:
+        SpooledTemporaryFile: The body, or None if it is empty
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    # request.stream enforces MAX_CONTENT_LENGTH while it is read
+    shutil.copyfileobj(request.stream, spool, 64 * 1024)
+    if spool.tell() == 0:
+        spool.close()
+        return None
+    spool.seek(0)
+    return spool
+
+def read_upload():
+    """
+    Read the request fields and image from a JSON, multipart or binary body
+    
+    JSON bodies carry the image base64-encoded in imageData. Multipart bodies
+    carry it as a file part named image (or imageData) next to ordinary form
+    fields. application/octet-stream and image/* bodies are the image itself,
+    with the other fields in the query string.
+    
+    Returns:
+        tuple: (fields dict or None, image as bytes or a binary file object, or None)
+    
+    Raises:
+        ValueError: If JSON image data is not valid base64
+    """
+    mimetype = request.mimetype
+    if mimetype == 'multipart/form-data':
+        # Werkzeug already spools large file parts to disk while parsing
+        upload = request.files.get('image') or request.files.get('imageData')
+        return request.form.to_dict(), upload.stream if upload else None
+    
+    if mimetype == 'application/octet-stream' or mimetype.startswith('image/'):
+        return request.args.to_dict(), spool_request_body()
+    
+    data = request.get_json(silent=True)
+    if not data:
         return None, None
+    image_data = data.get('imageData')
+    return data, decode_image_data(image_data) if image_data else None
+
+def prepare_input_image(image):
+    """
+    Shrink an uploaded image for the upstream request
+    
+    Args:
+        image: Image bytes or a binary file object
+    
+    Returns:
+        PreparedUpload: The image bytes to send and their real MIME type
+    
+    Raises:
+        ValueError: If the data is not a readable image
+    """
+    upload = preprocess_upload(image)
+    print(f"🔍 UPLOAD: {upload.original_bytes} -> {len(upload.data)} bytes "
+          f"({upload.bytes_saved} saved), {upload.mime_type} {upload.width}x{upload.height}")
+    return upload
+
+def negotiate_rendition(renditions):
+    """
+    Pick which stored file of an image to serve from the Accept header
+    
+    Among formats the client accepts equally, the first listed (the
+    smallest) wins. Clients without an Accept header, or accepting none of
+    the stored formats, get the last entry, which is the original.
+    
+    Args:
+        renditions: (key, MIME type) pairs from storage.get_image_renditions
+    
+    Returns:
+        tuple: (key, MIME type) to serve
+    """
+    accept = request.accept_mimetypes
+    if not accept:
+        return renditions[-1]
+    best = max(renditions, key=lambda rendition: accept.quality(rendition[1]))
+    return best if accept.quality(best[1]) > 0 else renditions[-1]
+
+# Upstream pipelines shared by the synchronous routes and background jobs
+def lookup_cached_result(cache_key, use_cache, retry_info):
+    """
+    Check the result cache before calling upstream
+    
+    Returns:
+        dict: The cached entry, or None if the request must go upstream
+    """
+    if cache_key is None or not result_cache.enabled:
+        return None
+    if not use_cache:
+        result_cache.record_bypass()
+        return None
+    
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        print("🔍 Serving result from cache")
+        retry_info["success"] = True
+        retry_info["cached"] = True
+    return cached
+
+def record_upstream_outcomes(route, retry_info):
+    """Feed attempt outcomes to the circuit breaker and record them with the time spent upstream"""
+    outcomes = retry_info["outcomes"]
+    admission.record(outcomes)
+    for outcome in outcomes:
+        metrics.inc("upstream_attempts_total", route=route, outcome=outcome["outcome"])
+    if outcomes:
+        upstream_seconds = sum(outcome["seconds"] for outcome in outcomes)
+        metrics.observe("stage_seconds", upstream_seconds, route=route, stage="upstream")
+    slept = sum(outcome.get("delay", 0) for outcome in outcomes)
+    if slept:
+        metrics.observe("stage_seconds", slept, route=route, stage="retry_sleep")
+
+def coalescing_key(fingerprint, use_cache):
+    """
+    Key under which concurrent identical requests share one upstream call
+    
+    Requests that skip the cache must not join a call that may answer from
+    it, so they coalesce only with other cache-skipping requests.
+    
+    Args:
+        fingerprint: Request fingerprint from request_fingerprint()
+        use_cache: Whether the request may be answered from the result cache
+    
+    Returns:
+        str: The single-flight key
+    """
+    return fingerprint if use_cache else f"{fingerprint}-fresh"
+
+def coalesce(fingerprint, fn):
+    """
+    Share one upstream call between concurrent identical requests
+    
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    (payload, status), shared = single_flight.do(fingerprint, fn)
+    if shared:
+        payload["retryInfo"] = {**payload.get("retryInfo", {}), "coalesced": True}
+    return payload, status
+
+def run_generation(prompt, use_cache=True):
+    """
+    Generate an image from a prompt, retrying on failure, and save it to storage
+    
+    Concurrent identical requests share a single upstream call.
+    
+    Args:
+        prompt: The generation prompt
+        use_cache: Whether a cached result may be returned instead of calling upstream
+    
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    fingerprint = request_fingerprint(prompt)
+    return coalesce(
+        coalescing_key(fingerprint, use_cache),
+        lambda: generate_upstream(prompt, fingerprint, use_cache)
+    )
+
+def run_edit(prompt, image, use_cache=True):
+    """
+    Edit an image according to a prompt, retrying on failure
+    
+    The input image is downscaled and recompressed first. Concurrent
+    identical requests share a single upstream call.
+    
+    Args:
+        prompt: The edit instructions
+        image: Input image as bytes or a binary file object
+        use_cache: Whether a cached result may be returned instead of calling upstream
+        
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    try:
+        with metrics.timer("stage_seconds", route="edit", stage="preprocess"):
+            upload = prepare_input_image(image)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    
+    fingerprint = request_fingerprint(prompt, image_bytes=upload.data)
+    payload, status = coalesce(
+        coalescing_key(fingerprint, use_cache),
+        lambda: edit_upstream(prompt, upload, fingerprint, use_cache)
+    )
+    payload["upload"] = upload.describe()
+    return payload, status
+
+def generate_upstream(prompt, cache_key, use_cache):
+    """
+    Generate an image with retries and save it to storage
+    
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    retry_info = retry_policy.new_retry_info()
+    
+    with metrics.timer("stage_seconds", route="generate", stage="cache_lookup"):
+        cached = lookup_cached_result(cache_key, use_cache, retry_info)
+    if cached is not None:
+        result_image_data = cached["imageData"]
+        image_bytes = base64.b64decode(result_image_data)
+    else:
+        # Create request with prompt and image generation settings
+        request_body = build_request_body(prompt)
+        
+        # Log request (prompts can contain personal data, so only their size is logged)
+        print(f"🔍 REQUEST MODEL: {GEMINI_MODEL}")
+        print(f"🔍 PROMPT: {len(prompt)} chars")
+        
+        try:
+            result = retry_policy.run(
+                lambda api_key, timeout: gemini_client.generate_content(api_key, request_body, timeout),
+                retry_info,
+                label="generate image"
+            )
+        except RetryError as e:
+            return {
+                "error": e.message,
+                "retryInfo": retry_info
+            }, e.status_code
+        finally:
+            record_upstream_outcomes("generate", retry_info)
+        
+        image_bytes = result.image_bytes
+        result_image_data = result.image_data
+        print(f"🔍 IMAGE RECEIVED: {len(image_bytes)} bytes, mime type: {result.mime_type}")
+        if cache_key:
+            result_cache.put(cache_key, result_image_data, mime_type=result.mime_type)
+    
+    # Save the decoded image to storage without another base64 round trip
+    with metrics.timer("stage_seconds", route="generate", stage="save"):
+        image_id = storage.save_image_bytes(
+            image_bytes, 
+            metadata={"prompt": prompt, "type": "generated"}
+        )
+    
+    # Return both the image data and ID
+    return {
+        "imageData": result_image_data,
+        "imageId": image_id,
+        "prompt": prompt,
+        "retryInfo": retry_info
+    }, 200
+
+def edit_upstream(prompt, upload, cache_key, use_cache):
+    """
+    Edit an image with retries
+    
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    retry_info = retry_policy.new_retry_info()
+    
+    with metrics.timer("stage_seconds", route="edit", stage="cache_lookup"):
+        cached = lookup_cached_result(cache_key, use_cache, retry_info)
+    if cached is not None:
+        result_text = cached["text"]
+        result_image_data = cached["imageData"]
+    else:
+        # Create request with both image and prompt
+        request_body = build_request_body(
+            prompt,
+            image_data=base64.b64encode(upload.data).decode('ascii'),
+            mime_type=upload.mime_type
+        )
+        
+        # Log request (without the image data or prompt text)
+        print(f"🔍 REQUEST MODEL: {GEMINI_MODEL}")
+        print(f"🔍 PROMPT: {len(prompt)} chars")
+        print(f"🔍 WITH IMAGE: {len(upload.data)} bytes, {upload.mime_type}")
+        
+        try:
+            result = retry_policy.run(
+                lambda api_key, timeout: gemini_client.generate_content(api_key, request_body, timeout),
+                retry_info,
+                label="edit image"
+            )
+        except RetryError as e:
+            return {
+                "error": e.message,
+                "retryInfo": retry_info
+            }, e.status_code
+        finally:
+            record_upstream_outcomes("edit", retry_info)
+        
+        result_text = result.text
+        result_image_data = result.image_data
+        print(f"🔍 IMAGE RECEIVED: {len(result.image_bytes)} bytes, mime type: {result.mime_type}")
+        if cache_key:
+            result_cache.put(cache_key, result_image_data, text=result_text, mime_type=result.mime_type)
+    
+    # Return results
+    return {
+        "text": result_text,
+        "imageData": result_image_data,
+        "retryInfo": retry_info
+    }, 200
+
+def run_job(job_type, prompt, image_bytes=None, use_cache=True):
+    """
+    Run a generate or edit job and save its result to storage
+    
+    The image itself is dropped from the job result to keep job records small;
+    clients fetch it from imageUrl instead.
+    
+    Returns:
+        tuple: (job result dict, HTTP status code)
+    """
+    if job_type == "edit":
+        payload, status = run_edit(prompt, image_bytes, use_cache)
+        if status < 400 and payload.get("imageData"):
+            with metrics.timer("stage_seconds", route="edit", stage="save"):
+                payload["imageId"] = storage.save_image(
+                    payload["imageData"],
+                    metadata={"prompt": prompt, "type": "edited"}
+                )
+    else:
+        payload, status = run_generation(prompt, use_cache)
+    
+    payload.pop("imageData", None)
+    if payload.get("imageId"):
+        payload["imageUrl"] = f"/api/images/{payload['imageId']}/raw"
+    return payload, status
+
+def run_batch_item(prompt, include_image_data=False):
+    """
+    Generate one image of a batch and save it to storage
+    
+    Items always go upstream: a batch of the same prompt asks for variations,
+    so neither the result cache nor request coalescing applies. Each item
+    takes its own admission slot as background work, so batches never take
+    the slots reserved for interactive requests, and a full worker fails the
+    item instead of the batch.
+    
+    Returns:
+        tuple: (item result dict, HTTP status code)
+    """
+    try:
+        with admission.admit(background=True):
+            payload, status = generate_upstream(prompt, None, False)
+    except Overloaded as e:
+        return {"error": e.message, "retryAfter": e.retry_after}, e.status_code
+    
+    if not include_image_data:
+        payload.pop("imageData", None)
+    if payload.get("imageId"):
+        payload["imageUrl"] = f"/api/images/{payload['imageId']}/raw"
+    return payload, status
+
+def image_not_found(image_id):
+    """404 for a missing image, or 500 if this worker failed to save it"""
+    error = storage.get_write_failure(image_id)
+    if error:
+        return jsonify({"error": f"Image could not be saved: {error}"}), 500
+    return jsonify({"error": "Image not found"}), 404
+
+def job_response(job):
+    """Shape a job record for API responses"""
+    return {
+        "jobId": job["id"],
+        "type": job["type"],
+        "status": job["status"],
+        "createdAt": job["createdAt"],
+        "updatedAt": job["updatedAt"],
+        "result": job["result"],
+        "error": job["error"]
+    }
 
 # Routes
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count every response and time it by route pattern, which keeps label values bounded"""
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.inc("http_requests_total", endpoint=endpoint, method=request.method,
+                status=response.status_code)
+    started = g.get("request_started")
+    if started is not None:
+        metrics.observe("http_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+    return response
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Answer oversized uploads with JSON like every other API error"""
+    return jsonify({
+        "error": f"Request body exceeds the {app.config['MAX_CONTENT_LENGTH']} byte limit"
+    }), 413
+
+@app.errorhandler(Overloaded)
+def request_shed(e):
+    """Reject shed requests quickly, telling the client when to come back"""
+    response = jsonify({"error": e.message})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.status_code
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "ok", "message": "Backend server is running"})
 
+def collect_stats():
+    """Gather runtime statistics for the upstream client and other subsystems"""
+    return {
+        "gemini": gemini_client.stats(),
+        "keys": key_manager.stats(),
+        "jobs": job_manager.stats(),
+        "batches": batch_runner.stats(),
+        "resultCache": result_cache.stats(),
+        "singleFlight": single_flight.stats(),
+        "hedging": hedger.stats(),
+        "admission": admission.stats(),
+        "storageWriter": storage.writer.stats(),
+        "storageTranscoder": storage.transcoder.stats(),
+        "imageCache": storage.hot_images.stats()
+    }
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Report runtime statistics for the upstream client and other subsystems"""
+    return jsonify(collect_stats())
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Expose request, stage, upstream, key and storage metrics of all workers in Prometheus format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/generate-image', methods=['POST'])
 def generate_image():
-    data = request.json
+    with metrics.timer("stage_seconds", route="generate", stage="decode"):
+        data = request.json
     prompt = data.get('prompt')
     
     if not prompt:
         return jsonify({"error": "No prompt provided"}), 400
 
     try:
-        # Set up for retry mechanism
-        max_attempts = 3
-        attempt = 0
-        result_image_data = None
-        retry_info = {
-            "attempts": 0,
-            "max_attempts": max_attempts,
-            "errors": [],
-            "success": False
-        }
-        
-        while attempt < max_attempts:
-            attempt += 1
-            
-            try:
-                print(f"🔍 ATTEMPT {attempt}/{max_attempts} to generate image")
-                
-                # Create request with prompt and image generation settings
-                request_body = {
-                    "contents": [
-                        {
-                            "role": "user",
-                            "parts": [
-                                {
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ],
-                    "generationConfig": {
-                        "temperature": 1,
-                        "topP": 0.95,
-                        "topK": 40,
-                        "maxOutputTokens": 8192,
-                        "responseModalities": ["image", "text"]
-                    },
-                    "safetySettings": [
-                        {
-                            "category": "HARM_CATEGORY_CIVIC_INTEGRITY",
-                            "threshold": "BLOCK_NONE"
-                        }
-                    ]
-                }
-                
-                # Log request
-                print(f"🔍 REQUEST MODEL: gemini-2.0-flash-exp")
-                print(f"🔍 PROMPT: {prompt}")
-                
-                # Get an API key from the key manager
-                api_key = get_api_key()
-
-                # Make the API call
-                url = f"{BASE_URL}?key={api_key}"
-                response = requests.post(
-                    url, 
-                    json=request_body,
-                    headers={"Content-Type": "application/json"}
-                )
-                
-                # Handle API errors with smarter key rotation
-                if response.status_code != 200:
-                    error_message = "Unknown error"
-                    try:
-                        error_data = response.json()
-                        if 'error' in error_data and 'message' in error_data['error']:
-                            error_message = error_data['error']['message']
-                            
-                            # Check for rate limiting errors
-                            if 'rate limit' in error_message.lower() or 'quota' in error_message.lower():
-                                # Mark this key as rate limited
-                                key_manager.mark_rate_limited(api_key)
-                                logger.warning(f"API key hit rate limit. Marked for cooldown.")
-                    except:
-                        error_message = f"API Error: {response.status_code}"
-                    
-                    if attempt < max_attempts:
-                        retry_info["errors"].append({
-                            "attempt": attempt,
-                            "message": error_message,
-                            "type": "api_error"
-                        })
-                        time.sleep(1)  # Short delay before retry
-                        continue
-                    else:
-                        return jsonify({
-                            "error": error_message,
-                            "retryInfo": retry_info
-                        }), response.status_code
-                
-                # Process successful response
-                response_data = response.json()
-                print(f"🔍 RESPONSE STATUS: {response.status_code}")
-                
-                # Extract image data
-                if 'candidates' in response_data and response_data['candidates']:
-                    first_candidate = response_data['candidates'][0]
-                    if 'content' in first_candidate and 'parts' in first_candidate['content']:
-                        parts = first_candidate['content']['parts']
-                        
-                        for part in parts:
-                            if 'inlineData' in part:
-                                inline_data = part['inlineData']
-                                if 'data' in inline_data and 'mimeType' in inline_data:
-                                    mime_type = inline_data['mimeType']
-                                    if mime_type.startswith('image/'):
-                                        result_image_data = inline_data['data']
-                                        print(f"🔍 IMAGE RECEIVED: {len(result_image_data)} chars, mime type: {mime_type}")
-                
-                # Check if we got an image back
-                if result_image_data is not None:
-                    print(f"🔍 Successfully generated image on attempt {attempt}/{max_attempts}")
-                    retry_info["attempts"] = attempt
-                    retry_info["success"] = True
-                    break  # Success - exit the retry loop
-                else:
-                    print(f"🔍 No image data in response, attempt {attempt}/{max_attempts}")
-                    if attempt < max_attempts:
-                        retry_info["errors"].append({
-                            "attempt": attempt,
-                            "message": "No image data received from API",
-                            "type": "missing_data"
-                        })
-                        time.sleep(1)  # Short delay before retry
-                        continue
-                    else:
-                        return jsonify({
-                            "error": "No image data received after multiple attempts",
-                            "retryInfo": retry_info
-                        }), 500
-            
-            except Exception as e:
-                print(f"🔍 Error during attempt {attempt}: {str(e)}")
-                retry_info["errors"].append({
-                    "attempt": attempt,
-                    "message": str(e),
-                    "type": "exception"
-                })
-                if attempt < max_attempts:
-                    time.sleep(1)  # Short delay before retry
-                    continue
-                else:
-                    return jsonify({
-                        "error": str(e),
-                        "retryInfo": retry_info
-                    }), 500
-        
-        # If we got here with image data, save it to storage
-        if result_image_data:
-            # Save image to storage
-            image_id = storage.save_image(
-                result_image_data, 
-                metadata={"prompt": prompt, "type": "generated"}
-            )
-            
-            # Return both the image data and ID
-            return jsonify({
-                "imageData": result_image_data,
-                "imageId": image_id,
-                "prompt": prompt,
-                "retryInfo": retry_info
-            })
-        else:
-            return jsonify({
-                "error": "Failed to generate image",
-                "retryInfo": retry_info
-            }), 500
-            
+        with admission.admit():
+            payload, status = run_generation(prompt, use_cache=not wants_fresh_result(data))
+        return jsonify(payload), status
+    except Overloaded:
+        raise
     except Exception as e:
         app.logger.error(f"Error generating image: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/edit-image', methods=['POST'])
 def edit_image():
+    """Edit an image sent as base64 JSON, multipart/form-data or a raw binary body"""
+    try:
+        with metrics.timer("stage_seconds", route="edit", stage="decode"):
+            data, image = read_upload()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if not data and image is None:
+        return jsonify({"error": "No data provided"}), 400
+        
+    prompt = (data or {}).get('prompt')
+    
+    if not prompt:
+        return jsonify({"error": "No prompt provided"}), 400
+    
+    if image is None:
+        return jsonify({"error": "No image data provided"}), 400
+    
+    with admission.admit():
+        payload, status = run_edit(prompt, image, use_cache=not wants_fresh_result(data))
+    return jsonify(payload), status
+
+@app.route('/api/generate-batch', methods=['POST'])
+def generate_batch():
+    """
+    Generate several images at once, streaming each result as NDJSON when it is ready
+    
+    The body holds either "prompts" (a list) or "prompt" with a "count". Each
+    line carries the item's index and prompt plus what /api/jobs would return
+    for it; a final line with "done" sums up the batch. Failed items are
+    reported on their own line and do not stop the others.
+    """
     data = request.json
     
     if not data:
         return jsonify({"error": "No data provided"}), 400
-        
+    
+    prompts = data.get('prompts')
+    if prompts is None:
+        prompt = data.get('prompt')
+        if not prompt:
+            return jsonify({"error": "No prompt provided"}), 400
+        count = data.get('count', 1)
+        if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+            return jsonify({"error": "Count must be a positive integer"}), 400
+        prompts = [prompt] * count
+    
+    if not isinstance(prompts, list) or not prompts:
+        return jsonify({"error": "Prompts must be a non-empty list"}), 400
+    if not all(isinstance(prompt, str) and prompt for prompt in prompts):
+        return jsonify({"error": "Every prompt must be a non-empty string"}), 400
+    if len(prompts) > batch_runner.max_items:
+        return jsonify({"error": f"A batch holds at most {batch_runner.max_items} images"}), 400
+    
+    # Fail the whole batch up front rather than item by item while upstream is failing
+    admission.check_circuit()
+    
+    include_image_data = request.args.get('include') == 'imageData'
+    # One call per key at a time, so a batch spreads over the keys instead of draining
+    # one, and no more than the slots batches may use, so items do not queue for them
+    concurrency = len(key_manager.keys)
+    if admission.enabled:
+        concurrency = min(concurrency, admission.max_concurrency - admission.reserve)
+    concurrency = max(1, concurrency)
+    
+    def generate_lines():
+        started = time.time()
+        succeeded = 0
+        results = batch_runner.run(
+            prompts, lambda prompt: run_batch_item(prompt, include_image_data), concurrency
+        )
+        for index, payload, status in results:
+            if status < 400:
+                succeeded += 1
+            line = {"index": index, "prompt": prompts[index], "status": status, **payload}
+            yield json.dumps(line) + "\n"
+        yield json.dumps({
+            "done": True,
+            "total": len(prompts),
+            "succeeded": succeeded,
+            "failed": len(prompts) - succeeded,
+            "seconds": round(time.time() - started, 3)
+        }) + "\n"
+    
+    response = Response(stream_with_context(generate_lines()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Queue a generate or edit request and return immediately with a job ID"""
+    data = request.json
+    
+    if not data:
+        return jsonify({"error": "No data provided"}), 400
+    
+    job_type = data.get('type', 'generate')
     prompt = data.get('prompt')
     image_data_b64 = data.get('imageData')
     
+    if job_type not in ('generate', 'edit'):
+        return jsonify({"error": "Job type must be 'generate' or 'edit'"}), 400
+    
     if not prompt:
         return jsonify({"error": "No prompt provided"}), 400
     
-    if not image_data_b64:
+    if job_type == 'edit' and not image_data_b64:
         return jsonify({"error": "No image data provided"}), 400
     
+    try:
+        image_bytes = decode_image_data(image_data_b64) if job_type == 'edit' else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Jobs already wait in their own bounded queue, but none should be queued while upstream is failing
+    admission.check_circuit()
+    
+    try:
+        job = job_manager.submit(
+            job_type, run_job, job_type, prompt, image_bytes, not wants_fresh_result(data)
+        )
+    except JobQueueFull as e:
+        response = jsonify({"error": str(e)})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    
+    response = jsonify({
+        **job_response(job),
+        "statusUrl": f"/api/jobs/{job['id']}",
+        "eventsUrl": f"/api/jobs/{job['id']}/events"
+    })
+    response.headers['Location'] = f"/api/jobs/{job['id']}"
+    return response, 202
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report a job's status and, once finished, its result"""
+    job = job_manager.get(job_id)
     
-    # Set up for retry mechanism
-    max_attempts = 3
-    attempt = 0
-    result_text = None
-    result_image_data = None
-    last_error = None
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
     
-    # Track detailed retry information
-    retry_info = {
-        "attempts": 0,
-        "max_attempts": max_attempts,
-        "errors": [],
-        "success": False
-    }
+    payload = job_response(job)
     
-    while attempt < max_attempts:
-        attempt += 1
-        
-        try:
-            print(f"🔍 ATTEMPT {attempt}/{max_attempts} to edit image")
-            
-            # Create request with both image and prompt
-            request_body = {
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": [
-                            {
-                                "inlineData": {
-                                    "mimeType": "image/jpeg",
-                                    "data": image_data_b64
-                                }
-                            },
-                            {
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 1,
-                    "topP": 0.95,
-                    "topK": 40,
-                    "maxOutputTokens": 8192,
-                    "responseModalities": ["image", "text"]
-                },
-                "safetySettings": [
-                    {
-                        "category": "HARM_CATEGORY_CIVIC_INTEGRITY",
-                        "threshold": "BLOCK_NONE"
-                    }
-                ]
+    # Optionally inline the finished image for clients that cannot use imageUrl
+    result = payload["result"]
+    if request.args.get('include') == 'imageData' and result and result.get("imageId"):
+        image_data, _ = storage.get_image(result["imageId"])
+        if image_data:
+            payload["result"] = {
+                **result,
+                "imageData": image_data,
+                "mimeType": storage.base64_mime_type(image_data)
             }
-            
-            # Log request (without the image data to keep logs readable)
-            print(f"🔍 REQUEST MODEL: gemini-2.0-flash-exp")
-            print(f"🔍 PROMPT: {prompt}")
-            print(f"🔍 WITH IMAGE: {len(image_data_b64) if image_data_b64 else 0} chars")
-            
-            # Get an API key from the key manager
-            api_key = get_api_key()
-
-            # Make the API call
-            url = f"{BASE_URL}?key={api_key}"
-            response = requests.post(
-                url, 
-                json=request_body,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            # Handle API errors with smarter key rotation
-            if response.status_code != 200:
-                error_message = "Unknown error"
-                try:
-                    error_data = response.json()
-                    if 'error' in error_data and 'message' in error_data['error']:
-                        error_message = error_data['error']['message']
-                        
-                        # Check for rate limiting errors
-                        if 'rate limit' in error_message.lower() or 'quota' in error_message.lower():
-                            # Mark this key as rate limited
-                            key_manager.mark_rate_limited(api_key)
-                            logger.warning(f"API key hit rate limit. Marked for cooldown.")
-                except:
-                    error_message = f"API Error: {response.status_code}"
-                
-                last_error = error_message
-                if attempt < max_attempts:
-                    time.sleep(1)  # Short delay before retry
-                    continue
-                else:
-                    return jsonify({
-                        "error": error_message,
-                        "retryInfo": retry_info
-                    }), response.status_code
-            
-            # Process successful response
-            response_data = response.json()
-            print(f"🔍 RESPONSE STATUS: {response.status_code}")
-            
-            # Extract text and image data
-            if 'candidates' in response_data and response_data['candidates']:
-                first_candidate = response_data['candidates'][0]
-                if 'content' in first_candidate and 'parts' in first_candidate['content']:
-                    parts = first_candidate['content']['parts']
-                    
-                    for part in parts:
-                        if 'text' in part:
-                            result_text = part['text']
-                        elif 'inlineData' in part:
-                            inline_data = part['inlineData']
-                            if 'data' in inline_data and 'mimeType' in inline_data:
-                                mime_type = inline_data['mimeType']
-                                if mime_type.startswith('image/'):
-                                    result_image_data = inline_data['data']
-                                    print(f"🔍 IMAGE RECEIVED: {len(result_image_data)} chars, mime type: {mime_type}")
-            
-            # Check if we got an image back
-            if result_image_data is not None:
-                print(f"🔍 Successfully edited image on attempt {attempt}/{max_attempts}")
-                # Record success information
-                retry_info["attempts"] = attempt
-                retry_info["success"] = True
-                break  # Success - exit the retry loop
-            else:
-                print(f"🔍 No image data in response, attempt {attempt}/{max_attempts}")
-                if attempt < max_attempts:
-                    last_error = "No image data received from API"
-                    # Record error about missing image data
-                    retry_info["attempts"] = attempt
-                    retry_info["errors"].append({
-                        "attempt": attempt,
-                        "message": "No image data received from API",
-                        "type": "missing_data"
-                    })
-                    time.sleep(1)  # Short delay before retry
-                    continue
-                else:
-                    return jsonify({
-                        "error": "No image data received after multiple attempts",
-                        "retryInfo": retry_info
-                    }), 500
-        
-        except Exception as e:
-            print(f"🔍 Error during attempt {attempt}: {str(e)}")
-            last_error = str(e)
-            # Record exception information
-            retry_info["attempts"] = attempt
-            retry_info["errors"].append({
-                "attempt": attempt,
-                "message": str(e),
-                "type": "exception"
-            })
-            if attempt < max_attempts:
-                time.sleep(1)  # Short delay before retry
-                continue
+    
+    return jsonify(payload)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """Push job status changes as Server-Sent Events until the job finishes"""
+    job = job_manager.get(job_id)
+    
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    
+    def generate_events():
+        current = job
+        version = -1
+        while current is not None:
+            if current["version"] > version:
+                version = current["version"]
+                yield f"event: {current['status']}\ndata: {json.dumps(job_response(current))}\n\n"
+                if current["status"] in TERMINAL_STATES:
+                    return
             else:
-                return jsonify({
-                    "error": str(e),
-                    "retryInfo": retry_info
-                }), 500
+                # Comment line keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+            current = job_manager.wait_for_update(job_id, version, timeout=15)
     
-    # Return results
-    return jsonify({
-        "text": result_text,
-        "imageData": result_image_data,
-        "retryInfo": retry_info
-    })
+    response = Response(stream_with_context(generate_events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/images/save', methods=['POST'])
 def save_image():
-    data = request.json
+    """Save an image sent as base64 JSON, multipart/form-data or a raw binary body"""
+    try:
+        data, image = read_upload()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    if not data:
+    if not data and image is None:
         return jsonify({"error": "No data provided"}), 400
     
-    image_data = data.get('imageData')
-    metadata = data.get('metadata', {})
+    metadata = (data or {}).get('metadata', {})
+    if isinstance(metadata, str):
+        # Form fields and query parameters carry metadata as a JSON string
+        try:
+            metadata = json.loads(metadata)
+        except ValueError:
+            metadata = None
+    if not isinstance(metadata, dict):
+        return jsonify({"error": "Metadata must be a JSON object"}), 400
     
-    if not image_data:
+    if image is None:
         return jsonify({"error": "No image data provided"}), 400
     
     # Save the image
-    image_id = storage.save_image(image_data, metadata)
+    image_id = storage.save_image_bytes(image, metadata)
     
     if not image_id:
         return jsonify({"error": "Failed to save image"}), 500
@@ -491,14 +810,80 @@ def get_image(image_id):
     image_data, metadata = storage.get_image(image_id)
     
     if not image_data:
-        return jsonify({"error": "Image not found"}), 404
+        return image_not_found(image_id)
     
     return jsonify({
         "id": image_id,
         "imageData": image_data,
+        "mimeType": storage.base64_mime_type(image_data),
         "metadata": metadata
     })
 
+@app.route('/api/images/<image_id>', methods=['DELETE'])
+def delete_image(image_id):
+    """Delete an image along with its renditions, metadata and thumbnails"""
+    if not storage.delete_image(image_id):
+        return jsonify({"error": "Image not found"}), 404
+    
+    return jsonify({
+        "id": image_id,
+        "message": "Image deleted successfully"
+    })
+
+@app.route('/api/images/<image_id>/raw', methods=['GET'])
+def get_image_raw(image_id):
+    """
+    Serve the stored image bytes directly so browsers and proxies can cache them
+    
+    Pass ?size=small|medium|large to get a cached JPEG thumbnail instead.
+    Otherwise the format is negotiated from the Accept header between the
+    original and any WebP/AVIF rendition.
+    Supports If-None-Match / If-Modified-Since (304) and Range requests (206).
+    With S3 storage, full images are a redirect to a presigned URL.
+    """
+    size = request.args.get('size')
+    
+    if size:
+        try:
+            image_path = storage.get_thumbnail_path(image_id, size)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if image_path is None:
+            return jsonify({"error": "Image not found"}), 404
+        mime_type = "image/jpeg"
+    else:
+        renditions = storage.get_image_renditions(image_id)
+        if not renditions:
+            return image_not_found(image_id)
+        key, mime_type = negotiate_rendition(renditions)
+        
+        url = storage.get_file_url(key, mime_type)
+        if url:
+            response = redirect(url)
+            # The redirect must not outlive the presigned URL it points to
+            response.headers['Cache-Control'] = "private, max-age=60"
+            response.vary.add('Accept')
+            return response
+        image_path = storage.get_file_path(key)
+    
+    # Stored image bytes never change for an ID, so the ETag can be strong
+    # (they can only be deleted, which is why they are not marked immutable)
+    stat = image_path.stat()
+    etag = f"{image_id}-{size or image_path.suffix[1:]}-{stat.st_size}-{stat.st_mtime_ns}"
+    
+    response = send_file(
+        image_path,
+        mimetype=mime_type,
+        conditional=True,
+        etag=etag,
+        last_modified=stat.st_mtime
+    )
+    response.headers['Cache-Control'] = f"public, max-age={IMAGE_CACHE_MAX_AGE}"
+    if not size:
+        # A rendition may appear later, so caches must key on Accept from the start
+        response.vary.add('Accept')
+    return response
+
 @app.route('/api/images/<image_id>/metadata', methods=['PUT'])
 def update_image_metadata(image_id):
     """Update the metadata for a specific image"""
@@ -529,12 +914,27 @@ def list_images():
     limit = request.args.get('limit', 50, type=int)
     offset = request.args.get('offset', 0, type=int)
     tag = request.args.get('tag', None)
+    cursor = request.args.get('cursor', None)
+    variant = request.args.get('variant', 'full')
+    size = request.args.get('size', 'small')
+    
+    # fields=metadata is shorthand for listing without any image data
+    if request.args.get('fields') == 'metadata':
+        variant = 'none'
     
-    images = storage.list_images(limit, offset, tag)
+    try:
+        images, next_cursor = storage.list_images_page(
+            limit, offset, tag, cursor,
+            variant=variant, thumbnail_size=size
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     return jsonify({
         "images": images,
-        "count": len(images)
+        "count": len(images),
+        "nextCursor": next_cursor,
+        "variant": variant
     })
 
 @app.route('/', methods=['GET'])
@@ -543,12 +943,20 @@ def index():
         "message": "AI Photo Editor API",
         "endpoints": [
             "/api/health",
+            "/api/stats",
             "/api/generate-image",
+            "/api/generate-batch",
             "/api/edit-image",
+            "/api/jobs",
+            "/api/jobs/<job_id>",
+            "/api/jobs/<job_id>/events",
             "/api/images/save",
             "/api/images/<image_id>",
+            "DELETE /api/images/<image_id>",
+            "/api/images/<image_id>/raw",
             "/api/images/<image_id>/metadata",
-            "/api/images"
+            "/api/images",
+            "/api/metrics"
         ]
     })
 
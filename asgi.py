@@ -0,0 +1,394 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import functools
+import tempfile
+from contextlib import asynccontextmanager
+
+try:
+    import anyio.to_thread
+    from a2wsgi import WSGIMiddleware
+    from starlette.applications import Starlette
+    from starlette.concurrency import run_in_threadpool
+    from starlette.middleware import Middleware
+    from starlette.middleware.cors import CORSMiddleware
+    from starlette.responses import JSONResponse
+    from starlette.routing import Mount, Route
+except ImportError:
+    raise ImportError(
+        "The ASGI app needs starlette, uvicorn, a2wsgi, python-multipart and httpx[http2] "
+        "(see the commented lines in requirements.txt)"
+    )
+
+import app as flask_app
+import storage
+from admission import Overloaded
+from gemini_client import GEMINI_MODEL, AsyncGeminiClient, build_request_body, request_fingerprint
+from metrics import metrics
+from retry_policy import RetryError
+
+# ASGI settings, overridable from the environment. Waiting on Gemini costs a coroutine
+# instead of a thread, so one process can hold far more upstream calls than a gunicorn worker.
+ASGI_MAX_CONCURRENCY = int(os.environ.get('ASGI_MAX_CONCURRENCY', 256))
+ASGI_QUEUE_SIZE = int(os.environ.get('ASGI_QUEUE_SIZE', 64))
+# Threads for storage, cache and image preprocessing calls
+ASGI_STORAGE_THREADS = int(os.environ.get('ASGI_STORAGE_THREADS', 32))
+# Threads serving every other route through the Flask app
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 16))
+
+# Non-blocking upstream client; retries, keys, caches and storage are shared with the Flask app
+gemini_client = AsyncGeminiClient()
+retry_policy = flask_app.retry_policy
+result_cache = flask_app.result_cache
+
+# One admission controller per process, so its circuit breaker also guards /api/jobs
+admission = flask_app.admission
+admission.max_concurrency = ASGI_MAX_CONCURRENCY
+admission.queue_size = ASGI_QUEUE_SIZE
+admission.latency_percentile = gemini_client.latency_percentile
+
+# Upstream calls in flight in this process, by request fingerprint
+inflight = {}
+
+class BadRequest(Exception):
+    """Raised while reading a request that cannot be processed; carries the HTTP status"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def api_route(endpoint):
+    """Record request metrics for a coroutine route and turn shed or bad requests into JSON errors"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            started = time.perf_counter()
+            try:
+                response = await handler(request)
+            except Overloaded as e:
+                response = JSONResponse({"error": e.message}, e.status_code,
+                                        headers={"Retry-After": str(e.retry_after)})
+            except BadRequest as e:
+                response = JSONResponse({"error": e.message}, e.status_code)
+            metrics.inc("http_requests_total", endpoint=endpoint, method=request.method,
+                        status=response.status_code)
+            metrics.observe("http_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+            return response
+        return wrapper
+    return decorator
+
+def check_content_length(request):
+    """
+    Reject a request whose declared body size exceeds MAX_CONTENT_LENGTH
+
+    Returns:
+        int: The limit
+
+    Raises:
+        BadRequest: With status 413 if the body is too large
+    """
+    limit = flask_app.app.config['MAX_CONTENT_LENGTH']
+    if int(request.headers.get('content-length') or 0) > limit:
+        raise BadRequest(f"Request body exceeds the {limit} byte limit", 413)
+    return limit
+
+async def read_body(request):
+    """
+    Copy the request body into a temporary file, like app.spool_request_body
+
+    The body stays in memory up to UPLOAD_SPOOL_BYTES and MAX_CONTENT_LENGTH
+    is enforced while it is read, whatever Content-Length claimed.
+
+    Returns:
+        SpooledTemporaryFile: The body, or None if it is empty
+
+    Raises:
+        BadRequest: With status 413 if the body is too large
+    """
+    limit = check_content_length(request)
+    spool = tempfile.SpooledTemporaryFile(max_size=flask_app.UPLOAD_SPOOL_BYTES)
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > limit:
+                raise BadRequest(f"Request body exceeds the {limit} byte limit", 413)
+            if size > flask_app.UPLOAD_SPOOL_BYTES:
+                # The spool is (or is about to be) on disk; keep file I/O off the event loop
+                await run_in_threadpool(spool.write, chunk)
+            else:
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    if size == 0:
+        spool.close()
+        return None
+    spool.seek(0)
+    return spool
+
+async def read_json(request):
+    """Parse a JSON body, returning None if it is missing or not an object"""
+    body = await read_body(request)
+    if body is None:
+        return None
+    try:
+        with body:
+            data = json.load(body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+async def read_upload(request):
+    """
+    Read the request fields and image, like app.read_upload
+
+    Returns:
+        tuple: (fields dict or None, image as bytes or a binary file object, or None)
+
+    Raises:
+        BadRequest: If JSON image data is not valid base64 or the body is too large
+    """
+    mimetype = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    if mimetype == 'multipart/form-data':
+        check_content_length(request)
+        # Starlette spools file parts to disk while parsing, as Werkzeug does
+        form = await request.form()
+        upload = form.get('image') or form.get('imageData')
+        fields = {key: value for key, value in form.items() if isinstance(value, str)}
+        image = await upload.read() if upload is not None and not isinstance(upload, str) else None
+        return fields, image
+
+    if mimetype == 'application/octet-stream' or mimetype.startswith('image/'):
+        return dict(request.query_params), await read_body(request)
+
+    data = await read_json(request)
+    if not data:
+        return None, None
+    image_data = data.get('imageData')
+    try:
+        return data, flask_app.decode_image_data(image_data) if image_data else None
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+async def coalesce(fingerprint, fn):
+    """
+    Share one upstream call between concurrent identical requests in this process
+
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    future = inflight.get(fingerprint)
+    if future is not None:
+        payload, status = await asyncio.shield(future)
+        payload = {**payload, "retryInfo": {**payload.get("retryInfo", {}), "coalesced": True}}
+        return payload, status
+
+    future = asyncio.get_running_loop().create_future()
+    # Followers may all have gone away; do not warn about an unretrieved exception
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    inflight[fingerprint] = future
+    try:
+        result = await fn()
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        del inflight[fingerprint]
+
+async def call_upstream(route, request_body, retry_info, label):
+    """Run the retry policy on the async client and record the attempt outcomes"""
+    try:
+        return await retry_policy.run_async(
+            lambda api_key, timeout: gemini_client.generate_content(api_key, request_body, timeout),
+            retry_info,
+            label=label
+        )
+    finally:
+        flask_app.record_upstream_outcomes(route, retry_info)
+
+async def generate_upstream(prompt, cache_key, use_cache):
+    """
+    Generate an image with retries and save it to storage, like app.generate_upstream
+
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    retry_info = retry_policy.new_retry_info()
+
+    with metrics.timer("stage_seconds", route="generate", stage="cache_lookup"):
+        cached = await run_in_threadpool(flask_app.lookup_cached_result, cache_key, use_cache, retry_info)
+    if cached is not None:
+        result_image_data = cached["imageData"]
+        image_bytes = base64.b64decode(result_image_data)
+    else:
+        # Log request (prompts can contain personal data, so only their size is logged)
+        print(f"🔍 REQUEST MODEL: {GEMINI_MODEL}")
+        print(f"🔍 PROMPT: {len(prompt)} chars")
+
+        try:
+            result = await call_upstream("generate", build_request_body(prompt), retry_info, "generate image")
+        except RetryError as e:
+            return {
+                "error": e.message,
+                "retryInfo": retry_info
+            }, e.status_code
+
+        image_bytes = result.image_bytes
+        result_image_data = result.image_data
+        print(f"🔍 IMAGE RECEIVED: {len(image_bytes)} bytes, mime type: {result.mime_type}")
+        if cache_key:
+            await run_in_threadpool(result_cache.put, cache_key, result_image_data, mime_type=result.mime_type)
+
+    with metrics.timer("stage_seconds", route="generate", stage="save"):
+        image_id = await run_in_threadpool(
+            storage.save_image_bytes,
+            image_bytes,
+            {"prompt": prompt, "type": "generated"}
+        )
+
+    return {
+        "imageData": result_image_data,
+        "imageId": image_id,
+        "prompt": prompt,
+        "retryInfo": retry_info
+    }, 200
+
+async def edit_upstream(prompt, upload, cache_key, use_cache):
+    """
+    Edit an image with retries, like app.edit_upstream
+
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    retry_info = retry_policy.new_retry_info()
+
+    with metrics.timer("stage_seconds", route="edit", stage="cache_lookup"):
+        cached = await run_in_threadpool(flask_app.lookup_cached_result, cache_key, use_cache, retry_info)
+    if cached is not None:
+        result_text = cached["text"]
+        result_image_data = cached["imageData"]
+    else:
+        request_body = build_request_body(
+            prompt,
+            image_data=base64.b64encode(upload.data).decode('ascii'),
+            mime_type=upload.mime_type
+        )
+
+        # Log request (without the image data or prompt text)
+        print(f"🔍 REQUEST MODEL: {GEMINI_MODEL}")
+        print(f"🔍 PROMPT: {len(prompt)} chars")
+        print(f"🔍 WITH IMAGE: {len(upload.data)} bytes, {upload.mime_type}")
+
+        try:
+            result = await call_upstream("edit", request_body, retry_info, "edit image")
+        except RetryError as e:
+            return {
+                "error": e.message,
+                "retryInfo": retry_info
+            }, e.status_code
+
+        result_text = result.text
+        result_image_data = result.image_data
+        print(f"🔍 IMAGE RECEIVED: {len(result.image_bytes)} bytes, mime type: {result.mime_type}")
+        if cache_key:
+            await run_in_threadpool(result_cache.put, cache_key, result_image_data,
+                                    text=result_text, mime_type=result.mime_type)
+
+    return {
+        "text": result_text,
+        "imageData": result_image_data,
+        "retryInfo": retry_info
+    }, 200
+
+@api_route('/api/generate-image')
+async def generate_image(request):
+    with metrics.timer("stage_seconds", route="generate", stage="decode"):
+        data = await read_json(request)
+    prompt = (data or {}).get('prompt')
+
+    if not prompt:
+        return JSONResponse({"error": "No prompt provided"}, 400)
+
+    use_cache = not flask_app.wants_fresh_result(data, request.headers)
+    fingerprint = request_fingerprint(prompt)
+    try:
+        async with admission.admit_async():
+            payload, status = await coalesce(
+                flask_app.coalescing_key(fingerprint, use_cache),
+                lambda: generate_upstream(prompt, fingerprint, use_cache)
+            )
+        return JSONResponse(payload, status)
+    except Overloaded:
+        raise
+    except Exception as e:
+        flask_app.logger.error(f"Error generating image: {str(e)}")
+        return JSONResponse({"error": str(e)}, 500)
+
+@api_route('/api/edit-image')
+async def edit_image(request):
+    """Edit an image sent as base64 JSON, multipart/form-data or a raw binary body"""
+    with metrics.timer("stage_seconds", route="edit", stage="decode"):
+        data, image = await read_upload(request)
+
+    if not data and image is None:
+        return JSONResponse({"error": "No data provided"}, 400)
+
+    prompt = (data or {}).get('prompt')
+
+    if not prompt:
+        return JSONResponse({"error": "No prompt provided"}, 400)
+
+    if image is None:
+        return JSONResponse({"error": "No image data provided"}, 400)
+
+    use_cache = not flask_app.wants_fresh_result(data, request.headers)
+    async with admission.admit_async():
+        try:
+            with metrics.timer("stage_seconds", route="edit", stage="preprocess"):
+                upload = await run_in_threadpool(flask_app.prepare_input_image, image)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, 400)
+
+        fingerprint = request_fingerprint(prompt, image_bytes=upload.data)
+        payload, status = await coalesce(
+            flask_app.coalescing_key(fingerprint, use_cache),
+            lambda: edit_upstream(prompt, upload, fingerprint, use_cache)
+        )
+    payload["upload"] = upload.describe()
+    return JSONResponse(payload, status)
+
+@api_route('/api/stats')
+async def get_stats(request):
+    """Report runtime statistics, including the async upstream client's"""
+    stats = await run_in_threadpool(flask_app.collect_stats)
+    stats["geminiAsync"] = gemini_client.stats()
+    return JSONResponse(stats)
+
+@asynccontextmanager
+async def lifespan(app):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ASGI_STORAGE_THREADS
+    yield
+    await gemini_client.aclose()
+
+# Coroutine routes for the upstream-bound endpoints; everything else is served by Flask
+app = Starlette(
+    routes=[
+        Route('/api/generate-image', generate_image, methods=['POST']),
+        Route('/api/edit-image', edit_image, methods=['POST']),
+        Route('/api/stats', get_stats, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(flask_app.app, workers=ASGI_WSGI_THREADS)),
+    ],
+    # Replaces the CORS headers Flask-CORS sets, with the same allowed origins
+    middleware=[Middleware(CORSMiddleware, allow_origins=flask_app.allowed_origins,
+                           allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan
+)
@@ -0,0 +1,100 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Batch generation limits, overridable from the environment
+BATCH_THREADS = int(os.environ.get('BATCH_THREADS', 8))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 16))
+
+class BatchRunner:
+    def __init__(self, max_threads=BATCH_THREADS, concurrency=BATCH_CONCURRENCY,
+                 max_items=BATCH_MAX_ITEMS):
+        """
+        Initialize the batch runner
+
+        All batches of a process share one bounded pool of threads. Each batch
+        keeps at most `concurrency` items in flight, so one large batch cannot
+        take every thread from the others.
+
+        Args:
+            max_threads: Threads shared by all batches in a process
+            concurrency: Items of one batch run at once
+            max_items: Largest accepted batch
+        """
+        self.max_threads = max_threads
+        self.concurrency = concurrency
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None
+        self.counters = {
+            "batches": 0,
+            "items_succeeded": 0,
+            "items_failed": 0,
+            "items_abandoned": 0
+        }
+
+    def _get_executor(self):
+        """Get this process's executor, creating a new one after a fork"""
+        pid = os.getpid()
+        if self.executor is None or self.executor_pid != pid:
+            with self.lock:
+                if self.executor is None or self.executor_pid != pid:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.max_threads,
+                        thread_name_prefix="batch"
+                    )
+                    self.executor_pid = pid
+        return self.executor
+
+    def run(self, items, fn, concurrency=None):
+        """
+        Run fn on every item and yield the results in completion order
+
+        Items are only submitted as earlier ones finish. If the caller stops
+        iterating (e.g. the client went away), the items not yet started are
+        dropped; those in flight still run to completion.
+
+        Args:
+            items: The arguments, one call of fn per item
+            fn: Callable(item) returning a (payload dict, HTTP status code) tuple
+            concurrency: Items run at once, capped at the runner's concurrency
+
+        Yields:
+            tuple: (item index, payload dict, HTTP status code)
+        """
+        limit = max(1, min(concurrency or self.concurrency, self.concurrency))
+        executor = self._get_executor()
+        pending = list(enumerate(items))
+        pending.reverse()
+        running = {}
+        with self.lock:
+            self.counters["batches"] += 1
+        try:
+            while pending or running:
+                while pending and len(running) < limit:
+                    index, item = pending.pop()
+                    running[executor.submit(fn, item)] = index
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    try:
+                        payload, status = future.result()
+                    except Exception as e:
+                        payload, status = {"error": str(e)}, 500
+                    with self.lock:
+                        self.counters["items_succeeded" if status < 400 else "items_failed"] += 1
+                    yield index, payload, status
+        finally:
+            if pending:
+                with self.lock:
+                    self.counters["items_abandoned"] += len(pending)
+
+    def stats(self):
+        """Return batch and item counters"""
+        with self.lock:
+            stats = dict(self.counters)
+        stats["max_threads"] = self.max_threads
+        stats["concurrency"] = self.concurrency
+        return stats
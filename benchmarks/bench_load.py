@@ -0,0 +1,407 @@
+"""
+Load-test the service against benchmarks/fake_gemini.py, at several
+concurrency levels and storage sizes, and compare with a previous run.
+
+    python benchmarks/bench_load.py --images 1000,100000 --concurrency 1,8,32
+    python benchmarks/bench_load.py --baseline benchmarks/results/20240101-120000.json
+    python benchmarks/bench_load.py --server gunicorn,uvicorn --scenarios generate --concurrency 32,256
+
+Starts the fake upstream and the service on local ports, under gunicorn with
+the Procfile's worker class or as the ASGI app (asgi.py) under uvicorn. Seeds
+a storage directory that is kept between runs and drives each scenario with a
+closed loop of clients. Results are written as JSON to benchmarks/results/.
+"""
+import os
+import sys
+import json
+import time
+import random
+import base64
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+from io import BytesIO
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+SCENARIOS = ("generate", "edit", "list", "get")
+SERVERS = ("gunicorn", "uvicorn")
+
+# Metrics compared against the baseline, and whether a higher value is worse
+COMPARED_METRICS = {"throughput": False, "p50_ms": True, "p95_ms": True, "p99_ms": True, "peak_rss_mb": True}
+
+# Seconds between samples of the server's memory use
+RSS_SAMPLE_INTERVAL = 0.2
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=2).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces, so split after its closing paren
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        stack.extend(children.get(current, []))
+    return pids
+
+def rss_bytes(pid, field="VmRSS"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+class RssSampler:
+    def __init__(self, pid):
+        """
+        Track the peak combined RSS of a server process and its workers
+
+        Peaks between two samples can be missed, so the largest per-process
+        high-water mark (VmHWM) is reported alongside.
+        """
+        self.pid = pid
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, sum(rss_bytes(pid) for pid in process_tree(self.pid)))
+            self.stopped.wait(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def max_hwm(self):
+        return max(rss_bytes(pid, "VmHWM") for pid in process_tree(self.pid))
+
+def seed_png(size=16):
+    """A tiny distinct PNG, so seeded images are not all deduplicated into one blob"""
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def catalog_ids(storage_dir, limit=None):
+    db_path = Path(storage_dir) / "catalog.db"
+    if not db_path.exists():
+        return []
+    with sqlite3.connect(str(db_path)) as conn:
+        query = "SELECT id FROM images ORDER BY RANDOM()"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return [row[0] for row in conn.execute(query)]
+
+def seed_storage(storage_dir, count):
+    """Grow the storage directory to at least count images"""
+    existing = len(catalog_ids(storage_dir))
+    if existing >= count:
+        return
+    print(f"Seeding {count - existing} images into {storage_dir} ...", flush=True)
+    # storage reads its settings on import; skip fsync and background work for speed
+    os.environ.update({"STORAGE_DIR": str(storage_dir), "STORAGE_FSYNC": "false",
+                       "STORAGE_WRITE_BEHIND": "false", "STORAGE_TRANSCODE": "off",
+                       "METRICS_ENABLED": "false"})
+    sys.path.insert(0, str(ROOT))
+    import storage
+
+    started = time.monotonic()
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull  # storage prints one line per saved image
+        try:
+            for i in range(existing, count):
+                storage.save_image_bytes(seed_png(), {"type": "seed", "prompt": f"seed image {i}"})
+                if (i + 1) % 10000 == 0:
+                    print(f"  {i + 1}/{count} ({time.monotonic() - started:.0f}s)", file=stdout, flush=True)
+        finally:
+            sys.stdout = stdout
+
+def edit_payload(size=1024):
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+class Scenario:
+    def __init__(self, name, base_url, image_ids, image_count, edit_image):
+        self.name = name
+        self.base_url = base_url
+        self.image_ids = image_ids
+        self.image_count = image_count
+        self.edit_image = edit_image
+        self.local = threading.local()
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def request(self, i):
+        """Send request number i and return its HTTP status"""
+        session = self.session()
+        # Distinct prompts, so the result cache and request coalescing never kick in
+        prompt = f"benchmark {self.name} request {i} {random.random()}"
+        if self.name == "generate":
+            response = session.post(f"{self.base_url}/api/generate-image", json={"prompt": prompt})
+        elif self.name == "edit":
+            response = session.post(f"{self.base_url}/api/edit-image",
+                                    json={"prompt": prompt, "imageData": self.edit_image})
+        elif self.name == "list":
+            offset = random.randrange(max(1, self.image_count - 50))
+            response = session.get(f"{self.base_url}/api/images", params={"limit": 50, "offset": offset})
+        else:
+            response = session.get(f"{self.base_url}/api/images/{random.choice(self.image_ids)}")
+        response.content
+        return response.status_code
+
+def run_level(scenario, concurrency, total, server_pid):
+    """
+    Send total requests from concurrency closed-loop clients
+
+    Returns:
+        dict: Throughput, latency percentiles, status counts and peak RSS
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                status = str(scenario.request(i))
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    with RssSampler(server_pid) as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(client)
+        wall = time.perf_counter() - started
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    to_ms = lambda seconds: round(seconds * 1000, 1) if seconds is not None else None
+    return {
+        "requests": len(latencies),
+        "ok": ok,
+        "statuses": statuses,
+        "seconds": round(wall, 3),
+        "throughput": round(ok / wall, 2) if wall else None,
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p95_ms": to_ms(percentile(latencies, 95)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+        "peak_rss_mb": round(sampler.peak / 1e6, 1),
+        "max_worker_hwm_mb": round(sampler.max_hwm() / 1e6, 1)
+    }
+
+def start_fake(args, port):
+    command = [sys.executable, str(ROOT / "benchmarks" / "fake_gemini.py"), "--port", str(port),
+               "--latency-ms", str(args.latency_ms), "--latency-dist", args.latency_dist,
+               "--rate-limit-rate", str(args.rate_limit_rate), "--no-image-rate", str(args.no_image_rate),
+               "--quota-per-key", str(args.quota_per_key), "--image-size", args.image_size]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+def start_server(args, server, port, fake_port, storage_dir, log):
+    env = dict(os.environ)
+    env.update({
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{fake_port}/generateContent",
+        "STORAGE_DIR": str(storage_dir),
+        # Let the fake upstream, not the client-side budgets, decide when keys are limited
+        "GEMINI_KEY_RPM": str(args.key_rpm),
+        "GEMINI_KEY_RPD": str(args.key_rpm * 1440),
+        "METRICS_DIR": str(Path(storage_dir) / "metrics"),
+    })
+    for i in range(1, args.keys + 1):
+        env[f"GEMINI_API_KEY_{i:02d}"] = f"fake-key-{i:02d}"
+    if server == "uvicorn":
+        command = [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1",
+                   "--port", str(port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "app:app", "--worker-class", "gthread",
+                   "--workers", str(args.workers), "--threads", str(args.threads),
+                   "--bind", f"127.0.0.1:{port}", "--timeout", "300"]
+    return subprocess.Popen(command, cwd=str(ROOT), env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=str(ROOT),
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result):
+    return (result.get("server", "gunicorn"), result["scenario"], result["images"], result["concurrency"])
+
+def compare(results, baseline_path, tolerance):
+    """
+    Print changes against a baseline run
+
+    Returns:
+        int: Number of metrics that got worse by more than tolerance
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+        changes = []
+        for metric, higher_is_worse in COMPARED_METRICS.items():
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if higher_is_worse else change < -tolerance
+            regressions += worse
+            changes.append(f"{metric} {change:+.0%}{' REGRESSION' if worse else ''}")
+        print(f"  {result['server']:<10}{result['scenario']:<10}{result['images']:>8} images  c={result['concurrency']:<4}"
+              + ", ".join(changes))
+    return regressions
+
+def print_result(result):
+    errors = {status: count for status, count in result["statuses"].items() if not status.startswith("2")}
+    print(f"  {result['server']:<10}{result['scenario']:<10}{result['images']:>8}{result['concurrency']:>6}"
+          f"{result['throughput']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}"
+          f"{result['peak_rss_mb']:>10}  {errors or ''}", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of "
+                        + ", ".join(SCENARIOS))
+    parser.add_argument("--images", default="1000", help="Comma-separated storage sizes, e.g. 1000,100000,500000")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated client counts")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency level")
+    parser.add_argument("--storage-dir", default=str(Path(tempfile.gettempdir()) / "fashion-ai-bench"),
+                        help="Seeded storage, reused between runs")
+    parser.add_argument("--server", default="gunicorn", help="Comma-separated subset of " + ", ".join(SERVERS))
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per gunicorn worker")
+    parser.add_argument("--keys", type=int, default=3, help="Fake API keys given to the service")
+    parser.add_argument("--key-rpm", type=float, default=100000, help="GEMINI_KEY_RPM for the service")
+    parser.add_argument("--latency-ms", type=float, default=500, help="Median fake upstream latency")
+    parser.add_argument("--latency-dist", default="lognormal")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--no-image-rate", type=float, default=0.0)
+    parser.add_argument("--quota-per-key", type=int, default=0)
+    parser.add_argument("--image-size", default="1024x1024", help="Size of the fake upstream's PNG")
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="Earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    servers = [name for name in args.server.split(",") if name]
+    if set(servers) - set(SERVERS):
+        parser.error(f"unknown servers: {', '.join(sorted(set(servers) - set(SERVERS)))}")
+    sizes = sorted(int(n) for n in args.images.split(","))
+    levels = [int(n) for n in args.concurrency.split(",")]
+    storage_dir = Path(args.storage_dir)
+    storage_dir.mkdir(parents=True, exist_ok=True)
+    edit_image = edit_payload() if "edit" in scenarios else None
+
+    results = []
+    fake_port = free_port()
+    fake = start_fake(args, fake_port)
+    try:
+        wait_for(f"http://127.0.0.1:{fake_port}/stats")
+        print(f"  {'server':<10}{'scenario':<10}{'images':>8}{'conc':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+              f"{'p99 ms':>10}{'RSS MB':>10}  errors")
+        for size in sizes:
+            seed_storage(storage_dir, size)
+            image_ids = catalog_ids(storage_dir, limit=10000)
+            for server_name in servers:
+                port = free_port()
+                with open(storage_dir / "server.log", "ab") as log:
+                    server = start_server(args, server_name, port, fake_port, storage_dir, log)
+                    try:
+                        base_url = f"http://127.0.0.1:{port}"
+                        wait_for(f"{base_url}/api/health")
+                        for name in scenarios:
+                            scenario = Scenario(name, base_url, image_ids, size, edit_image)
+                            for concurrency in levels:
+                                result = {"server": server_name, "scenario": name, "images": size,
+                                          "concurrency": concurrency}
+                                result.update(run_level(scenario, concurrency, args.requests, server.pid))
+                                results.append(result)
+                                print_result(result)
+                    finally:
+                        server.terminate()
+                        server.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"revision": git_revision(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "options": vars(args), "results": results}, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare peak memory of parsing a generateContent response in one piece
+versus streaming it through InlineDataExtractor.
+
+    python benchmarks/bench_response_parsing.py --size-mb 4
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gemini_client import RESPONSE_CHUNK_SIZE, parse_response, parse_response_stream
+
+def response_chunks(image, chunk_size=RESPONSE_CHUNK_SIZE):
+    """Yield a response body carrying image, as the network would, without building it"""
+    prefix = json.dumps({
+        "candidates": [{
+            "content": {"parts": [{"text": "Here is the edited image."}, {"inlineData": {
+                "mimeType": "image/png", "data": "DATA"
+            }}], "role": "model"},
+            "finishReason": "STOP"
+        }],
+        "usageMetadata": {"promptTokenCount": 12, "totalTokenCount": 1290}
+    }, indent=2).encode()
+    head, tail = prefix.split(b"DATA")
+    yield head
+    # Encode in slices that are a multiple of 3 bytes so the pieces concatenate cleanly
+    step = chunk_size // 4 * 3
+    for start in range(0, len(image), step):
+        yield base64.b64encode(image[start:start + step])
+    yield tail
+
+def parse_whole(image):
+    """The previous approach: read the body, json-decode it, then decode the image"""
+    body = b"".join(response_chunks(image))  # response.content
+    response_data = json.loads(body)  # response.json()
+    result = parse_response(response_data)
+    return result.image_bytes, body, response_data
+
+def parse_streaming(image):
+    return parse_response_stream(response_chunks(image)).image_bytes
+
+def measure(fn, image):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn(image)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    decoded = result[0] if isinstance(result, tuple) else result
+    assert decoded == image
+    return peak, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=4, help="Decoded image size")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    image = os.urandom(int(args.size_mb * 1024 * 1024))
+    print(f"Image: {len(image) / 1e6:.1f} MB decoded, {len(image) * 4 / 3 / 1e6:.1f} MB as base64")
+    print(f"{'parser':<12}{'peak MB':>10}{'x image':>10}{'seconds':>10}")
+    for name, fn in (("whole", parse_whole), ("streaming", parse_streaming)):
+        runs = [measure(fn, image) for _ in range(args.repeat)]
+        peak = min(peak for peak, _ in runs)
+        elapsed = min(seconds for _, seconds in runs)
+        print(f"{name:<12}{peak / 1e6:>10.1f}{peak / len(image):>10.2f}{elapsed:>10.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Local stand-in for the Gemini generateContent endpoint, for load tests that
+must not spend real quota.
+
+    python benchmarks/fake_gemini.py --port 8099 --latency-ms 800 --rate-limit-rate 0.05
+    GEMINI_BASE_URL=http://127.0.0.1:8099/generateContent gunicorn app:app ...
+
+GET /stats returns the number of responses sent by kind.
+"""
+import os
+import json
+import math
+import time
+import random
+import base64
+import argparse
+import threading
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image
+
+# Bytes written to the socket at a time, so large payloads go out as a stream
+WRITE_CHUNK_SIZE = 64 * 1024
+
+def make_png(width, height):
+    """Build a PNG of random noise, which barely compresses, like a generated photo"""
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+def sample_latency(options):
+    """Draw one response delay in seconds from the configured distribution"""
+    median = options.latency_ms / 1000
+    if median <= 0:
+        return 0.0
+    if options.latency_dist == "fixed":
+        return median
+    if options.latency_dist == "exponential":
+        return random.expovariate(math.log(2) / median)
+    return random.lognormvariate(math.log(median), options.latency_sigma)
+
+def error_body(code, message, status, details=()):
+    return {"error": {"code": code, "message": message, "status": status, "details": list(details)}}
+
+class FakeGemini:
+    def __init__(self, options):
+        """
+        Initialize the fake endpoint
+
+        Args:
+            options: Parsed command-line options (see build_parser)
+        """
+        self.options = options
+        width, height = (int(n) for n in options.image_size.lower().split("x"))
+        self.image_data = base64.b64encode(make_png(width, height)).decode()
+        self.lock = threading.Lock()
+        self.successes_per_key = {}
+        self.counters = {"requests": 0, "ok": 0, "rate_limited": 0, "quota_exhausted": 0,
+                         "no_image": 0, "unavailable": 0}
+
+    def respond(self, api_key):
+        """
+        Decide the outcome of one request
+
+        Returns:
+            tuple: (HTTP status, response dict)
+        """
+        options = self.options
+        roll = random.random()
+        with self.lock:
+            self.counters["requests"] += 1
+            if options.quota_per_key and self.successes_per_key.get(api_key, 0) >= options.quota_per_key:
+                kind = "quota_exhausted"
+            elif roll < options.rate_limit_rate:
+                kind = "rate_limited"
+            elif roll < options.rate_limit_rate + options.unavailable_rate:
+                kind = "unavailable"
+            elif roll < options.rate_limit_rate + options.unavailable_rate + options.no_image_rate:
+                kind = "no_image"
+            else:
+                kind = "ok"
+                self.successes_per_key[api_key] = self.successes_per_key.get(api_key, 0) + 1
+            self.counters[kind] += 1
+
+        if kind == "rate_limited":
+            return 429, error_body(429, "Resource has been exhausted (e.g. check quota).", "RESOURCE_EXHAUSTED", [{
+                "@type": "type.googleapis.com/google.rpc.RetryInfo",
+                "retryDelay": f"{options.retry_delay:g}s"
+            }])
+        if kind == "quota_exhausted":
+            return 429, error_body(429, "You exceeded your current quota.", "RESOURCE_EXHAUSTED", [{
+                "@type": "type.googleapis.com/google.rpc.QuotaFailure",
+                "violations": [{"quotaId": "GenerateRequestsPerDayPerProjectPerModel-FreeTier"}]
+            }])
+        if kind == "unavailable":
+            return 503, error_body(503, "The model is overloaded. Please try again later.", "UNAVAILABLE")
+        if kind == "no_image":
+            return 200, {"candidates": [{
+                "content": {"parts": [{"text": "I can't create that image."}], "role": "model"},
+                "finishReason": "STOP"
+            }]}
+        return 200, {"candidates": [{
+            "content": {"parts": [
+                {"text": "Here is the image."},
+                {"inlineData": {"mimeType": "image/png", "data": self.image_data}}
+            ], "role": "model"},
+            "finishReason": "STOP"
+        }]}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so the service's pooled connections are exercised as in production
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self.send_json(200, self.fake.stats())
+        else:
+            self.send_json(404, error_body(404, "Not found", "NOT_FOUND"))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        time.sleep(sample_latency(self.fake.options))
+        status, body = self.fake.respond(self.headers.get("x-goog-api-key", ""))
+        self.send_json(status, body)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        for start in range(0, len(data), WRITE_CHUNK_SIZE):
+            self.wfile.write(data[start:start + WRITE_CHUNK_SIZE])
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open hundreds of connections at once
+    request_queue_size = 1024
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=500, help="Median response delay")
+    parser.add_argument("--latency-dist", choices=("lognormal", "exponential", "fixed"), default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the lognormal distribution")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a 429 carrying a RetryInfo delay")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="retryDelay sent with rate limits")
+    parser.add_argument("--quota-per-key", type=int, default=0,
+                        help="Successful responses per API key before it gets daily-quota 429s (0 = unlimited)")
+    parser.add_argument("--unavailable-rate", type=float, default=0.0, help="Fraction of 503 responses")
+    parser.add_argument("--no-image-rate", type=float, default=0.0,
+                        help="Fraction of 200 responses with text but no image")
+    parser.add_argument("--image-size", default="1024x1024", help="Size of the returned PNG, WIDTHxHEIGHT")
+    return parser
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    Handler.fake = FakeGemini(options)
+    server = Server((options.host, options.port), Handler)
+    size_mb = len(Handler.fake.image_data) / 1e6
+    print(f"Fake Gemini listening on http://{options.host}:{options.port}/generateContent "
+          f"({size_mb:.1f} MB base64 image per response)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+import os
+import json
+import base64
+import sqlite3
+import itertools
+import threading
+import time
+from pathlib import Path
+
+# Seconds between checks of the shared journal for entries written by other instances
+CATALOG_SYNC_INTERVAL = float(os.environ.get('CATALOG_SYNC_INTERVAL', 5))
+
+# Seconds between journal compactions; only the instance that finds the snapshot
+# older than this compacts, so a fleet writes about one snapshot per interval
+CATALOG_COMPACT_INTERVAL = float(os.environ.get('CATALOG_COMPACT_INTERVAL', 3600))
+
+# Longest a listing waits for a new instance's first journal sync before
+# returning what has been applied so far
+CATALOG_BACKFILL_WAIT = float(os.environ.get('CATALOG_BACKFILL_WAIT', 30))
+
+# Journal entries fetched before each write transaction during a sync
+SYNC_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    sort_ts REAL NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_sort ON images (sort_ts DESC, id DESC);
+
+CREATE TABLE IF NOT EXISTS image_tags (
+    tag TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    sort_ts REAL NOT NULL,
+    PRIMARY KEY (tag, image_id)
+);
+CREATE INDEX IF NOT EXISTS idx_image_tags_sort ON image_tags (tag, sort_ts DESC, image_id DESC);
+
+CREATE TABLE IF NOT EXISTS catalog_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def encode_cursor(sort_ts, image_id):
+    """Encode the position of the last returned row as an opaque cursor string"""
+    raw = json.dumps([sort_ts, image_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor, raising ValueError if malformed"""
+    try:
+        sort_ts, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(sort_ts), str(image_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _extract_tags(metadata):
+    """Return the set of tags an image should be findable by"""
+    tags = metadata.get('tags')
+    if isinstance(tags, str):
+        return {tags}
+    if isinstance(tags, (list, tuple)):
+        return {str(tag) for tag in tags if tag is not None}
+    return set()
+
+class Catalog:
+    def __init__(self, db_path, metadata_dir, journal=None, sync_interval=CATALOG_SYNC_INTERVAL,
+                 compact_interval=CATALOG_COMPACT_INTERVAL, backfill_wait=CATALOG_BACKFILL_WAIT):
+        """
+        Initialize the catalog
+
+        The first backfill, journal syncs and compactions run on a background
+        thread started by start(), so saves never wait on them. Until the
+        first backfill has committed, listings are served by scanning the
+        metadata files, as before there was a catalog; with a journal they
+        wait up to backfill_wait seconds for the first sync instead.
+
+        Args:
+            db_path: Path of the SQLite database file
+            metadata_dir: Directory holding the JSON metadata files, used for backfills
+            journal: Optional CatalogJournal shared with other instances; when set,
+                changes are appended to it and the catalog is kept in sync from it
+                instead of being backfilled from metadata_dir
+            sync_interval: Seconds between journal syncs
+            compact_interval: Seconds between journal compactions
+            backfill_wait: Longest a listing waits for the first journal sync
+        """
+        self.db_path = Path(db_path)
+        self.metadata_dir = Path(metadata_dir)
+        self.journal = journal
+        self.sync_interval = sync_interval
+        self.local = threading.local()  # One connection per thread
+        self.backfill_lock = threading.Lock()
+        self.backfilled = False
+        self.backfill_wait = backfill_wait
+        self.first_backfill = threading.Event()  # Set once the first backfill attempt is over
+        self.sync_lock = threading.Lock()
+        self.synced_at = 0.0
+        self.compact_interval = compact_interval
+        self.thread = None
+        self.thread_pid = None
+        self.thread_lock = threading.Lock()
+
+    def _connect(self):
+        """Get this thread's connection, creating the schema on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def _ensure_backfilled(self):
+        """Backfill from the JSON files on disk the first time an empty catalog is used"""
+        if self.backfilled:
+            return
+        with self.backfill_lock:
+            if self.backfilled:
+                return
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value FROM catalog_state WHERE key = 'backfilled_at'"
+            ).fetchone()
+            if row is None:
+                self.rebuild()
+            self.backfilled = True
+
+    def _is_backfilled(self):
+        """Whether a backfill has committed, here or in another process sharing the database"""
+        if self.backfilled:
+            return True
+        row = self._connect().execute(
+            "SELECT value FROM catalog_state WHERE key = 'backfilled_at'"
+        ).fetchone()
+        return row is not None
+
+    def start(self):
+        """Start this process's background backfill and sync thread, if not running yet"""
+        pid = os.getpid()
+        if self.thread is not None and self.thread_pid == pid:
+            return
+        with self.thread_lock:
+            if self.thread is not None and self.thread_pid == pid:
+                return
+            self.thread = threading.Thread(target=self._run, name="catalog-sync", daemon=True)
+            self.thread_pid = pid
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._ensure_backfilled()
+                break
+            except Exception as e:
+                print(f"Error backfilling catalog: {e}")
+                time.sleep(self.sync_interval)
+            finally:
+                self.first_backfill.set()
+        if self.journal is None:
+            return
+        compacted_at = time.monotonic()
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync(force=True)
+                if time.monotonic() - compacted_at >= self.compact_interval:
+                    compacted_at = time.monotonic()
+                    self.compact()
+            except Exception as e:
+                print(f"Error syncing catalog journal: {e}")
+
+    def _upsert(self, conn, metadata, sort_ts):
+        image_id = metadata['id']
+        conn.execute(
+            "INSERT OR REPLACE INTO images (id, sort_ts, metadata) VALUES (?, ?, ?)",
+            (image_id, sort_ts, json.dumps(metadata))
+        )
+        conn.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+        conn.executemany(
+            "INSERT INTO image_tags (tag, image_id, sort_ts) VALUES (?, ?, ?)",
+            [(tag, image_id, sort_ts) for tag in _extract_tags(metadata)]
+        )
+
+    def index_image(self, metadata, sort_ts=None):
+        """
+        Add or replace the catalog entry for an image
+
+        Args:
+            metadata: The image's full metadata dict (must contain 'id')
+            sort_ts: Listing sort key, normally the metadata file's mtime
+        """
+        if not metadata or not metadata.get('id'):
+            return
+        if sort_ts is None:
+            sort_ts = time.time()
+        # The backfill runs in the background; it picks up this image's
+        # metadata file if it scans after the file was written
+        self.start()
+        conn = self._connect()
+        with conn:
+            self._upsert(conn, metadata, sort_ts)
+        if self.journal is not None:
+            self.journal.append(metadata['id'], metadata, sort_ts)
+
+    def remove_image(self, image_id):
+        """Drop an image from the catalog"""
+        conn = self._connect()
+        with conn:
+            self._delete(conn, image_id)
+        if self.journal is not None:
+            self.journal.append(image_id, None, None)
+
+    def _delete(self, conn, image_id):
+        conn.execute("DELETE FROM images WHERE id = ?", (image_id,))
+        conn.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+
+    def sync(self, force=False):
+        """
+        Apply journal entries written since the last sync
+
+        Does nothing without a journal, or if the last sync was less than
+        sync_interval seconds ago unless force is set.
+
+        Returns:
+            int: Number of entries applied
+        """
+        if self.journal is None:
+            return 0
+        if not force and time.monotonic() - self.synced_at < self.sync_interval:
+            return 0
+        if not self.sync_lock.acquire(blocking=force):
+            # Another thread is already syncing
+            return 0
+        try:
+            conn = self._connect()
+            started = time.time()
+            position, synced_at = self._journal_state(conn)
+            applied = 0
+            if self.journal.is_stale(synced_at):
+                # Entries not applied yet may be compacted away; start over from the snapshot
+                position, entries = self.journal.read_snapshot()
+                with conn:
+                    conn.execute("DELETE FROM images")
+                    conn.execute("DELETE FROM image_tags")
+                    self._apply(conn, entries)
+                    self._set_journal_state(conn, position)
+                applied += len(entries)
+
+            # Entries are fetched from the backend before each transaction, so
+            # the database is never locked while waiting on the network
+            pending = self.journal.entries(position)
+            while True:
+                batch = list(itertools.islice(pending, SYNC_BATCH_SIZE))
+                if not batch:
+                    break
+                position = max([position or batch[0][0]] + [key for key, _ in batch])
+                with conn:
+                    self._apply(conn, [entry for _, entry in batch])
+                    self._set_journal_state(conn, position)
+                applied += len(batch)
+            with conn:
+                self._set_journal_state(conn, position, synced_at=started)
+            self.synced_at = time.monotonic()
+            return applied
+        finally:
+            self.sync_lock.release()
+
+    def _journal_state(self, conn):
+        """
+        Returns:
+            tuple: (key of the last applied journal entry, wall-clock start of
+                the last complete sync), each None if unknown
+        """
+        rows = dict(conn.execute(
+            "SELECT key, value FROM catalog_state WHERE key IN ('journal_position', 'journal_synced_at')"
+        ).fetchall())
+        synced_at = rows.get('journal_synced_at')
+        return rows.get('journal_position'), float(synced_at) if synced_at else None
+
+    def _set_journal_state(self, conn, position, synced_at=None):
+        if position:
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_state (key, value) VALUES ('journal_position', ?)",
+                (position,)
+            )
+        else:
+            conn.execute("DELETE FROM catalog_state WHERE key = 'journal_position'")
+        if synced_at is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_state (key, value) VALUES ('journal_synced_at', ?)",
+                (str(synced_at),)
+            )
+
+    def _apply(self, conn, entries):
+        for entry in entries:
+            if entry.get('metadata'):
+                self._upsert(conn, entry['metadata'], entry.get('sortTs') or time.time())
+            else:
+                self._delete(conn, entry['id'])
+
+    def compact(self, force=False):
+        """
+        Fold the journal into a snapshot of this catalog and delete old entries
+
+        Skipped unless force is set or the shared snapshot is older than
+        compact_interval, so only one instance per interval does the work.
+
+        Returns:
+            int: Number of journal entries deleted
+        """
+        if self.journal is None:
+            return 0
+        age = self.journal.snapshot_age()
+        if not force and age is not None and age < self.compact_interval:
+            return 0
+        self.sync(force=True)
+        conn = self._connect()
+        with self.sync_lock:
+            # No sync may run in between, so the rows match the position
+            position, _ = self._journal_state(conn)
+            rows = conn.execute("SELECT id, sort_ts, metadata FROM images").fetchall()
+        if not position:
+            return 0
+        entries = [
+            {"id": image_id, "metadata": json.loads(metadata), "sortTs": sort_ts}
+            for image_id, sort_ts, metadata in rows
+        ]
+        deleted = self.journal.compact(position, entries)
+        print(f"Compacted catalog journal: snapshot of {len(entries)} images, {deleted} entries deleted")
+        return deleted
+
+    def query(self, limit=50, offset=0, tag=None, cursor=None):
+        """
+        Fetch one page of image metadata, newest first
+
+        Args:
+            limit: Maximum number of entries to return
+            offset: Number of entries to skip (ignored when a cursor is given)
+            tag: Optional tag to filter by
+            cursor: Optional cursor returned by a previous query
+
+        Returns:
+            tuple: (list of metadata dicts, cursor for the next page or None)
+        """
+        self.start()
+        if self.journal is not None:
+            self.first_backfill.wait(self.backfill_wait)
+        elif not self._is_backfilled():
+            return self._scan(limit, offset, tag, cursor)
+        conn = self._connect()
+
+        if tag:
+            sql = ("SELECT i.sort_ts, i.id, i.metadata FROM image_tags t "
+                   "JOIN images i ON i.id = t.image_id WHERE t.tag = ?")
+            sort_cols = "t.sort_ts DESC, t.image_id DESC"
+            position = "(t.sort_ts, t.image_id) < (?, ?)"
+            params = [tag]
+        else:
+            sql = "SELECT sort_ts, id, metadata FROM images WHERE 1 = 1"
+            sort_cols = "sort_ts DESC, id DESC"
+            position = "(sort_ts, id) < (?, ?)"
+            params = []
+
+        if cursor:
+            sql += f" AND {position}"
+            params.extend(decode_cursor(cursor))
+            offset = 0
+
+        sql += f" ORDER BY {sort_cols} LIMIT ? OFFSET ?"
+        params.extend([limit, max(offset, 0)])
+
+        rows = conn.execute(sql, params).fetchall()
+        items = [json.loads(metadata) for _, _, metadata in rows]
+
+        next_cursor = None
+        if len(rows) == limit and rows:
+            last_ts, last_id, _ = rows[-1]
+            next_cursor = encode_cursor(last_ts, last_id)
+        return items, next_cursor
+
+    def _scan(self, limit, offset, tag, cursor):
+        """
+        Fetch one page like query, from the metadata files on disk
+
+        Used until the first backfill has committed. Every call reads all
+        metadata files, which is what listings cost before the catalog.
+        """
+        entries = []
+        for metadata_file in self.metadata_dir.rglob("*.json"):
+            try:
+                with open(metadata_file, "r") as f:
+                    metadata = json.load(f)
+                sort_ts = metadata_file.stat().st_mtime
+            except Exception:
+                continue
+            image_id = metadata.get('id')
+            if image_id and (not tag or tag in _extract_tags(metadata)):
+                entries.append((sort_ts, str(image_id), metadata))
+        entries.sort(key=lambda entry: entry[:2], reverse=True)
+
+        if cursor:
+            position = decode_cursor(cursor)
+            entries = [entry for entry in entries if entry[:2] < position]
+            offset = 0
+        offset = max(offset, 0)
+        page = entries[offset:offset + limit]
+
+        next_cursor = None
+        if len(page) == limit and page:
+            next_cursor = encode_cursor(*page[-1][:2])
+        return [metadata for _, _, metadata in page], next_cursor
+
+    def rebuild(self, batch_size=1000):
+        """
+        Rebuild the catalog from the JSON metadata files on disk, or from
+        the journal's snapshot and later entries when there is a journal
+
+        Returns:
+            int: Number of images indexed
+        """
+        conn = self._connect()
+        if self.journal is not None:
+            with conn:
+                # Without a sync time, sync starts over from the snapshot
+                conn.execute(
+                    "DELETE FROM catalog_state WHERE key IN ('journal_position', 'journal_synced_at')"
+                )
+            self.sync(force=True)
+            indexed = conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO catalog_state (key, value) VALUES ('backfilled_at', ?)",
+                    (str(time.time()),)
+                )
+            print(f"Catalog rebuilt with {indexed} images from the journal")
+            return indexed
+
+        indexed = 0
+        batch = []
+
+        with conn:
+            conn.execute("DELETE FROM images")
+            conn.execute("DELETE FROM image_tags")
+
+            # Metadata lives in hash-sharded subdirectories, or flat before migration
+            for metadata_file in self.metadata_dir.rglob("*.json"):
+                try:
+                    with open(metadata_file, "r") as f:
+                        metadata = json.load(f)
+                    if not metadata.get('id'):
+                        continue
+                    batch.append((metadata, metadata_file.stat().st_mtime))
+                except Exception as e:
+                    print(f"Skipping unreadable metadata file {metadata_file}: {e}")
+                    continue
+
+                if len(batch) >= batch_size:
+                    for metadata, sort_ts in batch:
+                        self._upsert(conn, metadata, sort_ts)
+                    indexed += len(batch)
+                    batch = []
+
+            for metadata, sort_ts in batch:
+                self._upsert(conn, metadata, sort_ts)
+            indexed += len(batch)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_state (key, value) VALUES ('backfilled_at', ?)",
+                (str(time.time()),)
+            )
+
+        print(f"Catalog rebuilt with {indexed} images")
+        return indexed
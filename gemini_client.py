@@ -0,0 +1,629 @@
+import os
+import re
+import json
+import asyncio
+import time
+import base64
+import hashlib
+import binascii
+import logging
+import threading
+from collections import deque
+from io import BytesIO
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL = "gemini-2.0-flash-exp"
+# Point GEMINI_BASE_URL at benchmarks/fake_gemini.py to exercise the service without spending quota
+BASE_URL = os.environ.get(
+    'GEMINI_BASE_URL',
+    f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
+)
+
+# Connection settings, overridable from the environment
+CONNECT_TIMEOUT = float(os.environ.get('GEMINI_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.environ.get('GEMINI_READ_TIMEOUT', 120))
+POOL_SIZE = int(os.environ.get('GEMINI_POOL_SIZE', 10))
+# Async client (ASGI mode) only: a cap on connections, of which HTTP/2 needs only a
+# few since it multiplexes calls, and an overall limit on one call including the download
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('GEMINI_ASYNC_MAX_CONNECTIONS', 256))
+# httpx scans its whole pool for every request, so the connections are split over
+# this many clients to keep the scans short when hundreds of calls are in flight
+ASYNC_POOLS = int(os.environ.get('GEMINI_ASYNC_POOLS', 8))
+CALL_TIMEOUT = float(os.environ.get('GEMINI_CALL_TIMEOUT', 150))
+
+# Number of recent call latencies kept for percentile reporting
+LATENCY_WINDOW = 500
+
+# Bytes read from the response stream at a time
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_GENERATION_CONFIG = {
+    "temperature": 1,
+    "topP": 0.95,
+    "topK": 40,
+    "maxOutputTokens": 8192,
+    "responseModalities": ["image", "text"]
+}
+
+DEFAULT_SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_CIVIC_INTEGRITY",
+        "threshold": "BLOCK_NONE"
+    }
+]
+
+class GeminiAPIError(Exception):
+    """Raised when the Gemini API answers with a non-200 status"""
+
+    def __init__(self, message, status_code, status=None, details=None, headers=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.status = status  # e.g. RESOURCE_EXHAUSTED
+        self.details = details or []
+        self.headers = headers or {}
+
+class MalformedResponseError(ValueError):
+    """Raised when a 200 response body cannot be parsed, e.g. because it was truncated"""
+
+class GeminiResult:
+    """Text and image extracted from a generateContent response"""
+
+    def __init__(self, text=None, image_bytes=None, mime_type=None):
+        self.text = text
+        self.image_bytes = image_bytes  # Decoded image, or None
+        self.mime_type = mime_type
+        self.finish_reason = None  # e.g. STOP or SAFETY
+        self.block_reason = None  # Set when the prompt itself was blocked
+
+    @property
+    def image_data(self):
+        """The image base64-encoded, or None; encoded on each access"""
+        if self.image_bytes is None:
+            return None
+        return base64.b64encode(self.image_bytes).decode('ascii')
+
+def build_request_body(prompt, image_data=None, mime_type="image/jpeg", generation_config=None):
+    """
+    Build a generateContent request body
+
+    Args:
+        prompt: The text prompt
+        image_data: Optional base64-encoded input image
+        mime_type: MIME type of the input image
+        generation_config: Optional overrides for DEFAULT_GENERATION_CONFIG
+
+    Returns:
+        dict: The JSON request body
+    """
+    parts = []
+    if image_data:
+        parts.append({
+            "inlineData": {
+                "mimeType": mime_type,
+                "data": image_data
+            }
+        })
+    parts.append({"text": prompt})
+
+    return {
+        "contents": [
+            {
+                "role": "user",
+                "parts": parts
+            }
+        ],
+        "generationConfig": {**DEFAULT_GENERATION_CONFIG, **(generation_config or {})},
+        "safetySettings": DEFAULT_SAFETY_SETTINGS
+    }
+
+def request_fingerprint(prompt, image_bytes=None, generation_config=None, model=GEMINI_MODEL):
+    """
+    Hash everything that determines a generateContent result
+
+    Args:
+        prompt: The text prompt
+        image_bytes: Optional raw (decoded) input image
+        generation_config: Optional overrides for DEFAULT_GENERATION_CONFIG
+        model: The model name
+
+    Returns:
+        str: Hex SHA-256 digest identifying the request
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "model": model,
+        "prompt": prompt,
+        "generationConfig": {**DEFAULT_GENERATION_CONFIG, **(generation_config or {})}
+    }, sort_keys=True).encode('utf-8'))
+    if image_bytes:
+        digest.update(b"\0")
+        digest.update(image_bytes)
+    return digest.hexdigest()
+
+def parse_response(response_data, inline_data=()):
+    """
+    Extract the text and first image from a generateContent response
+
+    Args:
+        response_data: The decoded JSON response
+        inline_data: Images already decoded by InlineDataExtractor; their
+            inlineData.data values are placeholders indexing this list
+
+    Returns:
+        GeminiResult: The text and image found (either may be None)
+    """
+    result = GeminiResult()
+    result.block_reason = response_data.get('promptFeedback', {}).get('blockReason')
+
+    candidates = response_data.get('candidates') or []
+    if not candidates:
+        return result
+
+    result.finish_reason = candidates[0].get('finishReason')
+    parts = candidates[0].get('content', {}).get('parts', [])
+    for part in parts:
+        if 'text' in part:
+            result.text = part['text']
+        elif 'inlineData' in part and result.image_bytes is None:
+            inline = part['inlineData']
+            mime_type = inline.get('mimeType', '')
+            if 'data' in inline and mime_type.startswith('image/'):
+                image_bytes = _inline_bytes(inline['data'], inline_data)
+                # An empty image is no image; leave it to the no-image handling
+                if image_bytes:
+                    result.image_bytes = image_bytes
+                    result.mime_type = mime_type
+
+    return result
+
+def _inline_bytes(value, inline_data):
+    match = _PLACEHOLDER.fullmatch(value) if inline_data else None
+    if match:
+        return inline_data[int(match.group(1))]
+    return base64.b64decode(value)
+
+# Stands in for an inlineData.data string the extractor decoded out of band
+_PLACEHOLDER = re.compile(r"\x00inline:(\d+)")
+
+class InlineDataExtractor:
+    """
+    Incrementally parse a generateContent response body
+
+    inlineData.data strings (the base64 image) are decoded into a buffer as
+    they arrive and replaced by a short placeholder. Only the remaining
+    skeleton, which is a few KB, is parsed with json. The encoded image is
+    therefore never held in memory as a whole.
+    """
+
+    _STRING_SPECIAL = re.compile(rb'["\\]')
+    _KEY_LIMIT = 16  # Longer strings cannot be keys we look for
+
+    def __init__(self):
+        self.skeleton = []
+        self.images = []
+        self.parents = []  # Key that opened each enclosing object or array
+        self.in_string = False
+        self.diverting = False  # Inside an inlineData.data value being decoded
+        self.escaped = False
+        self.string_start = bytearray()
+        self.last_string = None
+        self.current_key = None
+        self.pending = b""  # Base64 characters not yet forming a 4-byte group
+        self.buffer = None
+
+    def feed(self, chunk):
+        """Consume the next chunk of the response body"""
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self.escaped:
+                self._escape(chunk[i:i + 1])
+                i += 1
+            elif self.diverting or self.in_string:
+                match = self._STRING_SPECIAL.search(chunk, i)
+                end = match.start() if match else n
+                if end > i:
+                    self._string_bytes(chunk[i:end])
+                i = end
+                if match is None:
+                    break
+                if chunk[end] == 0x5C:  # Backslash
+                    self.escaped = True
+                else:
+                    self._end_string()
+                i += 1
+            else:
+                self._structure(chunk[i:i + 1])
+                i += 1
+
+    def _structure(self, char):
+        """Handle a byte outside strings; there are only a few KB of these"""
+        if char == b'"':
+            if self.current_key == b"data" and self.parents and self.parents[-1] == b"inlineData":
+                self.diverting = True
+                self.buffer = BytesIO()
+                return
+            self.in_string = True
+            self.string_start = bytearray()
+        elif char == b":":
+            self.current_key = self.last_string
+        elif char in b"{[":
+            self.parents.append(self.current_key)
+            self.current_key = None
+        elif char in b"}]":
+            if self.parents:
+                self.parents.pop()
+            self.current_key = None
+        elif char == b",":
+            self.current_key = None
+        self.skeleton.append(char)
+
+    def _string_bytes(self, data):
+        if self.diverting:
+            self._decode(data)
+            return
+        self.skeleton.append(data)
+        if len(self.string_start) <= self._KEY_LIMIT:
+            self.string_start += data[:self._KEY_LIMIT + 1]
+
+    def _escape(self, char):
+        self.escaped = False
+        if self.diverting:
+            # Some encoders escape "/" and may wrap base64 lines
+            if char == b"/":
+                self._decode(char)
+            elif char not in (b"n", b"r"):
+                raise ValueError("Unexpected escape in inlineData")
+            return
+        self.skeleton.append(b"\\" + char)
+        self.string_start += b"\\"
+
+    def _end_string(self):
+        if self.diverting:
+            self._decode(b"", final=True)
+            self.skeleton.append(f'"\\u0000inline:{len(self.images)}"'.encode('ascii'))
+            self.images.append(self.buffer.getvalue())
+            self.buffer = None
+            self.diverting = False
+        else:
+            self.skeleton.append(b'"')
+            key = bytes(self.string_start)
+            self.last_string = key if len(key) <= self._KEY_LIMIT else None
+            self.in_string = False
+
+    def _decode(self, data, final=False):
+        data = self.pending + data
+        usable = len(data) if final else len(data) - len(data) % 4
+        try:
+            if final and usable % 4:
+                data += b"=" * (4 - usable % 4)
+                usable = len(data)
+            self.buffer.write(binascii.a2b_base64(data[:usable]))
+        except binascii.Error as e:
+            raise ValueError(f"Malformed inlineData in response: {e}")
+        self.pending = data[usable:]
+
+    def result(self):
+        """Parse the skeleton once the whole body has been fed"""
+        if self.in_string or self.diverting:
+            raise ValueError("Response body ended inside a string")
+        response_data = json.loads(b"".join(self.skeleton))
+        return parse_response(response_data, self.images)
+
+def parse_response_stream(chunks):
+    """
+    Parse a generateContent response from an iterable of byte chunks
+
+    Returns:
+        GeminiResult: The text and first image found (either may be None)
+    """
+    extractor = InlineDataExtractor()
+    for chunk in chunks:
+        extractor.feed(chunk)
+    return extractor.result()
+
+def _parse_body(chunks):
+    """parse_response_stream, raising MalformedResponseError for a body that is not a valid response"""
+    try:
+        return parse_response_stream(chunks)
+    except (ValueError, AttributeError) as e:
+        raise MalformedResponseError(f"Malformed response from API: {e}") from e
+
+def _until(chunks, deadline):
+    """Pass chunks through, raising requests.Timeout once the monotonic deadline has passed"""
+    for chunk in chunks:
+        if time.monotonic() > deadline:
+            raise requests.Timeout("Gemini call ran past the request deadline")
+        yield chunk
+
+def parse_error(response):
+    """Build a GeminiAPIError from a non-200 response"""
+    message = f"API Error: {response.status_code}"
+    status = None
+    details = []
+    try:
+        error = response.json().get('error', {})
+        message = error.get('message', message)
+        status = error.get('status')
+        details = error.get('details', [])
+    except Exception:
+        pass
+    return GeminiAPIError(message, response.status_code, status, details, dict(response.headers))
+
+class GeminiClient:
+    def __init__(self, base_url=BASE_URL, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, pool_size=POOL_SIZE):
+        """
+        Initialize the client
+
+        Args:
+            base_url: The generateContent endpoint URL
+            connect_timeout: Seconds to wait for a TCP/TLS connection
+            read_timeout: Seconds to wait between bytes of the response
+            pool_size: Keep-alive connections kept per host
+        """
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.session = None
+        self.session_pid = None
+
+        # Per-call timing, used to measure the effect of connection reuse
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.call_stats = {"calls": 0, "errors": 0, "total_seconds": 0.0}
+
+    def _get_session(self):
+        """Get this process's pooled session, creating a new one after a fork"""
+        pid = os.getpid()
+        if self.session is None or self.session_pid != pid:
+            with self.lock:
+                if self.session is None or self.session_pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self.session = session
+                    self.session_pid = pid
+        return self.session
+
+    def _record_call(self, seconds, failed):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.call_stats["calls"] += 1
+            self.call_stats["total_seconds"] += seconds
+            if failed:
+                self.call_stats["errors"] += 1
+
+    def generate_content(self, api_key, request_body, timeout=None):
+        """
+        Call generateContent and parse the result
+
+        Args:
+            api_key: The Gemini API key to use
+            request_body: Body built with build_request_body
+            timeout: Optional seconds the whole call may take, e.g. what is
+                left of the request's deadline; caps the connect and read timeouts
+
+        Returns:
+            GeminiResult: The parsed response
+
+        Raises:
+            GeminiAPIError: If the API answers with a non-200 status
+            MalformedResponseError: If the response body cannot be parsed
+            requests.RequestException: On connection errors or timeouts
+        """
+        session = self._get_session()
+        started = time.monotonic()
+        connect_timeout, read_timeout = self.timeout
+        if timeout is not None:
+            connect_timeout, read_timeout = min(connect_timeout, timeout), min(read_timeout, timeout)
+        failed = True
+        try:
+            # Send the key as a header so it never appears in URLs or exception messages
+            response = session.post(
+                self.base_url,
+                json=request_body,
+                headers={"x-goog-api-key": api_key},
+                timeout=(connect_timeout, read_timeout),
+                stream=True
+            )
+            with response:
+                if response.status_code != 200:
+                    raise parse_error(response)
+
+                # Decode the image while it downloads instead of parsing the whole body
+                chunks = response.iter_content(RESPONSE_CHUNK_SIZE)
+                if timeout is not None:
+                    chunks = _until(chunks, started + timeout)
+                result = _parse_body(chunks)
+            failed = False
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            self._record_call(elapsed, failed)
+            logger.info(f"Gemini call finished in {elapsed:.2f}s (failed={failed})")
+
+    def latency_percentile(self, percentile, min_samples=1):
+        """Return the given percentile (0-100) of recent call latencies in seconds, or None"""
+        with self.lock:
+            samples = sorted(self.latencies)
+        if not samples or len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def _connections_opened(self):
+        """Count the TCP connections the session's pools have opened so far"""
+        if self.session is None:
+            return 0
+        opened = 0
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    opened += pool.num_connections
+        return opened
+
+    def stats(self):
+        """Return call counts, latency percentiles and connection reuse figures"""
+        with self.lock:
+            stats = dict(self.call_stats)
+        calls = stats["calls"]
+        opened = self._connections_opened()
+        stats["avg_seconds"] = stats["total_seconds"] / calls if calls else None
+        stats["p50_seconds"] = self.latency_percentile(50)
+        stats["p95_seconds"] = self.latency_percentile(95)
+        stats["connections_opened"] = opened
+        stats["connection_reuse_rate"] = 1 - opened / calls if calls else None
+        return stats
+
+class AsyncGeminiClient(GeminiClient):
+    def __init__(self, base_url=BASE_URL, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_connections=ASYNC_MAX_CONNECTIONS,
+                 pools=ASYNC_POOLS, call_timeout=CALL_TIMEOUT):
+        """
+        Initialize a non-blocking client for the ASGI app
+
+        Calls are spread over a few pooled httpx clients per event loop, and
+        go over HTTP/2 where the server supports it. Latency figures are kept
+        like GeminiClient's, so admission control can use them.
+
+        Args:
+            base_url: The generateContent endpoint URL
+            connect_timeout: Seconds to wait for a TCP/TLS connection
+            read_timeout: Seconds to wait between bytes of the response
+            max_connections: Connections kept open to the API, over all pools
+            pools: httpx clients the connections are split between
+            call_timeout: Seconds after which a whole call is abandoned
+
+        Raises:
+            ValueError: If httpx or its HTTP/2 support is not installed
+        """
+        try:
+            import h2  # noqa: F401 (httpx needs it for http2=True)
+            import httpx
+        except ImportError:
+            raise ValueError("The ASGI app needs httpx with HTTP/2 support (pip install 'httpx[http2]')")
+
+        super().__init__(base_url, connect_timeout, read_timeout, max_connections)
+        self.httpx = httpx
+        self.pools = max(1, pools)
+        self.call_timeout = call_timeout
+        self.clients = []
+        self.clients_loop = None
+        self.next_client = 0
+        self.call_stats["http2_calls"] = 0
+
+    def _get_client(self):
+        """Get the next of the running event loop's clients, creating them on first use"""
+        loop = asyncio.get_running_loop()
+        if self.clients_loop is not loop:
+            connect_timeout, read_timeout = self.timeout
+            per_pool = max(1, self.pool_size // self.pools)
+            self.clients = [
+                self.httpx.AsyncClient(
+                    http2=True,
+                    timeout=self.httpx.Timeout(read_timeout, connect=connect_timeout),
+                    limits=self.httpx.Limits(max_connections=per_pool, max_keepalive_connections=per_pool)
+                )
+                for _ in range(self.pools)
+            ]
+            self.clients_loop = loop
+        # Only the event loop's thread gets here, so no lock is needed
+        self.next_client = (self.next_client + 1) % len(self.clients)
+        return self.clients[self.next_client]
+
+    async def aclose(self):
+        """Close the clients' connections"""
+        clients, self.clients, self.clients_loop = self.clients, [], None
+        for client in clients:
+            await client.aclose()
+
+    async def _post(self, api_key, request_body):
+        client = self._get_client()
+        # Send the key as a header so it never appears in URLs or exception messages
+        async with client.stream(
+            "POST", self.base_url, json=request_body, headers={"x-goog-api-key": api_key}
+        ) as response:
+            if response.http_version == "HTTP/2":
+                with self.lock:
+                    self.call_stats["http2_calls"] += 1
+            if response.status_code != 200:
+                await response.aread()
+                raise parse_error(response)
+
+            # Decode the image while it downloads instead of parsing the whole body
+            extractor = InlineDataExtractor()
+            try:
+                async for chunk in response.aiter_bytes(RESPONSE_CHUNK_SIZE):
+                    extractor.feed(chunk)
+                return extractor.result()
+            except (ValueError, AttributeError) as e:
+                raise MalformedResponseError(f"Malformed response from API: {e}") from e
+
+    async def generate_content(self, api_key, request_body, timeout=None):
+        """
+        Call generateContent and parse the result without blocking the event loop
+
+        Args:
+            api_key: The Gemini API key to use
+            request_body: Body built with build_request_body
+            timeout: Optional seconds the whole call may take, capped at call_timeout
+
+        Returns:
+            GeminiResult: The parsed response
+
+        Raises:
+            GeminiAPIError: If the API answers with a non-200 status
+            MalformedResponseError: If the response body cannot be parsed
+            requests.RequestException: On connection errors or timeouts, as
+                raised by GeminiClient, so RetryPolicy treats both clients alike
+        """
+        started = time.monotonic()
+        call_timeout = self.call_timeout if timeout is None else min(self.call_timeout, timeout)
+        failed = True
+        try:
+            result = await asyncio.wait_for(self._post(api_key, request_body), call_timeout)
+            failed = False
+            return result
+        except asyncio.TimeoutError as e:
+            raise requests.Timeout(f"Gemini call took longer than {call_timeout:g}s") from e
+        except self.httpx.TimeoutException as e:
+            raise requests.Timeout(str(e) or type(e).__name__) from e
+        except self.httpx.TransportError as e:
+            raise requests.ConnectionError(str(e) or type(e).__name__) from e
+        finally:
+            elapsed = time.monotonic() - started
+            self._record_call(elapsed, failed)
+            logger.info(f"Gemini call finished in {elapsed:.2f}s (failed={failed})")
+
+    def _connections_opened(self):
+        """Count the connections currently held by the clients' pools, or None if unknown"""
+        opened = 0
+        for client in self.clients:
+            # httpx has no public API for this; its default transport wraps an httpcore pool
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            if pool is None:
+                return None
+            opened += len(pool.connections)
+        return opened
+
+    def stats(self):
+        """Return call counts, latency percentiles and pooled connection figures"""
+        with self.lock:
+            stats = dict(self.call_stats)
+        calls = stats["calls"]
+        stats["avg_seconds"] = stats["total_seconds"] / calls if calls else None
+        stats["p50_seconds"] = self.latency_percentile(50)
+        stats["p95_seconds"] = self.latency_percentile(95)
+        stats["open_connections"] = self._connections_opened()
+        return stats
+
+# Shared per-process client used by all routes
+gemini_client = GeminiClient()
@@ -0,0 +1,185 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Hedging settings, overridable from the environment. Hedging is opt-in.
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 2))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+HEDGE_BUDGET_PERCENT = float(os.environ.get('HEDGE_BUDGET_PERCENT', 10))
+HEDGE_THREADS = int(os.environ.get('HEDGE_THREADS', 64))
+
+class Hedger:
+    def __init__(self, latency_percentile, enabled=HEDGE_ENABLED, percentile=HEDGE_PERCENTILE,
+                 min_delay=HEDGE_MIN_DELAY, min_samples=HEDGE_MIN_SAMPLES,
+                 budget_percent=HEDGE_BUDGET_PERCENT, max_threads=HEDGE_THREADS):
+        """
+        Initialize the hedger
+
+        Args:
+            latency_percentile: Callable(percentile, min_samples) returning recent
+                upstream latency in seconds, or None while there are too few samples
+            enabled: Whether hedge requests are sent at all
+            percentile: Latency percentile after which a hedge is sent
+            min_delay: Lower bound on the hedge delay in seconds
+            min_samples: Latency samples needed before hedging starts
+            budget_percent: Maximum hedges as a percentage of upstream calls
+            max_threads: Threads available for in-flight upstream calls
+        """
+        self.latency_percentile = latency_percentile
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.budget_percent = budget_percent
+        self.max_threads = max_threads
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None
+
+        self.counters = {
+            "calls": 0,
+            "hedges_sent": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "both_failed": 0,
+            "skipped_budget": 0,
+            "skipped_no_key": 0
+        }
+
+    def _get_executor(self):
+        """Get this process's executor, creating a new one after a fork"""
+        pid = os.getpid()
+        if self.executor is None or self.executor_pid != pid:
+            with self.lock:
+                if self.executor is None or self.executor_pid != pid:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.max_threads,
+                        thread_name_prefix="hedge"
+                    )
+                    self.executor_pid = pid
+        return self.executor
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def hedge_delay(self):
+        """Seconds to wait for the first attempt before hedging, or None if not hedging"""
+        if not self.enabled:
+            return None
+        latency = self.latency_percentile(self.percentile, self.min_samples)
+        if latency is None:
+            return None
+        return max(self.min_delay, latency)
+
+    def _reserve_hedge(self):
+        """Take a hedge out of the budget, or return False if it is used up"""
+        with self.lock:
+            allowed = self.counters["calls"] * self.budget_percent / 100
+            if self.counters["hedges_sent"] + 1 > allowed:
+                self.counters["skipped_budget"] += 1
+                return False
+            self.counters["hedges_sent"] += 1
+            return True
+
+    def call(self, send, api_key, pick_hedge_key, on_error):
+        """
+        Call send(api_key), racing it against a second key if it is slow
+
+        A hedge is only sent when the first call has not answered within
+        hedge_delay() of starting to run, the budget allows it and pick_hedge_key returns a key.
+        The first result carrying an image wins. The other call cannot be
+        aborted mid-request, so it finishes in the background and its result
+        is discarded.
+
+        Args:
+            send: Callable taking an API key and returning a GeminiResult
+            api_key: Key for the first call
+            pick_hedge_key: Callable returning a second key, or None if none is free
+            on_error: Callable(api_key, exception) for failures that are not raised
+
+        Returns:
+            tuple: (result, key that produced it, whether a hedge was sent)
+
+        Raises:
+            Exception: The first call's error when no call produced a result
+        """
+        delay = self.hedge_delay()
+        if delay is None:
+            return send(api_key), api_key, False
+
+        self._count("calls")
+        started = threading.Event()
+
+        def send_primary():
+            started.set()
+            return send(api_key)
+
+        primary = self._get_executor().submit(send_primary)
+        # Time spent queued for an executor thread says nothing about upstream
+        # latency, so the hedge delay only starts once the first call is running
+        started.wait()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._reserve_hedge():
+            return primary.result(), api_key, False
+
+        hedge_key = pick_hedge_key()
+        if hedge_key is None:
+            with self.lock:
+                # Give the reserved hedge back to the budget
+                self.counters["hedges_sent"] -= 1
+                self.counters["skipped_no_key"] += 1
+            return primary.result(), api_key, False
+
+        hedge = self._get_executor().submit(send, hedge_key)
+        keys = {primary: api_key, hedge: hedge_key}
+        errors = {}
+        fallback = None
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors[future] = e
+                    continue
+                if result.image_bytes is None:
+                    fallback = fallback or (result, keys[future])
+                    continue
+
+                self._count("hedge_wins" if future is hedge else "primary_wins")
+                for failed, error in errors.items():
+                    on_error(keys[failed], error)
+                for loser in pending:
+                    loser.add_done_callback(lambda f, key=keys[loser]: self._discard(f, key, on_error))
+                return result, keys[future], True
+
+        if fallback is not None:
+            for failed, error in errors.items():
+                on_error(keys[failed], error)
+            return fallback[0], fallback[1], True
+
+        self._count("both_failed")
+        on_error(hedge_key, errors[hedge])
+        raise errors[primary]
+
+    def _discard(self, future, api_key, on_error):
+        """Report the failure of a call whose result is no longer needed"""
+        error = future.exception()
+        if error is not None:
+            on_error(api_key, error)
+
+    def stats(self):
+        """Return hedge counts, the win rate and the current hedge delay"""
+        with self.lock:
+            stats = dict(self.counters)
+        hedges = stats["hedges_sent"]
+        stats["enabled"] = self.enabled
+        stats["budget_percent"] = self.budget_percent
+        stats["delay_seconds"] = self.hedge_delay()
+        stats["hedge_win_rate"] = stats["hedge_wins"] / hedges if hedges else None
+        stats["extra_call_rate"] = hedges / stats["calls"] if stats["calls"] else None
+        return stats
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Hot-image cache settings, overridable from the environment
+IMAGE_CACHE_ENABLED = os.environ.get('IMAGE_CACHE_ENABLED', 'true').lower() == 'true'
+IMAGE_CACHE_MB = int(os.environ.get('IMAGE_CACHE_MB', 64))
+# Upper bound on how stale an entry can get when another instance changes the image
+IMAGE_CACHE_TTL = int(os.environ.get('IMAGE_CACHE_TTL', 300))
+
+# Size at which the shared invalidation log is truncated
+INVALIDATION_LOG_BYTES = 1024 * 1024
+# Invalidated ids whose generation is remembered before the table is reset
+MAX_GENERATIONS = 10000
+
+def _entry_size(image_data, metadata):
+    """Approximate the memory held by a cached image"""
+    return len(image_data) + (len(json.dumps(metadata)) if metadata else 0) + 256
+
+class ImageCache:
+    def __init__(self, invalidation_log, enabled=IMAGE_CACHE_ENABLED,
+                 max_bytes=IMAGE_CACHE_MB * 1024 * 1024, ttl=IMAGE_CACHE_TTL):
+        """
+        Initialize the in-memory cache of base64 image payloads and parsed metadata
+
+        Each worker process has its own cache. Invalidations are appended to a
+        log file shared by the workers, which every worker checks (with one
+        stat call) before answering from its cache.
+
+        Args:
+            invalidation_log: Path of the shared invalidation log
+            enabled: Whether lookups and stores do anything
+            max_bytes: Size budget of the cache
+            ttl: Seconds an entry may be served before it is read again
+        """
+        self.invalidation_log = Path(invalidation_log)
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # image_id -> (image_data, metadata, size, stored_at)
+        self.used_bytes = 0
+        # Bumped by invalidations, so a read that raced one is not cached
+        self.generations = {}  # image_id -> number of invalidations seen
+        self.epoch = 0  # Bumped when generations is reset
+        self.log_offset = self._log_size()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "invalidations": 0
+        }
+
+    def _log_size(self):
+        try:
+            return self.invalidation_log.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _drop(self, image_id):
+        """Remove an entry; the caller holds the lock"""
+        entry = self.entries.pop(image_id, None)
+        if entry is not None:
+            self.used_bytes -= entry[2]
+        return entry is not None
+
+    def _bump(self, image_id):
+        """Advance an image's generation; the caller holds the lock"""
+        if len(self.generations) >= MAX_GENERATIONS:
+            self.generations.clear()
+            self.epoch += 1
+        self.generations[image_id] = self.generations.get(image_id, 0) + 1
+
+    def _apply_invalidations(self):
+        """Drop entries invalidated by other workers since the last check"""
+        size = self._log_size()
+        with self.lock:
+            if size == self.log_offset:
+                return
+            if size < self.log_offset:
+                # The log was truncated, so some invalidations may have been missed
+                self.entries.clear()
+                self.used_bytes = 0
+                self.generations.clear()
+                self.epoch += 1
+                self.log_offset = size
+                return
+            try:
+                with open(self.invalidation_log, "rb") as f:
+                    f.seek(self.log_offset)
+                    new_lines = f.read(size - self.log_offset)
+            except FileNotFoundError:
+                return
+            self.log_offset = size
+            for image_id in new_lines.decode("utf-8", "replace").split():
+                self._bump(image_id)
+                if self._drop(image_id):
+                    self.counters["invalidations"] += 1
+
+    def get(self, image_id):
+        """
+        Look up a cached image
+
+        Returns:
+            tuple: (base64 image data, metadata) or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        self._apply_invalidations()
+        with self.lock:
+            entry = self.entries.get(image_id)
+            if entry is not None and time.monotonic() - entry[3] < self.ttl:
+                self.entries.move_to_end(image_id)
+                self.counters["hits"] += 1
+                image_data, metadata = entry[0], entry[1]
+                return image_data, dict(metadata) if metadata else metadata
+            if entry is not None:
+                self._drop(image_id)
+            self.counters["misses"] += 1
+        return None
+
+    def generation(self, image_id):
+        """
+        Token to take before reading an image from storage and pass to put()
+
+        Returns:
+            tuple: Changes whenever the image is invalidated, here or by another worker
+        """
+        if not self.enabled:
+            return None
+
+        self._apply_invalidations()
+        with self.lock:
+            return self.epoch, self.generations.get(image_id, 0)
+
+    def put(self, image_id, image_data, metadata, generation=None):
+        """
+        Cache an image, evicting least recently used ones to stay within budget
+
+        Args:
+            image_id: The image ID
+            image_data: Base64 image payload
+            metadata: Parsed metadata, or None
+            generation: Token from generation() taken before the image was read;
+                the image is not cached if it was invalidated since
+        """
+        if not self.enabled:
+            return
+
+        size = _entry_size(image_data, metadata)
+        if size > self.max_bytes:
+            return
+        if generation is not None:
+            self._apply_invalidations()
+        with self.lock:
+            if generation is not None and generation != (self.epoch, self.generations.get(image_id, 0)):
+                return
+            self._drop(image_id)
+            self.entries[image_id] = (image_data, metadata, size, time.monotonic())
+            self.used_bytes += size
+            self.counters["stores"] += 1
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.used_bytes -= evicted[2]
+                self.counters["evictions"] += 1
+
+    def invalidate(self, image_id):
+        """Drop an image from this worker's cache and tell the other workers to do the same"""
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self._bump(image_id)
+            if self._drop(image_id):
+                self.counters["invalidations"] += 1
+        try:
+            # Appends this small are atomic, so concurrent workers never interleave lines
+            with open(self.invalidation_log, "a") as f:
+                f.write(f"{image_id}\n")
+                if f.tell() > INVALIDATION_LOG_BYTES:
+                    f.truncate(0)
+        except OSError as e:
+            print(f"Error recording cache invalidation for image {image_id}: {e}")
+
+    def stats(self):
+        """Return hit/miss counters, the hit rate and memory usage"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["enabled"] = self.enabled
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.used_bytes
+            stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+        return stats
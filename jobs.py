@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Background execution limits, overridable from the environment
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 32))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 3600))
+
+# Unfinished jobs record their owner and a heartbeat; a job whose owner process is
+# gone, or whose heartbeat is older than JOB_STALE_SECONDS, is reported as failed
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 10))
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', 60))
+
+# Job states; succeeded and failed are terminal
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATES = (SUCCEEDED, FAILED)
+
+class JobQueueFull(Exception):
+    """Raised when the background queue already holds JOB_QUEUE_SIZE jobs"""
+
+class JobManager:
+    def __init__(self, jobs_dir, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE,
+                 ttl=JOB_TTL_SECONDS, heartbeat_interval=JOB_HEARTBEAT_INTERVAL,
+                 stale_after=JOB_STALE_SECONDS):
+        """
+        Initialize the job manager
+
+        Args:
+            jobs_dir: Directory where job records are persisted so that any
+                worker process can report on them
+            max_workers: Number of jobs run concurrently
+            max_pending: Maximum number of queued plus running jobs
+            ttl: Seconds a finished job is kept before being pruned
+            heartbeat_interval: Seconds between heartbeats of unfinished jobs
+            stale_after: Seconds without a heartbeat after which another
+                process reports an unfinished job as failed
+        """
+        self.jobs_dir = Path(jobs_dir)
+        self.jobs_dir.mkdir(exist_ok=True)
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.host = socket.gethostname()
+        self.jobs = {}
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.persist_lock = threading.Lock()  # Serializes job file writes; taken before condition
+        self.executor = None
+        self.executor_pid = None
+
+    def _get_executor(self):
+        """Get this process's executor and heartbeat thread, creating them after a fork"""
+        pid = os.getpid()
+        if self.executor is None or self.executor_pid != pid:
+            with self.condition:
+                if self.executor is None or self.executor_pid != pid:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix="job"
+                    )
+                    threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+                    self.executor_pid = pid
+        return self.executor
+
+    def _heartbeat(self):
+        """Periodically mark this process's unfinished jobs as alive"""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.condition:
+                now = time.time()
+                job_ids = []
+                for job in self.jobs.values():
+                    if job["status"] not in TERMINAL_STATES:
+                        # Not a status change, so the version stays and no event is sent
+                        job["heartbeatAt"] = now
+                        job_ids.append(job["id"])
+            for job_id in job_ids:
+                self._persist_current(job_id)
+
+    def _is_orphaned(self, job):
+        """Whether an unfinished job read from disk has lost the process running it"""
+        if job["status"] in TERMINAL_STATES:
+            return False
+        if time.time() - job.get("heartbeatAt", job["updatedAt"]) > self.stale_after:
+            return True
+        if job.get("ownerHost") != self.host or not job.get("ownerPid"):
+            return False
+        try:
+            os.kill(job["ownerPid"], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def _job_path(self, job_id):
+        return self.jobs_dir / f"{job_id}.json"
+
+    def _persist(self, job):
+        """Write a job record atomically so other workers never read a partial file"""
+        job_path = self._job_path(job["id"])
+        temp_path = job_path.with_name(f".{job_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(job, f)
+            os.replace(temp_path, job_path)
+        except Exception as e:
+            print(f"Error persisting job {job['id']}: {e}")
+
+    def _persist_current(self, job_id):
+        """
+        Persist a job's state as of now
+
+        Writes are serialized and each one snapshots the job only once it
+        holds the lock, so an older state (e.g. a heartbeat of a job that
+        has since finished) can never be the last one written.
+        """
+        with self.persist_lock:
+            with self.condition:
+                job = self.jobs.get(job_id)
+                snapshot = dict(job) if job is not None else None
+            if snapshot is not None:
+                self._persist(snapshot)
+
+    def _update(self, job_id, **changes):
+        """Apply changes to a job, persist it and wake up anyone waiting on it"""
+        with self.condition:
+            job = self.jobs[job_id]
+            job.update(changes)
+            job["updatedAt"] = time.time()
+            job["version"] += 1
+            self.condition.notify_all()
+        self._persist_current(job_id)
+
+    def _prune(self):
+        """Forget finished jobs older than the TTL (called with the condition held)"""
+        cutoff = time.time() - self.ttl
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job["status"] in TERMINAL_STATES and job["updatedAt"] < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+            try:
+                self._job_path(job_id).unlink()
+            except FileNotFoundError:
+                pass
+
+    def submit(self, job_type, fn, *args):
+        """
+        Queue a job for background execution
+
+        Args:
+            job_type: Label stored with the job (e.g. 'generate' or 'edit')
+            fn: Callable returning (result dict, HTTP status code)
+            *args: Arguments passed to fn
+
+        Returns:
+            dict: A snapshot of the new job record
+
+        Raises:
+            JobQueueFull: If max_pending jobs are already queued or running
+        """
+        with self.condition:
+            self._prune()
+            if self.pending >= self.max_pending:
+                raise JobQueueFull("Too many jobs in progress, try again later")
+            self.pending += 1
+
+            now = time.time()
+            job = {
+                "id": uuid.uuid4().hex,
+                "type": job_type,
+                "status": QUEUED,
+                "ownerHost": self.host,
+                "ownerPid": os.getpid(),
+                "createdAt": now,
+                "updatedAt": now,
+                "heartbeatAt": now,
+                "version": 0,
+                "result": None,
+                "error": None
+            }
+            self.jobs[job["id"]] = job
+            snapshot = dict(job)
+
+        self._persist_current(job["id"])
+        try:
+            self._get_executor().submit(self._run, job["id"], fn, args)
+        except Exception:
+            with self.condition:
+                self.pending -= 1
+            raise
+        return snapshot
+
+    def _run(self, job_id, fn, args):
+        self._update(job_id, status=RUNNING)
+        try:
+            result, status_code = fn(*args)
+            if status_code < 400:
+                self._update(job_id, status=SUCCEEDED, result=result)
+            else:
+                self._update(
+                    job_id,
+                    status=FAILED,
+                    result=result,
+                    error=result.get("error", f"Job failed with status {status_code}")
+                )
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            self._update(job_id, status=FAILED, error=str(e))
+        finally:
+            with self.condition:
+                self.pending -= 1
+
+    def get(self, job_id):
+        """
+        Get a snapshot of a job, including jobs started by other worker processes
+
+        Returns:
+            dict: The job record, or None if unknown
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+
+        # Job IDs are 32-character hex strings; reject anything else before touching the filesystem
+        if len(job_id) != 32 or not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._job_path(job_id), "r") as f:
+                job = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if self._is_orphaned(job):
+            now = time.time()
+            job.update(
+                status=FAILED,
+                error="The worker running this job stopped",
+                updatedAt=now,
+                version=job["version"] + 1
+            )
+            self._persist(job)
+        return job
+
+    def wait_for_update(self, job_id, version, timeout):
+        """
+        Block until a job's version moves past the given one or the timeout expires
+
+        Returns:
+            dict: The latest job snapshot, or None if the job is unknown
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if job_id in self.jobs:
+                job = self.jobs[job_id]
+                while job["version"] <= version:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                return dict(job)
+
+        # Owned by another worker process; poll its persisted record
+        while True:
+            job = self.get(job_id)
+            if job is None or job["version"] > version or time.monotonic() >= deadline:
+                return job
+            time.sleep(0.5)
+
+    def stats(self):
+        """Return counts of in-progress and known jobs in this process"""
+        with self.condition:
+            return {
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "workers": self.max_workers,
+                "tracked": len(self.jobs)
+            }
@@ -1,73 +1,477 @@
+import os
+import sys
 import time
-import random
+import heapq
+import hashlib
+import sqlite3
+import itertools
 import threading
-from collections import defaultdict
+from metrics import metrics
+
+# Per-key request budgets, overridable from the environment
+KEY_RPM = float(os.environ.get('GEMINI_KEY_RPM', 10))
+KEY_RPD = float(os.environ.get('GEMINI_KEY_RPD', 1500))
+
+# Where key state lives: 'memory' (per process), 'sqlite' (shared by all workers),
+# or 'auto' to share whenever the app runs under gunicorn or with WEB_CONCURRENCY > 1
+KEY_STATE_BACKEND = os.environ.get('KEY_STATE_BACKEND', 'auto').lower()
+
+# Cooldown after a rate-limit error doubles with each consecutive error, up to the max
+BASE_COOLDOWN_SECONDS = 15
+MAX_COOLDOWN_SECONDS = 300
+
+class NoKeysAvailable(ValueError):
+    """Raised when no API keys are configured at all"""
+
+class TokenBucket:
+    def __init__(self, capacity, per_second, now):
+        """A bucket holding up to capacity tokens, refilled continuously at per_second"""
+        self.capacity = capacity
+        self.per_second = per_second
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_second)
+            self.updated = now
+
+    def consume(self, now, amount=1):
+        self.refill(now)
+        self.tokens = max(0.0, self.tokens - amount)
+
+    def drain(self, now):
+        self.refill(now)
+        self.tokens = 0.0
+
+    def seconds_until(self, now, amount=1):
+        """Seconds until the bucket holds at least amount tokens"""
+        self.refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.per_second
+
+    def projected(self):
+        """
+        Tokens the bucket would hold at time zero, ignoring the capacity
+
+        All buckets refill at the same rate, so ordering keys by this value
+        orders them by current tokens without refilling each one.
+        """
+        return self.tokens - self.updated * self.per_second
+
+class KeyState:
+    def __init__(self, rpm, rpd, now):
+        self.minute = TokenBucket(rpm, rpm / 60.0, now)
+        self.day = TokenBucket(rpd, rpd / 86400.0, now)
+        self.errors = 0
+        self.cooldown_until = 0.0
+        self.last_used = 0.0
+        self.version = 0  # Bumped whenever the key is re-queued; older heap entries are stale
+
+    def ready_at(self, now):
+        """Earliest time the key has budget in both buckets and is out of cooldown"""
+        wait = max(self.minute.seconds_until(now), self.day.seconds_until(now))
+        return max(now + wait, self.cooldown_until)
+
+    def use(self, now):
+        """Spend one request from both buckets"""
+        self.minute.consume(now)
+        self.day.consume(now)
+        self.last_used = now
+
+    def rate_limited(self, now, retry_after=None):
+        """Drain the minute bucket and start a cooldown"""
+        self.errors += 1
+        self.minute.drain(now)
+        if retry_after is None:
+            retry_after = min(MAX_COOLDOWN_SECONDS, BASE_COOLDOWN_SECONDS * 2 ** (self.errors - 1))
+        self.cooldown_until = max(self.cooldown_until, now + retry_after)
+
+    def succeeded(self):
+        # Gradually reduce error count for successful calls
+        if self.errors > 0:
+            self.errors = max(0, self.errors - 0.5)
+
+    def describe(self, key, now):
+        """Summarize the key's budget for stats output, masking the key"""
+        self.minute.refill(now)
+        self.day.refill(now)
+        return {
+            "key": f"...{key[-4:]}",
+            "minute_tokens": round(self.minute.tokens, 2),
+            "day_tokens": round(self.day.tokens, 2),
+            "errors": self.errors,
+            "cooldown_seconds": round(max(0.0, self.cooldown_until - now), 1),
+            "last_used": self.last_used
+        }
 
 class KeyManager:
-    def __init__(self, keys=None):
-        """Initialize the key manager with a list of API keys"""
-        self.keys = keys or []
-        self.key_status = {}  # Store status of each key
-        self.rate_limit_data = defaultdict(lambda: {"errors": 0, "last_error": 0})
+    def __init__(self, keys=None, rpm=KEY_RPM, rpd=KEY_RPD):
+        """
+        Initialize the key manager with a list of API keys
+
+        Args:
+            keys: The API keys to schedule
+            rpm: Requests per minute allowed per key
+            rpd: Requests per day allowed per key
+        """
+        self.keys = []
+        self.rpm = rpm
+        self.rpd = rpd
+        self.states = {}
+        self.ready = []  # Heap of (-projected tokens, seq, key, version) for keys with budget
+        self.cooling = []  # Heap of (ready_at, seq, key, version) for keys without budget
+        self.sequence = itertools.count()
         self.lock = threading.Lock()  # For thread safety
-        
-        # Initialize all keys as available
-        for key in self.keys:
-            self.key_status[key] = {"available": True, "last_used": 0}
-    
+
+        self.add_keys(keys or [])
+
     def add_keys(self, keys):
         """Add one or more keys to the manager"""
         with self.lock:
+            now = time.time()
             for key in keys:
-                if key and key not in self.keys:
+                if key and key not in self.states:
                     self.keys.append(key)
-                    self.key_status[key] = {"available": True, "last_used": 0}
-    
-    def get_key(self):
-        """Get the best available API key"""
+                    self.states[key] = KeyState(self.rpm, self.rpd, now)
+                    self._enqueue(key, now)
+
+    def _enqueue(self, key, now):
+        """Push a key onto the ready or cooling heap, invalidating older entries"""
+        # Stale entries are dropped lazily; rebuild both heaps if too many pile up
+        if len(self.ready) + len(self.cooling) > 4 * len(self.keys) + 16:
+            self._rebuild_heaps(now)
+        state = self.states[key]
+        state.version += 1
+        ready_at = state.ready_at(now)
+        if ready_at <= now:
+            heapq.heappush(self.ready, (-state.minute.projected(), next(self.sequence), key, state.version))
+        else:
+            heapq.heappush(self.cooling, (ready_at, next(self.sequence), key, state.version))
+
+    def _rebuild_heaps(self, now):
+        self.ready = []
+        self.cooling = []
+        for key in self.keys:
+            self._enqueue(key, now)
+
+    def _is_current(self, key, version):
+        return self.states[key].version == version
+
+    def _release_cooled_down(self, now):
+        """Move keys whose cooldown has passed back onto the ready heap"""
+        while self.cooling and self.cooling[0][0] <= now:
+            _, _, key, version = heapq.heappop(self.cooling)
+            if self._is_current(key, version):
+                self._enqueue(key, now)
+
+    def _pop_valid(self, heap, exclude):
+        """
+        Pop the best current entry whose key is not excluded
+
+        Returns:
+            str: The key, or None if the heap has no such entry
+        """
+        skipped = []
+        selected = None
+        while heap:
+            entry = heapq.heappop(heap)
+            key, version = entry[2], entry[3]
+            if not self._is_current(key, version):
+                continue
+            if key in exclude:
+                skipped.append(entry)
+                continue
+            selected = key
+            break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return selected
+
+    def get_key(self, exclude=(), require_ready=False):
+        """
+        Get the key with the most remaining budget
+
+        Args:
+            exclude: Keys to avoid, e.g. ones that already failed for this request
+            require_ready: Return None instead of falling back to an excluded
+                or cooling key when no other key has budget right now
+
+        Returns:
+            str: The selected API key
+        """
         with self.lock:
             if not self.keys:
-                raise ValueError("No API keys available")
-            
-            # Filter out keys that had recent rate limit errors
-            current_time = time.time()
-            available_keys = [
-                key for key in self.keys 
-                if self.key_status.get(key, {}).get("available", True) and
-                (current_time - self.rate_limit_data[key]["last_error"] > 60 or 
-                 self.rate_limit_data[key]["errors"] < 3)
-            ]
-            
-            # If no keys are available, use any key (better than failing)
-            if not available_keys:
-                # Reset keys that have been in timeout for over 5 minutes
-                for key in self.keys:
-                    if (current_time - self.rate_limit_data[key]["last_error"] > 300):
-                        self.rate_limit_data[key]["errors"] = 0
-                        available_keys.append(key)
-                
-                # If still no keys, use any key
-                if not available_keys:
-                    available_keys = self.keys
-            
-            # Prefer keys with fewer errors
-            available_keys.sort(key=lambda k: self.rate_limit_data[k]["errors"])
-            
-            # Get the best key
-            selected_key = available_keys[0]
-            self.key_status[selected_key]["last_used"] = current_time
-            return selected_key
-    
-    def mark_rate_limited(self, key):
-        """Mark a key as having hit a rate limit"""
+                raise NoKeysAvailable("No API keys available")
+
+            now = time.time()
+            self._release_cooled_down(now)
+
+            selected_key = self._pop_valid(self.ready, exclude)
+            if selected_key is None and require_ready:
+                return None
+
+            # If no key has budget, use the one that recovers soonest (better than failing)
+            if selected_key is None:
+                selected_key = self._pop_valid(self.cooling, exclude)
+            if selected_key is None:
+                selected_key = self._pop_valid(self.ready, ()) or self._pop_valid(self.cooling, ())
+
+            self.states[selected_key].use(now)
+            self._enqueue(selected_key, now)
+        metrics.inc("key_selections_total", key=f"...{selected_key[-4:]}")
+        return selected_key
+
+    def mark_rate_limited(self, key, retry_after=None):
+        """
+        Mark a key as having hit a rate limit
+
+        Args:
+            key: The rate-limited key
+            retry_after: Optional server-provided delay in seconds before retrying
+        """
         with self.lock:
-            if key in self.keys:
-                self.rate_limit_data[key]["errors"] += 1
-                self.rate_limit_data[key]["last_error"] = time.time()
-    
+            state = self.states.get(key)
+            if state is None:
+                return
+            now = time.time()
+            state.rate_limited(now, retry_after)
+            self._enqueue(key, now)
+        metrics.inc("key_rate_limits_total", key=f"...{key[-4:]}")
+
     def reset_key(self, key):
         """Reset a key's status after successful use"""
         with self.lock:
-            if key in self.keys and self.rate_limit_data[key]["errors"] > 0:
-                # Gradually reduce error count for successful calls
-                self.rate_limit_data[key]["errors"] = max(0, self.rate_limit_data[key]["errors"] - 0.5)
\ No newline at end of file
+            state = self.states.get(key)
+            if state is not None:
+                state.succeeded()
+
+    def stats(self):
+        """Return the remaining budget and cooldown of every key (keys are masked)"""
+        with self.lock:
+            now = time.time()
+            return [self.states[key].describe(key, now) for key in self.keys]
+
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS key_state (
+    key_id TEXT PRIMARY KEY,
+    minute_tokens REAL NOT NULL,
+    minute_updated REAL NOT NULL,
+    day_tokens REAL NOT NULL,
+    day_updated REAL NOT NULL,
+    errors REAL NOT NULL,
+    cooldown_until REAL NOT NULL,
+    last_used REAL NOT NULL,
+    priority REAL NOT NULL,
+    ready_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_key_state_priority ON key_state (priority DESC);
+CREATE INDEX IF NOT EXISTS idx_key_state_ready_at ON key_state (ready_at);
+"""
+
+def _key_id(key):
+    """Identify a key in shared state without writing the key itself to disk"""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+class SharedKeyManager:
+    def __init__(self, keys=None, db_path="key_state.db", rpm=KEY_RPM, rpd=KEY_RPD):
+        """
+        Key manager whose budgets and cooldowns are shared by all worker processes
+
+        State lives in a SQLite database in WAL mode. Every selection and
+        update runs in an immediate transaction, so workers never race.
+
+        Args:
+            keys: The API keys to schedule
+            db_path: Path of the shared SQLite database
+            rpm: Requests per minute allowed per key
+            rpd: Requests per day allowed per key
+        """
+        self.keys = []
+        self.key_ids = {}  # key_id -> key
+        self.db_path = str(db_path)
+        self.rpm = rpm
+        self.rpd = rpd
+        self.local = threading.local()  # One connection per thread
+
+        self.add_keys(keys or [])
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SHARED_SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def _transaction(self):
+        """Start an immediate (write-locked) transaction and return the connection"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def _load(self, row):
+        """Rebuild a KeyState from a key_state row (without its key_id)"""
+        state = KeyState(self.rpm, self.rpd, 0)
+        (state.minute.tokens, state.minute.updated, state.day.tokens, state.day.updated,
+         state.errors, state.cooldown_until, state.last_used) = row[:7]
+        return state
+
+    def _save(self, conn, key_id, state, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO key_state (key_id, minute_tokens, minute_updated, "
+            "day_tokens, day_updated, errors, cooldown_until, last_used, priority, ready_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key_id, state.minute.tokens, state.minute.updated, state.day.tokens,
+             state.day.updated, state.errors, state.cooldown_until, state.last_used,
+             state.minute.projected(), state.ready_at(now))
+        )
+
+    def _fetch(self, conn, key_id):
+        return conn.execute(
+            "SELECT minute_tokens, minute_updated, day_tokens, day_updated, errors, "
+            "cooldown_until, last_used FROM key_state WHERE key_id = ?",
+            (key_id,)
+        ).fetchone()
+
+    def add_keys(self, keys):
+        """Add one or more keys to the manager"""
+        new_keys = [key for key in keys if key and key not in self.keys]
+        if not new_keys:
+            return
+        conn = self._transaction()
+        try:
+            now = time.time()
+            for key in new_keys:
+                key_id = _key_id(key)
+                self.keys.append(key)
+                self.key_ids[key_id] = key
+                # Keep state another worker already recorded for this key
+                if self._fetch(conn, key_id) is None:
+                    self._save(conn, key_id, KeyState(self.rpm, self.rpd, now), now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _select(self, conn, now, candidates, ready_only=False):
+        """Pick the best candidate key_id: most budget if any are ready, else soonest ready"""
+        if not candidates:
+            return None
+        placeholders = ",".join("?" * len(candidates))
+        row = conn.execute(
+            f"SELECT key_id FROM key_state WHERE key_id IN ({placeholders}) AND ready_at <= ? "
+            "ORDER BY priority DESC LIMIT 1",
+            (*candidates, now)
+        ).fetchone()
+        if row is None and not ready_only:
+            row = conn.execute(
+                f"SELECT key_id FROM key_state WHERE key_id IN ({placeholders}) "
+                "ORDER BY ready_at ASC LIMIT 1",
+                candidates
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_key(self, exclude=(), require_ready=False):
+        """
+        Get the key with the most remaining budget across all workers
+
+        Args:
+            exclude: Keys to avoid, e.g. ones that already failed for this request
+            require_ready: Return None instead of falling back to an excluded
+                or cooling key when no other key has budget right now
+
+        Returns:
+            str: The selected API key
+        """
+        if not self.keys:
+            raise NoKeysAvailable("No API keys available")
+
+        excluded_ids = {_key_id(key) for key in exclude}
+        allowed = [key_id for key_id in self.key_ids if key_id not in excluded_ids]
+
+        conn = self._transaction()
+        try:
+            now = time.time()
+            if require_ready:
+                key_id = self._select(conn, now, allowed, ready_only=True)
+                if key_id is None:
+                    conn.execute("ROLLBACK")
+                    return None
+            else:
+                key_id = self._select(conn, now, allowed) or self._select(conn, now, list(self.key_ids))
+            state = self._load(self._fetch(conn, key_id))
+            state.use(now)
+            self._save(conn, key_id, state, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        selected_key = self.key_ids[key_id]
+        metrics.inc("key_selections_total", key=f"...{selected_key[-4:]}")
+        return selected_key
+
+    def _modify(self, key, change):
+        """Apply change(state, now) to a key's shared state atomically"""
+        key_id = _key_id(key)
+        if key_id not in self.key_ids:
+            return
+        conn = self._transaction()
+        try:
+            now = time.time()
+            row = self._fetch(conn, key_id)
+            if row is not None:
+                state = self._load(row)
+                change(state, now)
+                self._save(conn, key_id, state, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def mark_rate_limited(self, key, retry_after=None):
+        """Mark a key as having hit a rate limit, for every worker"""
+        self._modify(key, lambda state, now: state.rate_limited(now, retry_after))
+        metrics.inc("key_rate_limits_total", key=f"...{key[-4:]}")
+
+    def reset_key(self, key):
+        """Reset a key's status after successful use"""
+        self._modify(key, lambda state, now: state.succeeded())
+
+    def stats(self):
+        """Return the remaining budget and cooldown of every key (keys are masked)"""
+        conn = self._connect()
+        now = time.time()
+        result = []
+        for key in self.keys:
+            row = self._fetch(conn, _key_id(key))
+            if row is not None:
+                result.append(self._load(row).describe(key, now))
+        return result
+
+def create_key_manager(keys, shared_db_path, backend=KEY_STATE_BACKEND):
+    """
+    Build the key manager for this deployment
+
+    Args:
+        keys: The API keys to schedule
+        shared_db_path: Database path used when state is shared between workers
+        backend: 'memory', 'sqlite' or 'auto' (shared under gunicorn or when
+            WEB_CONCURRENCY > 1)
+
+    Returns:
+        KeyManager or SharedKeyManager
+    """
+    if backend == 'auto':
+        workers = int(os.environ.get('WEB_CONCURRENCY', 1) or 1)
+        # The worker count can come from -w, GUNICORN_CMD_ARGS or a config file, so
+        # share state under any gunicorn; a single worker barely notices the difference
+        under_gunicorn = 'gunicorn.arbiter' in sys.modules
+        backend = 'sqlite' if workers > 1 or under_gunicorn else 'memory'
+
+    if backend == 'sqlite':
+        return SharedKeyManager(keys, db_path=shared_db_path)
+    return KeyManager(keys)
@@ -0,0 +1,101 @@
+"""
+Maintenance commands for the AI Photo Editor backend
+
+Usage:
+    python manage.py rebuild-catalog
+    python manage.py migrate-layout [--batch-size N] [--pause SECONDS]
+    python manage.py gc-blobs [--min-age SECONDS] [--dry-run]
+    python manage.py transcode-images
+    python manage.py prune-originals [--days N] [--dry-run]
+"""
+import argparse
+import storage
+
+def rebuild_catalog(args):
+    """Backfill the listing catalog from the metadata files on disk"""
+    count = storage.rebuild_catalog()
+    print(f"Indexed {count} images into {storage.catalog.db_path}")
+
+def migrate_layout(args):
+    """Move files from the flat storage layout to the sharded one"""
+    def report(counts):
+        print(f"Moved {counts['images']} images, {counts['metadata']} metadata files, "
+              f"{counts['thumbnails']} thumbnails")
+    storage.migrate_layout(batch_size=args.batch_size, pause=args.pause, progress=report)
+    print("Migration complete")
+
+def gc_blobs(args):
+    """Delete image blobs no longer referenced by any image"""
+    result = storage.gc_blobs(min_age=args.min_age, dry_run=args.dry_run)
+    action = "Would remove" if args.dry_run else "Removed"
+    print(f"{action} {result['removed']} of {result['blobs']} blobs "
+          f"({result['bytes_freed'] / 1024 / 1024:.1f} MB)")
+
+def transcode_images(args):
+    """Write WebP/AVIF renditions for images stored before transcoding was enabled"""
+    def report(counts):
+        print(f"Checked {counts['images']} images, transcoded {counts['transcoded']} "
+              f"({counts['bytes_saved'] / 1024 / 1024:.1f} MB saved)")
+    storage.transcode_images(progress=report)
+
+def prune_originals(args):
+    """Remove originals past the retention period that have a smaller rendition"""
+    result = storage.prune_originals(max_age_days=args.days, dry_run=args.dry_run)
+    action = "Would remove" if args.dry_run else "Removed"
+    print(f"{action} {result['removed']} of {result['originals']} originals "
+          f"({result['bytes'] / 1024 / 1024:.1f} MB, reclaimed by gc-blobs)")
+
+def main():
+    parser = argparse.ArgumentParser(description="AI Photo Editor maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = subparsers.add_parser(
+        "rebuild-catalog",
+        help="Rebuild the image listing catalog from storage/metadata"
+    )
+    rebuild_parser.set_defaults(func=rebuild_catalog)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate-layout",
+        help="Move images and metadata into hash-sharded subdirectories (safe while running)"
+    )
+    migrate_parser.add_argument("--batch-size", type=int, default=500,
+                                help="Files moved between pauses")
+    migrate_parser.add_argument("--pause", type=float, default=0.1,
+                                help="Seconds to sleep between batches")
+    migrate_parser.set_defaults(func=migrate_layout)
+
+    gc_parser = subparsers.add_parser(
+        "gc-blobs",
+        help="Delete deduplicated image blobs that no image refers to"
+    )
+    gc_parser.add_argument("--min-age", type=float, default=3600,
+                           help="Keep blobs younger than this many seconds")
+    gc_parser.add_argument("--dry-run", action="store_true",
+                           help="Only report what would be removed")
+    gc_parser.set_defaults(func=gc_blobs)
+
+    transcode_parser = subparsers.add_parser(
+        "transcode-images",
+        help="Write renditions in the STORAGE_TRANSCODE format for existing images"
+    )
+    transcode_parser.set_defaults(func=transcode_images)
+
+    prune_parser = subparsers.add_parser(
+        "prune-originals",
+        help="Remove originals that have a smaller rendition and are past the retention period"
+    )
+    prune_parser.add_argument("--days", type=float, default=storage.STORAGE_ORIGINAL_RETENTION_DAYS,
+                              help="Retention period (default: STORAGE_ORIGINAL_RETENTION_DAYS)")
+    prune_parser.add_argument("--dry-run", action="store_true",
+                              help="Only report what would be removed")
+    prune_parser.set_defaults(func=prune_originals)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
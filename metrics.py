@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import sys
+import uuid
+import atexit
+import socket
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; dead workers' snapshots are then kept as they are
+    fcntl = None
+
+# Metrics settings, overridable from the environment. Without METRICS_DIR a
+# single process keeps its counts in memory; multi-worker servers need the
+# directory so that every worker can merge the others' snapshots.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+# Histogram bucket upper bounds in seconds, from cache hits up to slow upstream calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# Every metric with its type and help text; all names get the 'fashion_ai_' prefix
+METRICS = {
+    "http_requests_total": ("counter", "HTTP requests by endpoint, method and status"),
+    "http_request_seconds": ("histogram", "HTTP request duration by endpoint"),
+    "stage_seconds": ("histogram", "Time spent in each stage of generate and edit requests"),
+    "upstream_attempts_total": ("counter", "Upstream Gemini attempts by route and outcome class"),
+    "key_selections_total": ("counter", "Times each API key was selected (keys are masked)"),
+    "key_rate_limits_total": ("counter", "Rate limits recorded per API key (keys are masked)"),
+    "storage_read_bytes_total": ("counter", "Bytes read from storage by kind"),
+    "storage_write_bytes_total": ("counter", "Bytes written to storage by kind"),
+    "storage_write_seconds": ("histogram", "Duration of storage writes by kind"),
+    "list_images_seconds": ("histogram", "Time to build one page of /api/images by variant"),
+}
+
+PREFIX = "fashion_ai_"
+
+# Snapshot that accumulates the counts of workers that have exited
+MERGED_FILE = "merged.json"
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def _multi_worker():
+    """Whether this process is likely one of several server workers"""
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1) or 1)
+    return workers > 1 or 'gunicorn.arbiter' in sys.modules
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _process_start(pid):
+    """Start time of a process in clock ticks since boot, or None without /proc"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+        # The command name may contain spaces and parentheses; starttime is the
+        # 20th field after it
+        return int(stat.rsplit(b")", 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Metrics:
+    def __init__(self, directory=METRICS_DIR, enabled=METRICS_ENABLED,
+                 flush_interval=METRICS_FLUSH_INTERVAL, buckets=LATENCY_BUCKETS):
+        """
+        Initialize the metrics registry
+
+        Each worker process counts in memory and writes a snapshot file to
+        directory every flush_interval seconds. Rendering merges the
+        snapshots of all workers. The snapshots of workers that have exited
+        are folded into one merged file, so counters never go backwards when
+        gunicorn replaces a worker and the number of files stays bounded.
+
+        Without a directory only this process's counts are reported, which
+        is only correct for a single process; under a multi-worker server
+        metrics are then disabled with a warning.
+
+        Args:
+            directory: Directory for per-process snapshot files, or None
+            enabled: Whether anything is recorded
+            flush_interval: Seconds between snapshot writes
+            buckets: Histogram bucket upper bounds
+        """
+        if directory is None and enabled and _multi_worker():
+            print("⚠️ Metrics disabled: set METRICS_DIR to a directory shared by all workers")
+            enabled = False
+        self.directory = Path(directory) if directory is not None else None
+        self.enabled = enabled
+        self.host = socket.gethostname()
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.pid = None
+        self.token = None  # Identifies this process's snapshots
+        self.started = None  # Process start time from _process_start
+        self.checked_token = None  # Token whose predecessor snapshot has been merged
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self.flushed_at = 0.0
+
+        if self.enabled and self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            atexit.register(self.flush)
+
+    def _check_pid(self):
+        """Discard values inherited through a fork; the caller holds the lock"""
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            self.token = uuid.uuid4().hex
+            self.started = _process_start(pid)
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter"""
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self.lock:
+            self._check_pid()
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, **labels):
+        """Record one value in a histogram"""
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self.lock:
+            self._check_pid()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+        self._maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of a with block in a histogram"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def _snapshot(self):
+        with self.lock:
+            self._check_pid()
+            return {
+                "host": self.host,
+                "token": self.token,
+                "started": self.started,
+                "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                "histograms": [
+                    [name, list(labels), list(counts), total, count]
+                    for (name, labels), (counts, total, count) in self.histograms.items()
+                ]
+            }
+
+    def _maybe_flush(self):
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write this process's snapshot file"""
+        if not self.enabled or self.directory is None:
+            return
+        self.flushed_at = time.monotonic()
+        try:
+            snapshot = self._snapshot()
+            if self.checked_token != snapshot["token"]:
+                # A file with this pid can only be an earlier process's; merge it
+                # before it is overwritten
+                with self._directory_lock() as locked:
+                    if locked:
+                        self._merge_dead([self.directory / f"{os.getpid()}.json"])
+                self.checked_token = snapshot["token"]
+            self._write(f"{os.getpid()}.json", snapshot)
+        except OSError as e:
+            print(f"Error writing metrics snapshot: {e}")
+
+    def _write(self, name, snapshot):
+        temp_path = self.directory / f".{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, self.directory / name)
+
+    def _read(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _fold(self, snapshot, counters, histograms):
+        """Add one snapshot's values to the counters and histograms dicts"""
+        for name, labels, value in snapshot.get("counters", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total, count in snapshot.get("histograms", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+
+    def _is_dead(self, pid, snapshot):
+        """
+        Whether a snapshot was written by a process on this host that has exited
+
+        A live pid is not enough: the pid may have been reused by another
+        process since, which the snapshot's start time or token gives away.
+        """
+        if snapshot.get("host", self.host) != self.host:
+            return False
+        if pid == os.getpid():
+            return snapshot.get("token") != self.token
+        if not _pid_alive(pid):
+            return True
+        started = snapshot.get("started")
+        return started is not None and _process_start(pid) not in (None, started)
+
+    def _merge_dead(self, paths):
+        """
+        Fold the snapshots of exited workers on this host into the merged file
+
+        The caller holds the directory lock. The merged file is written before
+        the dead snapshots are removed, so a crash in between can only count
+        them twice, never lose them.
+
+        Args:
+            paths: The per-process snapshot files
+
+        Returns:
+            list: The paths that are still in place
+        """
+        dead = []
+        for path in paths:
+            snapshot = self._read(path)
+            if snapshot is not None and self._is_dead(int(path.stem), snapshot):
+                dead.append((path, snapshot))
+        if not dead:
+            return paths
+
+        counters = {}
+        histograms = {}
+        merged = self._read(self.directory / MERGED_FILE)
+        if merged is not None:
+            self._fold(merged, counters, histograms)
+        for _, snapshot in dead:
+            self._fold(snapshot, counters, histograms)
+        self._write(MERGED_FILE, {
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [
+                [name, list(labels), counts, total, count]
+                for (name, labels), (counts, total, count) in histograms.items()
+            ]
+        })
+        removed = set()
+        for path, _ in dead:
+            try:
+                path.unlink()
+                removed.add(path)
+            except OSError:
+                pass
+        return [path for path in paths if path not in removed]
+
+    def _collect(self, counters, histograms):
+        """Fold every worker's snapshot, merging those of exited workers first"""
+        with self._directory_lock() as locked:
+            paths = sorted(path for path in self.directory.glob("*.json") if path.stem.isdigit())
+            if locked:
+                try:
+                    paths = self._merge_dead(paths)
+                except OSError as e:
+                    print(f"Error merging metrics snapshots: {e}")
+            for path in [self.directory / MERGED_FILE] + paths:
+                snapshot = self._read(path)
+                if snapshot is not None:
+                    self._fold(snapshot, counters, histograms)
+
+    @contextmanager
+    def _directory_lock(self):
+        """Hold the lock that serializes merges; yields False where it is unavailable"""
+        if fcntl is None:
+            yield False
+            return
+        with open(self.directory / ".merge.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def render(self):
+        """
+        Merge the snapshots of every worker into Prometheus text format
+
+        Returns:
+            str: The exposition text
+        """
+        counters = {}
+        histograms = {}
+        if self.directory is None:
+            self._fold(self._snapshot(), counters, histograms)
+        else:
+            self.flush()
+            self._collect(counters, histograms)
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {_format_number(value)}")
+                continue
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+                lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {total:.6f}")
+                lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+# Process-wide registry used by app, storage and key_manager
+metrics = Metrics()
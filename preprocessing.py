@@ -0,0 +1,126 @@
+import os
+from io import BytesIO
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Upload preprocessing settings, overridable from the environment
+UPLOAD_PREPROCESS_ENABLED = os.environ.get('UPLOAD_PREPROCESS_ENABLED', 'true').lower() == 'true'
+UPLOAD_MAX_EDGE = int(os.environ.get('UPLOAD_MAX_EDGE', 1536))
+UPLOAD_JPEG_QUALITY = int(os.environ.get('UPLOAD_JPEG_QUALITY', 85))
+
+# Pillow formats Gemini accepts as-is; anything else is always re-encoded
+GEMINI_FORMATS = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp"
+}
+
+class PreparedUpload:
+    """An input image ready to be sent upstream"""
+
+    def __init__(self, data, mime_type, original_bytes, width, height, resized=False,
+                 reencoded=False):
+        self.data = data  # Raw image bytes
+        self.mime_type = mime_type
+        self.original_bytes = original_bytes
+        self.width = width
+        self.height = height
+        self.resized = resized
+        self.reencoded = reencoded
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - len(self.data)
+
+    def describe(self):
+        """Summarize the preprocessing for API responses"""
+        return {
+            "originalBytes": self.original_bytes,
+            "sentBytes": len(self.data),
+            "bytesSaved": self.bytes_saved,
+            "mimeType": self.mime_type,
+            "width": self.width,
+            "height": self.height,
+            "resized": self.resized,
+            "reencoded": self.reencoded
+        }
+
+def _has_alpha(img):
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+def preprocess_upload(image, max_edge=UPLOAD_MAX_EDGE, quality=UPLOAD_JPEG_QUALITY,
+                      enabled=UPLOAD_PREPROCESS_ENABLED):
+    """
+    Normalize an uploaded image before it is sent to Gemini
+
+    Detects the real format, applies the EXIF orientation and shrinks the
+    image so its longest edge is at most max_edge. Images with transparency
+    or a palette are re-encoded as PNG, everything else as JPEG. The original bytes are
+    kept when they are already in a supported format, need no rotation or
+    resizing, and are smaller than the re-encoded version.
+
+    Args:
+        image: The uploaded image as bytes or a seekable binary file object
+        max_edge: Longest edge in pixels sent upstream
+        quality: JPEG quality used when re-encoding
+        enabled: When False, only the format is detected
+
+    Returns:
+        PreparedUpload: The image to send and what was done to it
+
+    Raises:
+        ValueError: If the bytes are not an image Pillow can read
+    """
+    source = BytesIO(image) if isinstance(image, (bytes, bytearray)) else image
+    original_bytes = source.seek(0, os.SEEK_END)
+    source.seek(0)
+
+    def read_original():
+        source.seek(0)
+        return source.read()
+
+    try:
+        # Decoding from the file lets large spooled uploads stay on disk
+        img = Image.open(source)
+        source_format = img.format
+        original_size = img.size
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise ValueError("Unsupported or invalid image data")
+
+    supported = source_format in GEMINI_FORMATS
+    if not enabled and supported:
+        return PreparedUpload(read_original(), GEMINI_FORMATS[source_format], original_bytes,
+                              *original_size)
+
+    try:
+        orientation = img.getexif().get(0x0112, 1)
+        if source_format == "JPEG":
+            # Let the decoder downscale by a power of two for large photos
+            img.draft("RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        if max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        resized = max(img.size) < max(original_size)
+
+        output = BytesIO()
+        if _has_alpha(img) or img.mode == "P":
+            # Transparency and palette graphics stay lossless
+            if img.mode != "P":
+                img = img.convert("RGBA")
+            img.save(output, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.save(output, format="JPEG", quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+    except OSError:
+        raise ValueError("Image data is truncated or corrupt")
+
+    data = output.getvalue()
+    unchanged = supported and not resized and orientation == 1
+    if unchanged and original_bytes <= len(data):
+        return PreparedUpload(read_original(), GEMINI_FORMATS[source_format], original_bytes,
+                              *original_size)
+
+    return PreparedUpload(data, mime_type, original_bytes, img.width, img.height,
+                          resized=resized, reencoded=True)
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Cache settings, overridable from the environment. The cache is opt-in.
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'false').lower() == 'true'
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 86400))
+RESULT_CACHE_MEMORY_MB = int(os.environ.get('RESULT_CACHE_MEMORY_MB', 64))
+RESULT_CACHE_DISK_MB = int(os.environ.get('RESULT_CACHE_DISK_MB', 1024))
+
+def _entry_size(entry):
+    """Approximate the memory held by a cached entry"""
+    return len(entry.get("imageData") or "") + len(entry.get("text") or "") + 256
+
+class ResultCache:
+    def __init__(self, cache_dir, enabled=RESULT_CACHE_ENABLED, ttl=RESULT_CACHE_TTL,
+                 memory_bytes=RESULT_CACHE_MEMORY_MB * 1024 * 1024,
+                 disk_bytes=RESULT_CACHE_DISK_MB * 1024 * 1024):
+        """
+        Initialize the two-tier result cache
+
+        Args:
+            cache_dir: Directory for the disk tier
+            enabled: Whether lookups and stores do anything
+            ttl: Seconds an entry stays valid
+            memory_bytes: Size budget of the in-memory LRU tier
+            disk_bytes: Size budget of the disk tier
+        """
+        self.cache_dir = Path(cache_dir)
+        self.enabled = enabled
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+
+        self.memory = OrderedDict()  # key -> entry, least recently used first
+        self.memory_used = 0
+        self.disk_used = None  # Computed lazily from the files on disk
+
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "bypasses": 0,
+            "evictions": 0
+        }
+
+        if self.enabled:
+            self.cache_dir.mkdir(exist_ok=True)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _disk_path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _is_fresh(self, entry):
+        return time.time() - entry.get("storedAt", 0) < self.ttl
+
+    def _remember(self, key, entry):
+        """Put an entry in the memory tier, evicting least recently used ones"""
+        size = _entry_size(entry)
+        if size > self.memory_bytes:
+            return
+        with self.lock:
+            previous = self.memory.pop(key, None)
+            if previous is not None:
+                self.memory_used -= _entry_size(previous)
+            self.memory[key] = entry
+            self.memory_used += size
+            while self.memory_used > self.memory_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_used -= _entry_size(evicted)
+                self.counters["evictions"] += 1
+
+    def get(self, key):
+        """
+        Look up a cached result
+
+        Returns:
+            dict: The cached entry, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if self._is_fresh(entry):
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return entry
+                del self.memory[key]
+                self.memory_used -= _entry_size(entry)
+
+        disk_path = self._disk_path(key)
+        try:
+            with open(disk_path, "r") as f:
+                entry = json.load(f)
+            if self._is_fresh(entry):
+                # Bump the mtime so disk eviction treats the file as recently used
+                os.utime(disk_path)
+                self._remember(key, entry)
+                self._count("disk_hits")
+                return entry
+            disk_path.unlink()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error reading result cache entry {key}: {e}")
+
+        self._count("misses")
+        return None
+
+    def put(self, key, image_data, text=None, mime_type=None):
+        """Store a result in both tiers"""
+        if not self.enabled:
+            return
+
+        entry = {
+            "imageData": image_data,
+            "text": text,
+            "mimeType": mime_type,
+            "storedAt": time.time()
+        }
+        self._remember(key, entry)
+
+        disk_path = self._disk_path(key)
+        temp_path = disk_path.with_name(f".{disk_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            disk_path.parent.mkdir(exist_ok=True)
+            with open(temp_path, "w") as f:
+                json.dump(entry, f)
+            try:
+                replaced_bytes = disk_path.stat().st_size
+            except FileNotFoundError:
+                replaced_bytes = 0
+            os.replace(temp_path, disk_path)
+            self._count("stores")
+            self._enforce_disk_budget(disk_path.stat().st_size - replaced_bytes)
+        except Exception as e:
+            print(f"Error writing result cache entry {key}: {e}")
+
+    def record_bypass(self):
+        """Count a request that asked to skip the cache"""
+        self._count("bypasses")
+
+    def _enforce_disk_budget(self, added_bytes):
+        """Delete the least recently used disk entries once the tier is over budget
+
+        Args:
+            added_bytes: Net growth of the tier from the last write (negative when
+                an entry was overwritten with a smaller one)
+        """
+        with self.lock:
+            if self.disk_used is None:
+                self.disk_used = sum(p.stat().st_size for p in self.cache_dir.glob("*/*.json"))
+            else:
+                self.disk_used += added_bytes
+            if self.disk_used <= self.disk_bytes:
+                return
+
+            files = sorted(
+                ((p.stat().st_mtime, p.stat().st_size, p) for p in self.cache_dir.glob("*/*.json")),
+                key=lambda item: item[0]
+            )
+            self.disk_used = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if self.disk_used <= self.disk_bytes * 0.9:
+                    break
+                try:
+                    path.unlink()
+                    self.disk_used -= size
+                    self.counters["evictions"] += 1
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """Return hit/miss counters and tier usage"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["enabled"] = self.enabled
+            stats["memory_entries"] = len(self.memory)
+            stats["memory_bytes"] = self.memory_used
+            stats["disk_bytes"] = self.disk_used
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else None
+        return stats
@@ -0,0 +1,362 @@
+import os
+import re
+import time
+import asyncio
+import random
+import logging
+from email.utils import parsedate_to_datetime
+import requests
+from gemini_client import GeminiAPIError, MalformedResponseError
+from key_manager import NoKeysAvailable
+
+logger = logging.getLogger(__name__)
+
+# Retry settings, overridable from the environment
+MAX_ATTEMPTS = int(os.environ.get('GEMINI_MAX_ATTEMPTS', 3))
+BASE_DELAY = float(os.environ.get('GEMINI_RETRY_BASE_DELAY', 0.5))
+MAX_DELAY = float(os.environ.get('GEMINI_RETRY_MAX_DELAY', 8))
+REQUEST_DEADLINE = float(os.environ.get('GEMINI_REQUEST_DEADLINE', 90))
+
+# Failure classes
+RATE_LIMIT = "rate_limit"  # Retry on another key; the failing key cools down
+KEY_ERROR = "key_error"  # The key itself is unusable; retry on another key
+TRANSIENT = "transient"  # Upstream hiccup; retry after a backoff
+FATAL = "fatal"  # Retrying cannot help; fail immediately
+
+RETRYABLE = (RATE_LIMIT, KEY_ERROR, TRANSIENT)
+
+# google.rpc status codes returned in error.status, checked before the HTTP status
+RPC_STATUS_CLASSES = {
+    "RESOURCE_EXHAUSTED": RATE_LIMIT,
+    "UNAUTHENTICATED": KEY_ERROR,
+    "PERMISSION_DENIED": KEY_ERROR,
+    "UNAVAILABLE": TRANSIENT,
+    "DEADLINE_EXCEEDED": TRANSIENT,
+    "INTERNAL": TRANSIENT,
+    "ABORTED": TRANSIENT,
+    "INVALID_ARGUMENT": FATAL,
+    "FAILED_PRECONDITION": FATAL,
+    "NOT_FOUND": FATAL,
+    "UNIMPLEMENTED": FATAL,
+}
+
+HTTP_STATUS_CLASSES = {
+    400: FATAL,
+    401: KEY_ERROR,
+    403: KEY_ERROR,
+    404: FATAL,
+    408: TRANSIENT,
+    409: TRANSIENT,
+    429: RATE_LIMIT,
+    500: TRANSIENT,
+    502: TRANSIENT,
+    503: TRANSIENT,
+    504: TRANSIENT,
+}
+
+# Error reasons (google.rpc.ErrorInfo) that mean the key is bad even on a 400
+KEY_ERROR_REASONS = ("API_KEY_INVALID", "API_KEY_EXPIRED", "API_KEY_SERVICE_BLOCKED")
+
+# finishReason / blockReason values for which asking again will not produce an image
+BLOCKED_REASONS = ("SAFETY", "IMAGE_SAFETY", "PROHIBITED_CONTENT", "BLOCKLIST", "SPII")
+
+class RetryError(Exception):
+    """Raised when a request failed for good; carries the HTTP status to return"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def classify_api_error(error):
+    """
+    Classify a GeminiAPIError
+
+    Returns:
+        str: One of RATE_LIMIT, KEY_ERROR, TRANSIENT or FATAL
+    """
+    for detail in error.details:
+        if isinstance(detail, dict) and detail.get('reason') in KEY_ERROR_REASONS:
+            return KEY_ERROR
+    if error.status in RPC_STATUS_CLASSES:
+        return RPC_STATUS_CLASSES[error.status]
+    if error.status_code in HTTP_STATUS_CLASSES:
+        return HTTP_STATUS_CLASSES[error.status_code]
+    return TRANSIENT if error.status_code >= 500 else FATAL
+
+def server_retry_delay(error):
+    """
+    Extract the retry delay the server asked for, if any
+
+    Looks at the Retry-After header (seconds or HTTP date) and at
+    google.rpc.RetryInfo.retryDelay (e.g. "12s") in the error details.
+
+    Returns:
+        float: Delay in seconds, or None
+    """
+    for detail in error.details:
+        if isinstance(detail, dict) and detail.get('@type', '').endswith('google.rpc.RetryInfo'):
+            match = re.fullmatch(r"([\d.]+)s", str(detail.get('retryDelay', '')))
+            if match:
+                return float(match.group(1))
+
+    retry_after = {k.lower(): v for k, v in error.headers.items()}.get('retry-after')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+def backoff_delay(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    """Exponential backoff with full jitter for the given (1-based) attempt"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+def _time_left(deadline):
+    """Seconds until a monotonic deadline, never zero so timeouts stay valid"""
+    return max(deadline - time.monotonic(), 0.001)
+
+def _mask(key):
+    return f"...{key[-4:]}" if key else None
+
+class RetryPolicy:
+    def __init__(self, key_manager, max_attempts=MAX_ATTEMPTS, deadline=REQUEST_DEADLINE,
+                 hedger=None):
+        """
+        Initialize the retry policy
+
+        Args:
+            key_manager: Supplies keys and learns about rate limits
+            max_attempts: Upper bound on upstream attempts per request
+            deadline: Seconds a request may spend upstream in total; each
+                attempt's timeout is capped at what is left of it
+            hedger: Optional Hedger racing slow attempts against a second key
+        """
+        self.key_manager = key_manager
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.hedger = hedger
+
+    def new_retry_info(self):
+        """Create the retryInfo dict reported back to clients"""
+        return {
+            "attempts": 0,
+            "max_attempts": self.max_attempts,
+            "errors": [],
+            "outcomes": [],
+            "success": False
+        }
+
+    def run(self, send, retry_info, label="request"):
+        """
+        Call upstream until an image comes back or retrying stops making sense
+
+        Each attempt uses a key not yet tried for this request when possible.
+
+        Args:
+            send: Callable taking an API key and the seconds left before the
+                deadline, and returning a GeminiResult
+            retry_info: Dict from new_retry_info, filled in with per-attempt outcomes
+            label: What is being done, for log messages
+
+        Returns:
+            GeminiResult: A result containing image data
+
+        Raises:
+            RetryError: When attempts, the deadline or a fatal error end the retries
+        """
+        steps = self._attempts(retry_info, label)
+        reply, error = None, None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            reply, error = None, None
+
+            if step[0] == "sleep":
+                time.sleep(step[1])
+                continue
+            _, api_key, tried_keys, deadline = step
+            # A hedge starts later than the primary, so each call gets what is left then
+            bounded_send = lambda key: send(key, _time_left(deadline))
+            try:
+                if self.hedger is not None:
+                    reply = self.hedger.call(
+                        bounded_send,
+                        api_key,
+                        lambda: self._pick_hedge_key(tried_keys),
+                        self._penalize
+                    )
+                else:
+                    reply = (bounded_send(api_key), api_key, False)
+            except Exception as e:
+                error = e
+
+    async def run_async(self, send, retry_info, label="request"):
+        """
+        Like run, for the asyncio event loop; slow attempts are not hedged
+
+        Args:
+            send: Coroutine function taking an API key and the seconds left
+                before the deadline, and returning a GeminiResult
+            retry_info: Dict from new_retry_info, filled in with per-attempt outcomes
+            label: What is being done, for log messages
+
+        Returns:
+            GeminiResult: A result containing image data
+
+        Raises:
+            RetryError: When attempts, the deadline or a fatal error end the retries
+        """
+        steps = self._attempts(retry_info, label)
+        reply, error = None, None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            reply, error = None, None
+
+            if step[0] == "sleep":
+                await asyncio.sleep(step[1])
+                continue
+            _, api_key, _, deadline = step
+            try:
+                reply = (await send(api_key, _time_left(deadline)), api_key, False)
+            except Exception as e:
+                error = e
+
+    def _attempts(self, retry_info, label):
+        """
+        The retry loop shared by run and run_async, as a generator
+
+        Yields ("call", api_key, tried_keys, monotonic deadline) when an
+        attempt should be sent and
+        expects (result, key that answered, whether a hedge was sent) back, or
+        the exception the attempt raised thrown in. Yields ("sleep", seconds)
+        between attempts. Returns the successful result.
+        """
+        started = time.monotonic()
+        tried_keys = set()
+        final_error = RetryError("No image data received after multiple attempts", 500)
+
+        for attempt in range(1, self.max_attempts + 1):
+            retry_info["attempts"] = attempt
+            print(f"🔍 ATTEMPT {attempt}/{self.max_attempts} to {label}")
+
+            api_key = None
+            attempt_started = time.monotonic()
+            retry_after = None
+            try:
+                api_key = self.key_manager.get_key(exclude=tried_keys)
+                tried_keys.add(api_key)
+                result, api_key, hedged = yield ("call", api_key, tried_keys, started + self.deadline)
+                if hedged:
+                    retry_info["hedged"] = True
+
+                if result.image_bytes is not None:
+                    self.key_manager.reset_key(api_key)
+                    self._record(retry_info, attempt, api_key, "success", 200, attempt_started)
+                    retry_info["success"] = True
+                    print(f"🔍 Successfully completed {label} on attempt {attempt}/{self.max_attempts}")
+                    return result
+
+                # The key worked; the model just did not return an image
+                self.key_manager.reset_key(api_key)
+                blocked = result.block_reason or (
+                    result.finish_reason if result.finish_reason in BLOCKED_REASONS else None
+                )
+                if blocked:
+                    message = f"Request blocked by the model ({blocked})"
+                    kind, error_type, status_code = FATAL, "blocked", 400
+                else:
+                    message = "No image data received from API"
+                    kind, error_type, status_code = TRANSIENT, "missing_data", 500
+                    final_error = RetryError("No image data received after multiple attempts", 500)
+            except GeminiAPIError as e:
+                kind, retry_after = self._penalize(api_key, e)
+                message, error_type, status_code = e.message, "api_error", e.status_code
+            except (requests.RequestException, MalformedResponseError) as e:
+                # Timeouts, dropped connections and truncated or garbled bodies
+                kind, message, error_type, status_code = TRANSIENT, str(e), "exception", 502
+            except NoKeysAvailable as e:
+                kind, message, error_type, status_code = FATAL, str(e), "exception", 500
+            except Exception as e:
+                kind, message, error_type, status_code = FATAL, str(e), "exception", 500
+
+            print(f"🔍 Attempt {attempt} failed ({kind}): {message}")
+            self._record(retry_info, attempt, api_key, kind, status_code, attempt_started)
+            retry_info["errors"].append({
+                "attempt": attempt,
+                "message": message,
+                "type": error_type,
+                "class": kind
+            })
+            if error_type != "missing_data":
+                final_error = RetryError(message, status_code)
+
+            if kind not in RETRYABLE or attempt == self.max_attempts:
+                break
+
+            delay = backoff_delay(attempt)
+            # A rate-limited key is left to cool down; only wait out the server's
+            # delay when there is no other key to rotate to
+            if kind == RATE_LIMIT and retry_after and len(tried_keys) >= len(self.key_manager.keys):
+                delay = max(delay, retry_after)
+
+            elapsed = time.monotonic() - started
+            if elapsed + delay >= self.deadline:
+                retry_info["deadlineExceeded"] = True
+                break
+
+            retry_info["outcomes"][-1]["delay"] = round(delay, 3)
+            yield ("sleep", delay)
+
+            # Once every key has been tried, start rotating through them again
+            if len(tried_keys) >= len(self.key_manager.keys):
+                tried_keys.clear()
+
+        raise final_error
+
+    def _pick_hedge_key(self, tried_keys):
+        """Pick an untried key with budget for a hedge request, or None"""
+        hedge_key = self.key_manager.get_key(exclude=tried_keys, require_ready=True)
+        if hedge_key is not None:
+            tried_keys.add(hedge_key)
+        return hedge_key
+
+    def _penalize(self, api_key, error):
+        """
+        Tell the key manager about a failed call on api_key
+
+        Returns:
+            tuple: (failure class, server-requested retry delay or None)
+        """
+        if not isinstance(error, GeminiAPIError):
+            transient = isinstance(error, (requests.RequestException, MalformedResponseError))
+            return TRANSIENT if transient else FATAL, None
+
+        kind = classify_api_error(error)
+        retry_after = None
+        if kind == RATE_LIMIT:
+            retry_after = server_retry_delay(error)
+            self.key_manager.mark_rate_limited(api_key, retry_after)
+            logger.warning(f"API key {_mask(api_key)} hit rate limit. Marked for cooldown.")
+        elif kind == KEY_ERROR:
+            # Keep the key out of rotation for the longest cooldown
+            self.key_manager.mark_rate_limited(api_key, 3600)
+            logger.warning(f"API key {_mask(api_key)} was rejected. Taken out of rotation.")
+        return kind, retry_after
+
+    def _record(self, retry_info, attempt, api_key, outcome, status_code, attempt_started):
+        retry_info["outcomes"].append({
+            "attempt": attempt,
+            "key": _mask(api_key),
+            "outcome": outcome,
+            "status": status_code,
+            "seconds": round(time.monotonic() - attempt_started, 3)
+        })
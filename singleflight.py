@@ -0,0 +1,169 @@
+import os
+import copy
+import json
+import time
+import uuid
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; cross-worker mode is disabled there
+    fcntl = None
+
+# Coalescing settings, overridable from the environment
+SINGLEFLIGHT_ENABLED = os.environ.get('SINGLEFLIGHT_ENABLED', 'true').lower() == 'true'
+SINGLEFLIGHT_CROSS_WORKER = os.environ.get('SINGLEFLIGHT_CROSS_WORKER', 'false').lower() == 'true'
+
+# Lock and result files older than this are removed by the periodic sweep
+STALE_FILE_SECONDS = 3600
+
+class _Call:
+    """An in-flight call that other threads can wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self, lock_dir, enabled=SINGLEFLIGHT_ENABLED,
+                 cross_worker=SINGLEFLIGHT_CROSS_WORKER):
+        """
+        Initialize the coalescer
+
+        Args:
+            lock_dir: Directory for lock and result files shared between worker processes
+            enabled: Whether calls are coalesced at all
+            cross_worker: Whether to also coalesce with other processes via file locks
+        """
+        self.lock_dir = Path(lock_dir)
+        self.enabled = enabled
+        self.cross_worker = cross_worker and fcntl is not None
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.last_sweep = time.time()
+        self.counters = {"leaders": 0, "coalesced_local": 0, "coalesced_cross_worker": 0}
+
+        if self.cross_worker:
+            self.lock_dir.mkdir(exist_ok=True)
+
+    def do(self, key, fn):
+        """
+        Run fn, unless an identical call is already in flight, and share its result
+
+        Args:
+            key: Fingerprint identifying identical calls
+            fn: Zero-argument callable producing a JSON-serialisable result
+
+        Returns:
+            tuple: (result, True if the result came from another caller's call)
+        """
+        if not self.enabled or key is None:
+            return fn(), False
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+                self.counters["leaders"] += 1
+            else:
+                self.counters["coalesced_local"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
+
+        try:
+            if self.cross_worker:
+                result, shared = self._do_cross_worker(key, fn)
+            else:
+                result, shared = fn(), False
+            # Keep a private copy so callers mutating their result cannot affect followers
+            call.result = copy.deepcopy(result)
+            return result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+    def _do_cross_worker(self, key, fn):
+        """Coalesce with other worker processes using an exclusive lock file per key"""
+        lock_path = self.lock_dir / f"{key}.lock"
+        waiter_path = self.lock_dir / f"{key}.wait"
+        result_path = self.lock_dir / f"{key}.json"
+        self._sweep()
+
+        with open(lock_path, "a") as lock_file:
+            # Keep in-use lock files young so the sweep never removes them
+            os.utime(lock_path)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is running this call; wait for it and reuse its result
+                waiting_since = time.time()
+                waiter_path.touch()
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                result = self._read_result(result_path, waiting_since)
+                if result is not None:
+                    with self.lock:
+                        self.counters["coalesced_cross_worker"] += 1
+                    return result, True
+
+            try:
+                result = fn()
+                # Only pay for writing the result when another worker is waiting for it
+                if waiter_path.exists():
+                    self._write_result(result_path, result)
+                    waiter_path.unlink(missing_ok=True)
+                return result, False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_result(self, result_path, newer_than):
+        """Read a result file written after the given time, or None"""
+        try:
+            if result_path.stat().st_mtime < newer_than:
+                return None
+            with open(result_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_result(self, result_path, result):
+        temp_path = result_path.with_name(f".{result_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(result, f)
+            os.replace(temp_path, result_path)
+        except Exception as e:
+            print(f"Error sharing coalesced result: {e}")
+
+    def _sweep(self):
+        """Remove old lock and result files at most once a minute"""
+        now = time.time()
+        if now - self.last_sweep < 60:
+            return
+        self.last_sweep = now
+        for path in self.lock_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime > STALE_FILE_SECONDS:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Return how many calls ran upstream and how many were coalesced"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self.calls)
+        stats["enabled"] = self.enabled
+        stats["cross_worker"] = self.cross_worker
+        return stats
@@ -1,20 +1,205 @@
 import os
+import atexit
 import base64
 import json
 import uuid
+import hashlib
 import time
 from datetime import datetime
+from io import BytesIO
 from pathlib import Path
+from PIL import Image, ImageOps, UnidentifiedImageError
+from catalog import Catalog
+from image_cache import ImageCache
+from metrics import metrics
+from storage_backends import CatalogJournal, create_backend
+from storage_writer import StorageWriter
 
 # Define storage directory - create if it doesn't exist
-STORAGE_DIR = Path("./storage")
+STORAGE_DIR = Path(os.environ.get("STORAGE_DIR", "./storage")).resolve()
 IMAGES_DIR = STORAGE_DIR / "images"
 METADATA_DIR = STORAGE_DIR / "metadata"
+THUMBNAILS_DIR = STORAGE_DIR / "thumbnails"
+RENDITIONS_DIR = STORAGE_DIR / "renditions"
 
 # Create directories if they don't exist
 STORAGE_DIR.mkdir(exist_ok=True)
 IMAGES_DIR.mkdir(exist_ok=True)
 METADATA_DIR.mkdir(exist_ok=True)
+THUMBNAILS_DIR.mkdir(exist_ok=True)
+RENDITIONS_DIR.mkdir(exist_ok=True)
+
+# Where images, renditions and metadata are kept, addressed by keys such as
+# 'images/ab/cd/<id>.png'. Thumbnails and the catalog are local caches either way.
+backend = create_backend(STORAGE_DIR)
+
+# Longest edge in pixels for each thumbnail size served by list_images
+THUMBNAIL_SIZES = {"small": 256, "medium": 512, "large": 1024}
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 80))
+
+# What list_images returns for each entry: the full image, a thumbnail, or metadata only
+IMAGE_VARIANTS = ("full", "thumbnail", "none")
+
+# Index of metadata used to serve listings without scanning METADATA_DIR. With a
+# remote backend every instance keeps its own copy, synced through a shared journal.
+catalog = Catalog(
+    STORAGE_DIR / "catalog.db",
+    METADATA_DIR,
+    journal=CatalogJournal(backend) if backend.remote else None
+)
+
+# Seconds to wait for queued writes at shutdown, and for a pending image before reading it
+STORAGE_FLUSH_TIMEOUT = float(os.environ.get("STORAGE_FLUSH_TIMEOUT", 30))
+
+# Seconds a read of a just-created image waits for it to appear, since another
+# worker's write-behind queue may still hold it; only IDs younger than
+# RECENT_IMAGE_SECONDS wait, so lookups of unknown images stay fast
+STORAGE_PENDING_WAIT = float(os.environ.get("STORAGE_PENDING_WAIT", 2))
+RECENT_IMAGE_SECONDS = 60
+
+# File extension for each image format we may store, most common first
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/avif": ".avif",
+    "image/gif": ".gif",
+    "application/octet-stream": ".bin"
+}
+
+# Recently read images, so hot IDs are served without reading or encoding them again
+hot_images = ImageCache(STORAGE_DIR / "image_cache.invalidations")
+
+# MIME type for each stored file extension
+EXTENSION_TYPES = {extension: mime_type for mime_type, extension in IMAGE_EXTENSIONS.items()}
+
+# Formats smaller renditions may be stored in, most compact first
+RENDITION_TYPES = ("image/avif", "image/webp")
+
+# Background transcoding of stored images to a smaller rendition: off, webp or avif
+STORAGE_TRANSCODE = os.environ.get("STORAGE_TRANSCODE", "off").lower()
+STORAGE_TRANSCODE_QUALITY = int(os.environ.get("STORAGE_TRANSCODE_QUALITY", 90))
+# Encode lossless sources (PNG, GIF) losslessly instead of at STORAGE_TRANSCODE_QUALITY
+STORAGE_TRANSCODE_LOSSLESS = os.environ.get("STORAGE_TRANSCODE_LOSSLESS", "false").lower() == "true"
+
+# Days an original is kept once a smaller rendition exists; unset keeps originals forever
+_retention = os.environ.get("STORAGE_ORIGINAL_RETENTION_DAYS", "")
+STORAGE_ORIGINAL_RETENTION_DAYS = float(_retention) if _retention else None
+
+def _transcode_format(name):
+    """
+    Resolve STORAGE_TRANSCODE to a Pillow format name
+    
+    AVIF needs a Pillow build with AVIF support or the pillow-avif-plugin
+    package; without either, WebP is used instead.
+    
+    Returns:
+        str: 'WEBP', 'AVIF', or None when transcoding is off
+    """
+    if name in ("", "off", "none", "false"):
+        return None
+    if name not in ("webp", "avif"):
+        print(f"Unknown STORAGE_TRANSCODE '{name}', transcoding disabled")
+        return None
+    
+    if name == "avif":
+        try:
+            import pillow_avif  # noqa: F401  Registers the AVIF plugin with Pillow
+        except ImportError:
+            pass
+    Image.init()
+    if name == "avif" and "AVIF" not in Image.SAVE:
+        print("AVIF encoding is not available in this Pillow build, transcoding to WebP instead")
+        name = "webp"
+    if name.upper() not in Image.SAVE:
+        print(f"{name.upper()} encoding is not available in this Pillow build, transcoding disabled")
+        return None
+    return name.upper()
+
+TRANSCODE_FORMAT = _transcode_format(STORAGE_TRANSCODE)
+
+def _shard(image_id):
+    """
+    Spread files over ab/cd/ subdirectories using a hash of the ID
+    
+    IDs start with a timestamp, so their own prefix would put most new files
+    in the same directory; hashing keeps every directory small.
+    """
+    digest = hashlib.sha1(image_id.encode("utf-8")).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}"
+
+def _shard_dir(base_dir, image_id):
+    return base_dir / _shard(image_id)
+
+def _image_key(image_id, mime_type="image/jpeg"):
+    extension = IMAGE_EXTENSIONS.get(mime_type, ".bin")
+    return f"images/{_shard(image_id)}/{image_id}{extension}"
+
+def _metadata_key(image_id):
+    return f"metadata/{_shard(image_id)}/{image_id}.json"
+
+def _image_keys(image_id):
+    """Candidate original image keys: each format in the sharded layout, then the old flat layout"""
+    shard = _shard(image_id)
+    keys = tuple(f"images/{shard}/{image_id}{extension}" for extension in IMAGE_EXTENSIONS.values())
+    return keys + (f"images/{image_id}.jpg",)
+
+def _metadata_keys(image_id):
+    """Candidate metadata keys: the sharded layout, then the old flat layout"""
+    return (_metadata_key(image_id), f"metadata/{image_id}.json")
+
+def _rendition_key(image_id, mime_type):
+    return f"renditions/{_shard(image_id)}/{image_id}{IMAGE_EXTENSIONS[mime_type]}"
+
+def _rendition_keys(image_id):
+    """Candidate rendition keys, most compact format first"""
+    return tuple(_rendition_key(image_id, mime_type) for mime_type in RENDITION_TYPES)
+
+def _original_first_keys(image_id):
+    """
+    Candidate keys for base64 JSON responses, which cannot negotiate a format:
+    the original, then a rendition if the original has been removed
+    """
+    return _image_keys(image_id) + _rendition_keys(image_id)
+
+def _find_key(keys):
+    for key in keys:
+        if backend.exists(key):
+            return key
+    return None
+
+def _read_first(keys):
+    """Read the first of keys that exists, tolerating files moved by migrate_layout meanwhile"""
+    for _ in range(2):
+        for key in keys:
+            data = _read(key)
+            if data is not None:
+                return data
+    return None
+
+def _read(key):
+    """Read a key through the backend, counting the bytes read"""
+    data = backend.read(key)
+    if data is not None:
+        metrics.inc("storage_read_bytes_total", len(data), kind=key.split("/", 1)[0])
+    return data
+
+def _write(key, data, **options):
+    """Write a key through the backend, timing the write and counting the bytes written"""
+    kind = key.split("/", 1)[0]
+    with metrics.timer("storage_write_seconds", kind=kind):
+        backend.write(key, data, **options)
+    size = len(data) if isinstance(data, (bytes, bytearray)) else data.tell()
+    metrics.inc("storage_write_bytes_total", size, kind=kind)
+
+def _index_metadata(metadata, metadata_key):
+    """Record metadata in the catalog; the JSON file stays the source of truth"""
+    try:
+        # Listings sort local files by mtime, as catalog rebuilds do
+        stat = None if backend.remote else backend.stat(metadata_key)
+        catalog.index_image(metadata, sort_ts=stat[1] / 1e9 if stat else None)
+    except Exception as e:
+        print(f"Error indexing image {metadata.get('id')} in catalog: {e}")
 
 def save_image(image_data_base64, metadata=None):
     """
@@ -27,9 +212,6 @@ def save_image(image_data_base64, metadata=None):
     Returns:
         str: The image ID
     """
-    # Generate a unique ID for this image
-    image_id = f"{int(time.time())}_{uuid.uuid4().hex[:8]}"
-    
     # Decode base64 image data
     try:
         image_data = base64.b64decode(image_data_base64)
@@ -37,45 +219,291 @@ def save_image(image_data_base64, metadata=None):
         print(f"Error decoding base64 image: {e}")
         return None
     
-    # Save the image file
-    image_path = IMAGES_DIR / f"{image_id}.jpg"
-    with open(image_path, "wb") as f:
-        f.write(image_data)
+    return save_image_bytes(image_data, metadata)
+
+def save_image_bytes(image_data, metadata=None):
+    """
+    Save raw image data to persistent storage
     
-    # Save metadata if provided
+    The ID is assigned immediately. Image bytes are written by the background
+    writer unless write-behind is disabled or its queue is full; until then
+    get_image serves them from memory.
+    
+    Args:
+        image_data: Image bytes, or a binary file object positioned at the start
+        metadata: Optional dict with additional information
+        
+    Returns:
+        str: The image ID
+    """
+    # Generate a unique ID for this image
+    image_id = f"{int(time.time())}_{uuid.uuid4().hex[:8]}"
+    
+    # Add timestamp and id to metadata
+    full_metadata = None
     if metadata:
-        metadata_path = METADATA_DIR / f"{image_id}.json"
-        with open(metadata_path, "w") as f:
-            # Add timestamp and id to metadata
-            full_metadata = {
-                "id": image_id,
-                "timestamp": datetime.now().isoformat(),
-                **metadata
-            }
-            json.dump(full_metadata, f, indent=2)
-    
-    print(f"Saved image {image_id} to {image_path}")
+        full_metadata = {
+            "id": image_id,
+            "timestamp": datetime.now().isoformat(),
+            **metadata
+        }
+    
+    # File uploads are written straight away so they never need to be held in memory
+    if isinstance(image_data, (bytes, bytearray)):
+        if writer.submit(image_id, bytes(image_data), full_metadata):
+            return image_id
+    
+    _write_image(image_id, image_data, full_metadata)
     return image_id
 
+def _write_image(image_id, image_data, metadata):
+    """Persist an image and its metadata; the metadata is written last"""
+    if isinstance(image_data, (bytes, bytearray)):
+        header = image_data[:16]
+    else:
+        header = image_data.read(16)
+        image_data.seek(0)
+    mime_type = sniff_mime_type(header)
+    image_key = _image_key(image_id, mime_type)
+    _write(image_key, image_data, content_type=mime_type, dedupe=True)
+    
+    # Save metadata if provided
+    if metadata:
+        metadata_key = _metadata_key(image_id)
+        _write(metadata_key, json.dumps(metadata, indent=2).encode("utf-8"),
+               content_type="application/json")
+        _index_metadata(metadata, metadata_key)
+    
+    print(f"Saved image {image_id} to {image_key}")
+    if TRANSCODE_FORMAT and mime_type.startswith("image/"):
+        transcoder.submit(image_id, None, None)
+
+def _remove_original(image_id):
+    """Delete an image's original; a local blob is reclaimed by gc_blobs once unreferenced"""
+    for key in _image_keys(image_id):
+        backend.delete(key)
+
+def _transcode_image(image_id, image_data=None, metadata=None):
+    """
+    Write a smaller TRANSCODE_FORMAT rendition of a stored image
+    
+    The rendition is only kept when it is smaller than the original.
+    Animated images and images already in the target format are skipped.
+    With a retention of 0 days the original is removed right away.
+    
+    Args:
+        image_id: The ID of the image
+        image_data: Unused; the stored original is read back
+        metadata: Unused
+        
+    Returns:
+        int: Bytes saved by the rendition, or 0 if none was written
+    """
+    if TRANSCODE_FORMAT is None:
+        return 0
+    rendition_type = f"image/{TRANSCODE_FORMAT.lower()}"
+    rendition_key = _rendition_key(image_id, rendition_type)
+    if backend.exists(rendition_key):
+        return 0
+    source_data = _read_first(_image_keys(image_id))
+    if source_data is None:
+        return 0
+    
+    source_bytes = len(source_data)
+    try:
+        img = Image.open(BytesIO(source_data))
+    except UnidentifiedImageError:
+        return 0
+    with img:
+        if img.format == TRANSCODE_FORMAT or getattr(img, "is_animated", False):
+            return 0
+        
+        options = {"quality": STORAGE_TRANSCODE_QUALITY}
+        if STORAGE_TRANSCODE_LOSSLESS and img.format in ("PNG", "GIF"):
+            options["lossless"] = True
+        # Carry over orientation and color profile
+        for key in ("exif", "icc_profile"):
+            if img.info.get(key):
+                options[key] = img.info[key]
+        
+        if img.mode not in ("RGB", "RGBA"):
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        output = BytesIO()
+        img.save(output, format=TRANSCODE_FORMAT, **options)
+    
+    rendition_data = output.getvalue()
+    if len(rendition_data) >= source_bytes:
+        print(f"Kept only the original of image {image_id}: {TRANSCODE_FORMAT} was not smaller")
+        return 0
+    
+    _write(rendition_key, rendition_data, content_type=rendition_type, dedupe=True)
+    # Cached payloads should switch to the smaller rendition
+    hot_images.invalidate(image_id)
+    print(f"Transcoded image {image_id} to {TRANSCODE_FORMAT}: "
+          f"{source_bytes} -> {len(rendition_data)} bytes")
+    if STORAGE_ORIGINAL_RETENTION_DAYS == 0:
+        _remove_original(image_id)
+    return source_bytes - len(rendition_data)
+
+# Background writer that takes image writes off the request path
+writer = StorageWriter(_write_image)
+
+# Background transcoder for smaller renditions; images it has no room for are
+# left to `manage.py transcode-images`
+transcoder = StorageWriter(_transcode_image, enabled=TRANSCODE_FORMAT is not None)
+
+def _flush_pending_writes():
+    if not writer.flush(timeout=STORAGE_FLUSH_TIMEOUT):
+        print(f"Gave up waiting for {writer.stats()['pending']} pending image writes")
+
+atexit.register(_flush_pending_writes)
+
+# Leading bytes of the image formats we may store, mapped to their MIME types
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+def sniff_mime_type(image_data):
+    """
+    Detect an image's MIME type from its leading bytes
+    
+    Images stored before format detection all use a .jpg extension, so the
+    name cannot be trusted.
+    
+    Args:
+        image_data: The image bytes (at least the first 16 bytes)
+        
+    Returns:
+        str: The detected MIME type, 'application/octet-stream' if unknown
+    """
+    for signature, mime_type in _IMAGE_SIGNATURES:
+        if image_data.startswith(signature):
+            return mime_type
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "image/webp"
+    if image_data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return "application/octet-stream"
+
+def _original_mime_type(key):
+    """MIME type of a stored original; local files from before format detection all end in .jpg"""
+    path = backend.local_path(key)
+    if path is not None:
+        with open(path, "rb") as f:
+            return sniff_mime_type(f.read(16))
+    return EXTENSION_TYPES.get(os.path.splitext(key)[1], "application/octet-stream")
+
+def base64_mime_type(image_base64):
+    """MIME type of base64-encoded image data, from its first bytes"""
+    return sniff_mime_type(base64.b64decode(image_base64[:24]))
+
+def get_image_path(image_id):
+    """
+    Get the path of a stored image file
+    
+    Returns:
+        Path: The original image file, a rendition if the original has been
+            removed, or None if the image does not exist or is not stored locally
+    """
+    # Callers need a file, so let a pending write land first
+    writer.wait(image_id, timeout=STORAGE_FLUSH_TIMEOUT)
+    key = _find_key(_original_first_keys(image_id))
+    return backend.local_path(key) if key else None
+
+def _await_other_worker(image_id, find):
+    """
+    Retry a lookup of a just-created image for up to STORAGE_PENDING_WAIT seconds
+    
+    Args:
+        image_id: The ID of the image, which starts with its creation time
+        find: Callable returning the lookup result, falsy while not found
+        
+    Returns:
+        The first truthy result, or None
+    """
+    try:
+        created = int(image_id.split("_", 1)[0])
+    except ValueError:
+        return None
+    if time.time() - created > RECENT_IMAGE_SECONDS:
+        return None
+    deadline = time.monotonic() + STORAGE_PENDING_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        result = find()
+        if result:
+            return result
+    return None
+
+def get_write_failure(image_id):
+    """Return why saving an image failed in this process, or None"""
+    return writer.failure(image_id)
+
+def get_image_renditions(image_id):
+    """
+    List the stored files an image can be served from
+    
+    Returns:
+        list: (key, MIME type) pairs with renditions first, smallest format
+            first, and the original last; empty if the image does not exist
+    """
+    writer.wait(image_id, timeout=STORAGE_FLUSH_TIMEOUT)
+    renditions = _find_renditions(image_id)
+    if not renditions:
+        renditions = _await_other_worker(image_id, lambda: _find_renditions(image_id)) or []
+    return renditions
+
+def _find_renditions(image_id):
+    renditions = [
+        (key, mime_type)
+        for key, mime_type in zip(_rendition_keys(image_id), RENDITION_TYPES)
+        if backend.exists(key)
+    ]
+    original_key = _find_key(_image_keys(image_id))
+    if original_key is not None:
+        renditions.append((original_key, _original_mime_type(original_key)))
+    return renditions
+
+def get_file_path(key):
+    """Local path of a stored file, or None if the backend is remote"""
+    return backend.local_path(key)
+
+def get_file_url(key, mime_type=None):
+    """Presigned URL clients can fetch a stored file from, or None for local files"""
+    return backend.url(key, content_type=mime_type)
+
 def get_image(image_id):
-    """Retrieve an image from storage"""
-    image_path = IMAGES_DIR / f"{image_id}.jpg"
-    metadata_path = METADATA_DIR / f"{image_id}.json"
+    """Retrieve an image from the hot-image cache, the write queue if it is still pending, or storage"""
+    pending = writer.get(image_id)
+    if pending is not None:
+        image_data, metadata = pending
+        return base64.b64encode(image_data).decode('utf-8'), dict(metadata) if metadata else None
     
-    if not image_path.exists():
-        return None, None
+    cached = hot_images.get(image_id)
+    if cached is not None:
+        return cached
     
-    with open(image_path, "rb") as f:
-        image_data = f.read()
+    # An update or delete landing during the read must not leave the old copy cached
+    generation = hot_images.generation(image_id)
+    image_data = _read_first(_original_first_keys(image_id))
+    if image_data is None:
+        image_data = _await_other_worker(image_id, lambda: _read_first(_original_first_keys(image_id)))
+    if image_data is None:
+        return None, None
     
     image_base64 = base64.b64encode(image_data).decode('utf-8')
     
     metadata = None
-    if metadata_path.exists():
-        with open(metadata_path, "r") as f:
-            metadata = json.load(f)
+    metadata_json = _read_first(_metadata_keys(image_id))
+    if metadata_json is not None:
+        metadata = json.loads(metadata_json)
     
-    return image_base64, metadata
+    hot_images.put(image_id, image_base64, metadata, generation)
+    return image_base64, dict(metadata) if metadata else metadata
 
 def update_image_metadata(image_id, new_metadata):
     """
@@ -88,17 +516,17 @@ def update_image_metadata(image_id, new_metadata):
     Returns:
         bool: True if successful, False otherwise
     """
-    metadata_path = METADATA_DIR / f"{image_id}.json"
+    writer.wait(image_id, timeout=STORAGE_FLUSH_TIMEOUT)
+    metadata_json = _read_first(_metadata_keys(image_id))
     
     # Check if the metadata file exists
-    if not metadata_path.exists():
+    if metadata_json is None:
         print(f"Metadata file not found for image {image_id}")
         return False
     
     try:
         # Load existing metadata
-        with open(metadata_path, "r") as f:
-            metadata = json.load(f)
+        metadata = json.loads(metadata_json)
         
         # Update with new values, preserving ID and timestamp
         original_id = metadata.get('id')
@@ -112,9 +540,14 @@ def update_image_metadata(image_id, new_metadata):
         if original_timestamp:
             metadata['timestamp'] = original_timestamp
         
-        # Write updated metadata back to file
-        with open(metadata_path, "w") as f:
-            json.dump(metadata, f, indent=2)
+        # Write updated metadata back, moving it to the sharded layout if needed
+        metadata_key = _metadata_key(image_id)
+        _write(metadata_key, json.dumps(metadata, indent=2).encode("utf-8"),
+               content_type="application/json")
+        if not backend.remote:
+            backend.delete(f"metadata/{image_id}.json")
+        hot_images.invalidate(image_id)
+        _index_metadata(metadata, metadata_key)
         
         print(f"Updated metadata for image {image_id}")
         return True
@@ -123,6 +556,137 @@ def update_image_metadata(image_id, new_metadata):
         print(f"Error updating metadata for image {image_id}: {e}")
         return False
 
+def delete_image(image_id):
+    """
+    Delete an image with its renditions, metadata and cached thumbnails
+    
+    Content shared with other images stays; local blobs are reclaimed by gc_blobs.
+    
+    Args:
+        image_id: The ID of the image to delete
+        
+    Returns:
+        bool: True if the image existed
+    """
+    # Let queued work land first so nothing is written back after the delete
+    writer.wait(image_id, timeout=STORAGE_FLUSH_TIMEOUT)
+    transcoder.wait(image_id, timeout=STORAGE_FLUSH_TIMEOUT)
+    
+    keys = _image_keys(image_id) + _rendition_keys(image_id) + _metadata_keys(image_id)
+    if _find_key(keys) is None:
+        return False
+    
+    for key in keys:
+        backend.delete(key)
+    for size in THUMBNAIL_SIZES:
+        (_shard_dir(THUMBNAILS_DIR / size, image_id) / f"{image_id}.jpg").unlink(missing_ok=True)
+    hot_images.invalidate(image_id)
+    try:
+        catalog.remove_image(image_id)
+    except Exception as e:
+        print(f"Error removing image {image_id} from catalog: {e}")
+    
+    print(f"Deleted image {image_id}")
+    return True
+
+def _render_thumbnail(source, max_edge):
+    """Decode an image (a path or file object) and return it as JPEG bytes no larger than max_edge on either side"""
+    with Image.open(source) as img:
+        # Let the JPEG decoder downscale while decoding instead of loading full size
+        img.draft('RGB', (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_edge, max_edge))
+        
+        # JPEG has no alpha channel, so flatten transparent images onto white
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+        return output.getvalue()
+
+def get_thumbnail_path(image_id, size="small"):
+    """
+    Get the path of a cached JPEG thumbnail, generating it if needed
+    
+    Cached thumbnails carry the source image's mtime, so they are regenerated
+    whenever the source file changes.
+    
+    Args:
+        image_id: The ID of the image
+        size: One of the keys of THUMBNAIL_SIZES
+        
+    Returns:
+        Path: The thumbnail file path, or None if the image does not exist
+        
+    Raises:
+        ValueError: If the size is unknown
+    """
+    if size not in THUMBNAIL_SIZES:
+        raise ValueError(f"Unknown thumbnail size '{size}'")
+    
+    writer.wait(image_id, timeout=STORAGE_FLUSH_TIMEOUT)
+    thumbnail_path = _shard_dir(THUMBNAILS_DIR / size, image_id) / f"{image_id}.jpg"
+    
+    for source_key in _image_keys(image_id) + _rendition_keys(image_id):
+        source_stat = backend.stat(source_key)
+        if source_stat is not None:
+            break
+    else:
+        return None
+    source_mtime_ns = source_stat[1]
+    
+    try:
+        if thumbnail_path.stat().st_mtime_ns == source_mtime_ns:
+            return thumbnail_path
+    except FileNotFoundError:
+        pass
+    
+    # Thumbnails are always cached locally, whichever backend holds the source
+    source = backend.local_path(source_key)
+    if source is None:
+        source_data = _read(source_key)
+        if source_data is None:
+            return None
+        source = BytesIO(source_data)
+    thumbnail_data = _render_thumbnail(source, THUMBNAIL_SIZES[size])
+    
+    # Write to a temp file and rename so concurrent readers never see a partial thumbnail
+    thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = thumbnail_path.with_name(f".{thumbnail_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(thumbnail_data)
+    os.utime(temp_path, ns=(source_mtime_ns, source_mtime_ns))
+    os.replace(temp_path, thumbnail_path)
+    metrics.inc("storage_write_bytes_total", len(thumbnail_data), kind="thumbnails")
+    
+    return thumbnail_path
+
+def get_thumbnail(image_id, size="small"):
+    """
+    Get a JPEG thumbnail of an image, generating and caching it on first use
+    
+    Args:
+        image_id: The ID of the image
+        size: One of the keys of THUMBNAIL_SIZES
+        
+    Returns:
+        bytes: JPEG thumbnail data, or None if the image does not exist
+        
+    Raises:
+        ValueError: If the size is unknown
+    """
+    thumbnail_path = get_thumbnail_path(image_id, size)
+    if thumbnail_path is None:
+        return None
+    with open(thumbnail_path, "rb") as f:
+        return f.read()
+
 def list_images(limit=50, offset=0, tag=None):
     """
     List available images with optional filtering
@@ -135,45 +699,229 @@ def list_images(limit=50, offset=0, tag=None):
     Returns:
         list: List of image metadata
     """
-    result = []
-    
-    # Get all JSON metadata files
-    metadata_files = sorted(METADATA_DIR.glob("*.json"), 
-                           key=lambda x: os.path.getmtime(x),
-                           reverse=True)
+    images, _ = list_images_page(limit, offset=offset, tag=tag)
+    return images
+
+def list_images_page(limit=50, offset=0, tag=None, cursor=None,
+                     variant="full", thumbnail_size="small"):
+    """
+    List one page of images, newest first, from the catalog
     
-    # Apply offset
-    metadata_files = metadata_files[offset:]
+    Args:
+        limit: Maximum number of images to return
+        offset: Number of images to skip (ignored when cursor is given)
+        tag: Optional tag to filter by
+        cursor: Opaque cursor from a previous page for keyset pagination
+        variant: 'full' for the stored image, 'thumbnail' for a cached
+            thumbnail, or 'none' for metadata only
+        thumbnail_size: Thumbnail size to use when variant is 'thumbnail'
+        
+    Returns:
+        tuple: (list of image metadata, cursor for the next page or None)
+        
+    Raises:
+        ValueError: If the cursor, variant or thumbnail size is invalid
+    """
+    if variant not in IMAGE_VARIANTS:
+        raise ValueError(f"Unknown variant '{variant}'")
+    if variant == "thumbnail" and thumbnail_size not in THUMBNAIL_SIZES:
+        raise ValueError(f"Unknown thumbnail size '{thumbnail_size}'")
     
-    # Process files
-    for metadata_file in metadata_files:
-        if len(result) >= limit:
-            break
+    with metrics.timer("list_images_seconds", variant=variant):
+        images, next_cursor = catalog.query(limit, offset=offset, tag=tag, cursor=cursor)
+        if variant != "none":
+            _attach_image_data(images, variant, thumbnail_size)
+    return images, next_cursor
+
+def _attach_image_data(images, variant, thumbnail_size):
+    """Add base64 image or thumbnail data to each listed image's metadata"""
+    for metadata in images:
+        try:
+            if variant == "thumbnail":
+                image_data = get_thumbnail(metadata['id'], thumbnail_size)
+            else:
+                image_data = _read_first(_original_first_keys(metadata['id']))
+            if image_data is None:
+                continue
             
-        with open(metadata_file, "r") as f:
-            try:
-                metadata = json.load(f)
-                
-                # Filter by tag if specified
-                if tag and ('tags' not in metadata or tag not in metadata['tags']):
+            # Add base64 encoded image data to metadata
+            metadata['imageData'] = base64.b64encode(image_data).decode('utf-8')
+            metadata['mimeType'] = sniff_mime_type(image_data[:16])
+        except Exception as e:
+            print(f"Error reading image {metadata['id']}: {e}")
+            continue
+
+def rebuild_catalog():
+    """
+    Rebuild the listing catalog from the metadata files already on disk
+    
+    Returns:
+        int: Number of images indexed
+    """
+    return catalog.rebuild()
+
+def _move_no_clobber(source, target):
+    """
+    Move source to target unless target already exists
+    
+    A link never replaces an existing file, so a newer copy written to the
+    sharded layout meanwhile always wins over the legacy one.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        return False
+    source.unlink(missing_ok=True)
+    return True
+
+def migrate_layout(batch_size=500, pause=0.0, progress=None):
+    """
+    Move images, metadata and thumbnails from the flat layout to the sharded one
+    
+    Safe to run while the app is serving: reads fall back to the flat layout
+    until a file has moved, and the migration can be interrupted and resumed.
+    
+    Args:
+        batch_size: Files moved between pauses
+        pause: Seconds to sleep after each batch to limit I/O pressure
+        progress: Optional callable receiving the running counts after each batch
+        
+    Returns:
+        dict: Number of files moved per kind
+        
+    Raises:
+        ValueError: If images are not stored locally
+    """
+    if backend.remote:
+        raise ValueError("The flat layout only exists in local storage")
+    
+    counts = {"images": 0, "metadata": 0, "thumbnails": 0}
+    sources = [("images", IMAGES_DIR, ".jpg"), ("metadata", METADATA_DIR, ".json")]
+    for size in THUMBNAIL_SIZES:
+        sources.append(("thumbnails", THUMBNAILS_DIR / size, ".jpg"))
+    
+    in_batch = 0
+    for kind, directory, suffix in sources:
+        if not directory.is_dir():
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith(".") or not entry.name.endswith(suffix):
                     continue
-                    
-                # Get the corresponding image file
-                image_id = metadata.get('id')
-                if image_id:
-                    image_path = IMAGES_DIR / f"{image_id}.jpg"
-                    if image_path.exists():
-                        # Read image data
-                        with open(image_path, "rb") as img_file:
-                            image_data = img_file.read()
-                        
-                        # Add base64 encoded image data to metadata
-                        metadata['imageData'] = base64.b64encode(image_data).decode('utf-8')
-                
-                # Add to results
-                result.append(metadata)
-            except Exception as e:
-                print(f"Error processing metadata file {metadata_file}: {e}")
-                continue
+                image_id = entry.name[:-len(suffix)]
+                source = Path(entry.path)
+                target = _shard_dir(directory, image_id) / entry.name
+                if _move_no_clobber(source, target):
+                    counts[kind] += 1
+                    in_batch += 1
+                if in_batch >= batch_size:
+                    in_batch = 0
+                    if progress:
+                        progress(dict(counts))
+                    if pause:
+                        time.sleep(pause)
+    
+    if progress:
+        progress(dict(counts))
+    return counts
+
+def gc_blobs(min_age=3600, dry_run=False):
+    """
+    Delete blobs that no image refers to any more
+    
+    Args:
+        min_age: Only consider blobs older than this many seconds, so blobs
+            that are about to be linked by an in-progress save survive
+        dry_run: Only count what would be removed
+        
+    Returns:
+        dict: Blob counts and the bytes reclaimed
+        
+    Raises:
+        ValueError: If images are not stored locally, since only local storage deduplicates
+    """
+    if backend.remote:
+        raise ValueError("Blobs only exist in local storage")
+    return backend.gc_blobs(min_age=min_age, dry_run=dry_run)
+
+def transcode_images(progress=None):
+    """
+    Write renditions for stored images that do not have one yet
+    
+    Args:
+        progress: Optional callable receiving the running counts every 100 images
+        
+    Returns:
+        dict: Images checked, renditions written and bytes saved
+        
+    Raises:
+        ValueError: If transcoding is disabled
+    """
+    if TRANSCODE_FORMAT is None:
+        raise ValueError("Transcoding is disabled; set STORAGE_TRANSCODE to webp or avif")
+    
+    counts = {"images": 0, "transcoded": 0, "bytes_saved": 0}
+    for key in backend.iter_keys("images/"):
+        image_id = key.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        counts["images"] += 1
+        try:
+            saved = _transcode_image(image_id)
+        except Exception as e:
+            print(f"Error transcoding image {image_id}: {e}")
+            continue
+        if saved:
+            counts["transcoded"] += 1
+            counts["bytes_saved"] += saved
+        if progress and counts["images"] % 100 == 0:
+            progress(dict(counts))
+    
+    if progress:
+        progress(dict(counts))
+    return counts
+
+def prune_originals(max_age_days=STORAGE_ORIGINAL_RETENTION_DAYS, dry_run=False):
+    """
+    Remove originals that have a smaller rendition and are past the retention period
+    
+    Locally, removed originals stop counting as blob references; run
+    gc_blobs afterwards to reclaim the space.
+    
+    Args:
+        max_age_days: Remove originals older than this many days
+        dry_run: Only count what would be removed
+        
+    Returns:
+        dict: Originals with a rendition, how many were removed and their size
+        
+    Raises:
+        ValueError: If no retention period is set
+    """
+    if max_age_days is None:
+        raise ValueError("No retention period set; originals are kept forever")
     
-    return result
\ No newline at end of file
+    result = {"originals": 0, "removed": 0, "bytes": 0}
+    cutoff = time.time() - max_age_days * 86400
+    seen = set()
+    for key in backend.iter_keys("renditions/"):
+        image_id = key.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        if image_id in seen:
+            continue
+        seen.add(image_id)
+        for original_key in _image_keys(image_id):
+            stat = backend.stat(original_key)
+            if stat is not None:
+                break
+        else:
+            continue
+        result["originals"] += 1
+        size, mtime_ns = stat
+        if mtime_ns / 1e9 > cutoff:
+            continue
+        if not dry_run:
+            _remove_original(image_id)
+        result["removed"] += 1
+        result["bytes"] += size
+    return result
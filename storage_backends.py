@@ -0,0 +1,568 @@
+import os
+import json
+import uuid
+import hashlib
+import shutil
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+
+# Where images and metadata live: local (a directory) or s3 (any S3-compatible service)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local").lower()
+
+# fsync files before renaming them into place, so a crash never leaves a torn file
+STORAGE_FSYNC = os.environ.get("STORAGE_FSYNC", "true").lower() == "true"
+
+# S3 settings; S3_ENDPOINT_URL points at MinIO or another S3-compatible service
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+S3_REGION = os.environ.get("S3_REGION")
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 32))
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+S3_PRESIGN_EXPIRES = int(os.environ.get("S3_PRESIGN_EXPIRES", 3600))
+
+# Seconds of clock skew between instances tolerated when reading the catalog journal
+JOURNAL_SKEW = float(os.environ.get("CATALOG_JOURNAL_SKEW", 60))
+
+# Journal entries older than this many seconds are folded into the snapshot and deleted
+JOURNAL_RETENTION = float(os.environ.get("CATALOG_JOURNAL_RETENTION", 24 * 3600))
+
+class LocalBackend:
+    """
+    Files under a local directory, addressed by '/'-separated keys
+
+    Images can be deduplicated: their content is stored once under
+    blobs/ab/cd/<sha256> and each key is a hard link to it, so a blob's
+    reference count is its link count minus one.
+    """
+
+    remote = False
+
+    def __init__(self, root, fsync=STORAGE_FSYNC):
+        """
+        Initialize the backend
+
+        Args:
+            root: Directory holding all files
+            fsync: Whether files are fsynced before being renamed into place
+        """
+        self.root = Path(root)
+        self.blobs_dir = self.root / "blobs"
+        self.fsync = fsync
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.blobs_dir.mkdir(exist_ok=True)
+
+    def local_path(self, key):
+        """Path of the file behind a key"""
+        return self.root / key
+
+    def read(self, key):
+        """Return the bytes stored under key, or None if there are none"""
+        try:
+            with open(self.root / key, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def stat(self, key):
+        """
+        Return the size and modification time of a key
+
+        Returns:
+            tuple: (size in bytes, mtime in nanoseconds), or None if the key does not exist
+        """
+        try:
+            stat = (self.root / key).stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def exists(self, key):
+        return (self.root / key).is_file()
+
+    def write(self, key, data, content_type=None, dedupe=False):
+        """
+        Store data under key, replacing it atomically
+
+        Args:
+            key: Where to store the data
+            data: Bytes, or a binary file object positioned at the start
+            content_type: Unused; kept for parity with S3Backend
+            dedupe: Store the content once in the blob store and link key to it
+        """
+        if dedupe:
+            self._store_deduplicated(self.root / key, data)
+        else:
+            self._atomic_write(self.root / key, data)
+
+    def delete(self, key):
+        (self.root / key).unlink(missing_ok=True)
+
+    def iter_keys(self, prefix, start_after=None):
+        """
+        Yield the keys under a directory prefix in sorted order
+
+        Args:
+            prefix: Key prefix ending in '/'
+            start_after: Only yield keys sorting after this one
+        """
+        top = self.root / prefix
+        for directory, subdirs, files in os.walk(top):
+            subdirs.sort()
+            relative = Path(directory).relative_to(self.root).as_posix()
+            for name in sorted(files):
+                key = f"{relative}/{name}"
+                if name.startswith(".") or (start_after and key <= start_after):
+                    continue
+                yield key
+
+    def url(self, key, content_type=None, expires=None):
+        """Local files are served by the app itself, so there is no URL"""
+        return None
+
+    def _atomic_write(self, path, data):
+        """
+        Write a file via a temp file and rename so readers never see a partial file
+
+        Args:
+            path: The destination path
+            data: Bytes, or a binary file object to copy in chunks
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            with open(temp_path, "wb") as f:
+                if isinstance(data, (bytes, bytearray)):
+                    f.write(data)
+                else:
+                    shutil.copyfileobj(data, f, 1024 * 1024)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    def _blob_file(self, digest):
+        return self.blobs_dir / digest[:2] / digest[2:4] / digest
+
+    def _store_blob(self, data):
+        """
+        Store content once, under its SHA-256
+
+        Args:
+            data: Bytes, or a binary file object positioned at the start
+
+        Returns:
+            Path: The blob file, shared by every key with the same content
+        """
+        digest = hashlib.sha256()
+        if isinstance(data, (bytes, bytearray)):
+            digest.update(data)
+            blob_path = self._blob_file(digest.hexdigest())
+            if not blob_path.is_file():
+                self._atomic_write(blob_path, data)
+            return blob_path
+
+        # Hash while copying, since the name is only known once all bytes are seen
+        temp_path = self.blobs_dir / f".{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in iter(lambda: data.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            blob_path = self._blob_file(digest.hexdigest())
+            if blob_path.is_file():
+                temp_path.unlink()
+            else:
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(temp_path, blob_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        return blob_path
+
+    def _link_blob(self, blob_path, path):
+        """Point path at a blob with a hard link, copying where links are unsupported"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            os.link(blob_path, temp_path)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(blob_path, temp_path)
+        os.replace(temp_path, path)
+
+    def _store_deduplicated(self, path, data):
+        """Write a file as a link to its content-addressed blob"""
+        for attempt in range(2):
+            if not isinstance(data, (bytes, bytearray)):
+                data.seek(0)
+            blob_path = self._store_blob(data)
+            try:
+                self._link_blob(blob_path, path)
+                return
+            except FileNotFoundError:
+                # gc_blobs removed the blob between the two steps; store it again
+                if attempt:
+                    raise
+
+    def gc_blobs(self, min_age=3600, dry_run=False):
+        """
+        Delete blobs that no key refers to any more
+
+        Args:
+            min_age: Only consider blobs older than this many seconds, so blobs
+                that are about to be linked by an in-progress save survive
+            dry_run: Only count what would be removed
+
+        Returns:
+            dict: Blob counts and the bytes reclaimed
+        """
+        result = {"blobs": 0, "referenced": 0, "removed": 0, "bytes_freed": 0}
+        now = time.time()
+        for directory, _, files in os.walk(self.blobs_dir):
+            for name in files:
+                path = Path(directory) / name
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                if name.startswith("."):
+                    # Temp file left behind by an interrupted write
+                    if now - stat.st_mtime > min_age and not dry_run:
+                        path.unlink(missing_ok=True)
+                    continue
+                result["blobs"] += 1
+                if stat.st_nlink > 1 or now - stat.st_mtime <= min_age:
+                    result["referenced"] += 1
+                    continue
+                if not dry_run:
+                    path.unlink(missing_ok=True)
+                result["removed"] += 1
+                result["bytes_freed"] += stat.st_size
+        return result
+
+class S3Backend:
+    """
+    Objects in an S3-compatible bucket, addressed by the same keys as LocalBackend
+
+    Content is not deduplicated. Large uploads are split into multipart
+    uploads, and reads can be handed to clients as presigned URLs.
+    """
+
+    remote = True
+
+    def __init__(self, bucket, prefix=S3_PREFIX, endpoint_url=S3_ENDPOINT_URL, region=S3_REGION,
+                 max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                 multipart_threshold=S3_MULTIPART_THRESHOLD, presign_expires=S3_PRESIGN_EXPIRES):
+        """
+        Initialize the backend
+
+        Args:
+            bucket: Bucket name
+            prefix: Prefix put in front of every key, e.g. 'fashion-ai/'
+            endpoint_url: Endpoint of an S3-compatible service; None for AWS
+            region: Bucket region
+            max_pool_connections: Size of the HTTP connection pool
+            multipart_threshold: Uploads larger than this many bytes use multipart
+            presign_expires: Lifetime of presigned URLs in seconds
+
+        Raises:
+            ValueError: If boto3 is not installed
+        """
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise ValueError("STORAGE_BACKEND=s3 needs boto3 (pip install boto3)")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.presign_expires = presign_expires
+        self.boto3 = boto3
+        self.client_config = Config(
+            max_pool_connections=max_pool_connections,
+            retries={"max_attempts": 3, "mode": "standard"},
+            # MinIO and most stand-ins only support path-style addressing
+            s3={"addressing_style": "path" if endpoint_url else "auto"}
+        )
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            max_concurrency=4
+        )
+        self.lock = threading.Lock()
+        self._client = None
+        self.client_pid = None
+
+    @property
+    def client(self):
+        """This process's client; connection pools must not be shared across a fork"""
+        pid = os.getpid()
+        if self._client is None or self.client_pid != pid:
+            with self.lock:
+                if self._client is None or self.client_pid != pid:
+                    self._client = self.boto3.session.Session().client(
+                        "s3",
+                        endpoint_url=self.endpoint_url,
+                        region_name=self.region,
+                        config=self.client_config
+                    )
+                    self.client_pid = pid
+        return self._client
+
+    def _is_missing(self, error):
+        code = error.response.get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def local_path(self, key):
+        return None
+
+    def read(self, key):
+        """Return the bytes stored under key, or None if there are none"""
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return response["Body"].read()
+
+    def stat(self, key):
+        """
+        Return the size and modification time of a key
+
+        Returns:
+            tuple: (size in bytes, mtime in nanoseconds), or None if the key does not exist
+        """
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return response["ContentLength"], int(response["LastModified"].timestamp() * 1e9)
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def write(self, key, data, content_type=None, dedupe=False):
+        """
+        Upload data under key
+
+        Args:
+            key: Where to store the data
+            data: Bytes, or a binary file object positioned at the start
+            content_type: Content-Type stored with the object
+            dedupe: Ignored; objects are not deduplicated
+        """
+        extra_args = {"ContentType": content_type} if content_type else None
+        source = BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+        self.client.upload_fileobj(
+            source,
+            self.bucket,
+            self.prefix + key,
+            ExtraArgs=extra_args,
+            Config=self.transfer_config
+        )
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def iter_keys(self, prefix, start_after=None):
+        """
+        Yield the keys under a prefix in sorted order
+
+        Args:
+            prefix: Key prefix ending in '/'
+            start_after: Only yield keys sorting after this one
+        """
+        params = {"Bucket": self.bucket, "Prefix": self.prefix + prefix}
+        if start_after:
+            params["StartAfter"] = self.prefix + start_after
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(**params):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):]
+
+    def url(self, key, content_type=None, expires=None):
+        """Return a presigned GET URL for a key"""
+        params = {"Bucket": self.bucket, "Key": self.prefix + key}
+        if content_type:
+            params["ResponseContentType"] = content_type
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params=params,
+            ExpiresIn=expires or self.presign_expires
+        )
+
+class CatalogJournal:
+    """
+    Append-only log of metadata changes, shared by every instance through the backend
+
+    Each change is one object under journal/, named by the time it was made,
+    so an instance catches up by listing only the keys after the last one it
+    applied. Compaction folds every entry into a single snapshot object and
+    deletes the entries older than the retention period, so a new instance
+    reads one snapshot plus the recent entries instead of the whole history.
+    """
+
+    def __init__(self, backend, prefix="journal/", snapshot_key="journal-snapshot.json",
+                 skew=JOURNAL_SKEW, retention=JOURNAL_RETENTION):
+        """
+        Initialize the journal
+
+        Args:
+            backend: Storage backend holding the journal objects
+            prefix: Key prefix of journal objects
+            snapshot_key: Key of the compacted snapshot
+            skew: Seconds to re-read before the last applied entry, so entries
+                from instances with slightly slow clocks are not missed
+            retention: Seconds entries are kept after being written; an
+                instance that fell further behind restarts from the snapshot
+        """
+        self.backend = backend
+        self.prefix = prefix
+        self.snapshot_key = snapshot_key
+        self.skew = skew
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.recent = set()  # Keys applied within the skew window, not fetched again
+
+    def append(self, image_id, metadata, sort_ts):
+        """
+        Record new metadata for an image
+
+        Args:
+            image_id: The ID of the image
+            metadata: The full metadata dict, or None if the image was deleted
+            sort_ts: The image's listing sort key
+        """
+        key = f"{self.prefix}{time.time_ns():020d}-{image_id}.json"
+        entry = {"id": image_id, "metadata": metadata, "sortTs": sort_ts}
+        self.backend.write(key, json.dumps(entry).encode("utf-8"), content_type="application/json")
+
+    def _written_ns(self, key):
+        return int(key[len(self.prefix):].split("-", 1)[0])
+
+    def is_stale(self, synced_at):
+        """
+        Check whether entries a reader has not applied yet may have been compacted away
+
+        Args:
+            synced_at: Wall-clock time the reader last started a complete sync, or None
+
+        Returns:
+            bool: True if the reader must restart from the snapshot
+        """
+        return synced_at is None or synced_at < time.time() - self.retention + self.skew
+
+    def read_snapshot(self):
+        """
+        Read the compacted snapshot
+
+        Returns:
+            tuple: (position of the last entry it includes, list of entry dicts
+                for the images that exist), or (None, []) without a snapshot
+        """
+        data = self.backend.read(self.snapshot_key)
+        if data is None:
+            return None, []
+        snapshot = json.loads(data)
+        return snapshot["position"], snapshot["entries"]
+
+    def snapshot_age(self):
+        """Seconds since the snapshot was written, or None without one"""
+        stat = self.backend.stat(self.snapshot_key)
+        return None if stat is None else (time.time_ns() - stat[1]) / 1e9
+
+    def compact(self, position, entries):
+        """
+        Replace the snapshot and delete the entries it makes redundant
+
+        Args:
+            position: Key of the last entry reflected in entries
+            entries: Entry dicts for every image that exists, as of position
+
+        Returns:
+            int: Number of journal entries deleted
+        """
+        body = json.dumps({"position": position, "entries": entries}).encode("utf-8")
+        self.backend.write(self.snapshot_key, body, content_type="application/json")
+        # Keep the retention window, which instances still catching up may need
+        cutoff_ns = min(self._written_ns(position), time.time_ns() - int(self.retention * 1e9))
+        deleted = 0
+        for key in self.backend.iter_keys(self.prefix):
+            if self._written_ns(key) >= cutoff_ns:
+                break
+            self.backend.delete(key)
+            deleted += 1
+        return deleted
+
+    def entries(self, position=None):
+        """
+        Yield journal entries written after a position
+
+        Keys within the skew window before position are listed again, but
+        entries already yielded by this instance are not fetched twice.
+
+        Args:
+            position: Key of the last applied entry, or None to read from the start
+
+        Yields:
+            tuple: (key, entry dict)
+        """
+        start_after = None
+        if position:
+            written_ns = self._written_ns(position)
+            start_after = f"{self.prefix}{max(0, written_ns - int(self.skew * 1e9)):020d}"
+        with self.lock:
+            # A replay from the start fetches everything again
+            self.recent = {key for key in self.recent if start_after and key > start_after}
+        for key in self.backend.iter_keys(self.prefix, start_after=start_after):
+            with self.lock:
+                if key in self.recent:
+                    continue
+            data = self.backend.read(key)
+            if data is None:
+                continue
+            try:
+                entry = json.loads(data)
+            except ValueError:
+                print(f"Skipping unreadable journal entry {key}")
+                continue
+            with self.lock:
+                self.recent.add(key)
+            yield key, entry
+
+def create_backend(root):
+    """
+    Create the backend selected by STORAGE_BACKEND
+
+    Args:
+        root: Directory used by the local backend
+
+    Raises:
+        ValueError: If the backend is unknown or misconfigured
+    """
+    if STORAGE_BACKEND == "local":
+        return LocalBackend(root)
+    if STORAGE_BACKEND == "s3":
+        if not S3_BUCKET:
+            raise ValueError("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        print(f"Storing images in S3 bucket {S3_BUCKET} ({S3_ENDPOINT_URL or 'AWS'})")
+        return S3Backend(S3_BUCKET)
+    raise ValueError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}'")
@@ -0,0 +1,145 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+# Write-behind settings, overridable from the environment
+STORAGE_WRITE_BEHIND = os.environ.get('STORAGE_WRITE_BEHIND', 'true').lower() == 'true'
+STORAGE_WRITE_QUEUE_SIZE = int(os.environ.get('STORAGE_WRITE_QUEUE_SIZE', 64))
+# Retries of a failed background write, with exponential backoff from 0.5s;
+# the image stays readable from memory meanwhile
+STORAGE_WRITE_RETRIES = int(os.environ.get('STORAGE_WRITE_RETRIES', 3))
+
+# Writes that failed for good, remembered so reads can report them instead of a 404
+MAX_REMEMBERED_FAILURES = 1000
+
+class StorageWriter:
+    def __init__(self, write_fn, max_pending=STORAGE_WRITE_QUEUE_SIZE, enabled=STORAGE_WRITE_BEHIND,
+                 retries=STORAGE_WRITE_RETRIES):
+        """
+        Initialize the write-behind writer
+
+        Args:
+            write_fn: Callable(image_id, image_data, metadata) that persists one image
+            max_pending: Writes held in memory before callers must write themselves
+            enabled: Whether writes are deferred at all
+            retries: Further attempts at a write that raised
+        """
+        self.write_fn = write_fn
+        self.max_pending = max_pending
+        self.enabled = enabled
+        self.retries = retries
+        self.failures = OrderedDict()  # image_id -> error message, oldest first
+        self.condition = threading.Condition()
+        self.pending = {}  # image_id -> (image_data, metadata), in submission order
+        self.queue = queue.Queue()
+        self.thread = None
+        self.thread_pid = None
+        self.counters = {"queued": 0, "written": 0, "retried": 0, "failed": 0, "overflowed": 0}
+
+    def _ensure_thread(self):
+        """Start this process's writer thread, discarding state inherited through a fork"""
+        pid = os.getpid()
+        if self.thread is not None and self.thread_pid == pid:
+            return
+        with self.condition:
+            if self.thread is not None and self.thread_pid == pid:
+                return
+            if self.thread_pid != pid:
+                self.pending = {}
+                self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+            self.thread_pid = pid
+            self.thread.start()
+
+    def submit(self, image_id, image_data, metadata):
+        """
+        Queue an image to be written in the background
+
+        Returns:
+            bool: False if the caller must write the image itself, because
+                write-behind is disabled or the queue is full
+        """
+        if not self.enabled:
+            return False
+        self._ensure_thread()
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.counters["overflowed"] += 1
+                return False
+            self.pending[image_id] = (image_data, metadata)
+            self.counters["queued"] += 1
+        self.queue.put(image_id)
+        return True
+
+    def get(self, image_id):
+        """
+        Return a pending write
+
+        Returns:
+            tuple: (image bytes, metadata) or None if the image is not pending
+        """
+        with self.condition:
+            return self.pending.get(image_id)
+
+    def failure(self, image_id):
+        """
+        Return why a background write failed for good
+
+        Returns:
+            str: The last error, or None if the write did not fail in this process
+        """
+        with self.condition:
+            return self.failures.get(image_id)
+
+    def wait(self, image_id, timeout=None):
+        """Block until a pending image has been written; returns False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: image_id not in self.pending, timeout)
+
+    def flush(self, timeout=None):
+        """Block until every pending image has been written; returns False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending, timeout)
+
+    def _run(self):
+        while True:
+            image_id = self.queue.get()
+            with self.condition:
+                item = self.pending.get(image_id)
+            if item is None:
+                continue
+            error = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(0.5 * 2 ** (attempt - 1))
+                    with self.condition:
+                        self.counters["retried"] += 1
+                try:
+                    self.write_fn(image_id, *item)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    print(f"Error writing image {image_id} in the background "
+                          f"(attempt {attempt + 1}/{self.retries + 1}): {e}")
+            with self.condition:
+                del self.pending[image_id]
+                if error is None:
+                    self.counters["written"] += 1
+                else:
+                    self.counters["failed"] += 1
+                    self.failures[image_id] = str(error)
+                    while len(self.failures) > MAX_REMEMBERED_FAILURES:
+                        self.failures.popitem(last=False)
+                self.condition.notify_all()
+
+    def stats(self):
+        """Return queue depth and write counters"""
+        with self.condition:
+            stats = dict(self.counters)
+            stats["pending"] = len(self.pending)
+        stats["enabled"] = self.enabled
+        stats["max_pending"] = self.max_pending
+        return stats
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The backend modules live at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# storage creates its directories on import; keep them out of the working tree
+os.environ.setdefault("STORAGE_DIR", tempfile.mkdtemp(prefix="fashion-ai-tests-"))
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import admission
+from admission import CLOSED, HALF_OPEN, OPEN, AdmissionController, Overloaded
+
+def controller(**kwargs):
+    settings = dict(enabled=True, max_concurrency=2, queue_size=1, queue_timeout=0.2, reserve=1,
+                    window=30, min_calls=4, failure_rate=0.5, open_seconds=10)
+    settings.update(kwargs)
+    return AdmissionController(lambda percentile, min_samples: None, **settings)
+
+def outcomes(*names):
+    return [{"outcome": name} for name in names]
+
+def test_requests_beyond_slots_and_queue_are_rejected_with_429():
+    gate = controller()
+    with gate.admit(), gate.admit():
+        # The one queue place times out, since nothing leaves
+        with pytest.raises(Overloaded) as excinfo:
+            with gate.admit():
+                pass
+        assert excinfo.value.status_code == 429
+        assert gate.counters["rejected_timeout"] == 1
+    assert gate.active == 0
+
+def test_queue_full_is_rejected_immediately():
+    gate = controller(queue_timeout=5)
+    entered = threading.Event()
+
+    def waiter():
+        entered.set()
+        with gate.admit():
+            pass
+
+    with gate.admit(), gate.admit():
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        entered.wait()
+        while gate.waiting == 0:
+            time.sleep(0.01)
+        with pytest.raises(Overloaded):
+            with gate.admit():
+                pass
+        assert gate.counters["rejected_queue_full"] == 1
+    thread.join()
+    assert gate.counters["admitted"] == 3
+
+def test_background_requests_leave_the_reserve_to_interactive_ones():
+    gate = controller(max_concurrency=3, reserve=1)
+    with gate.admit(background=True), gate.admit(background=True):
+        with pytest.raises(Overloaded):
+            with gate.admit(background=True):
+                pass
+        with gate.admit():
+            assert gate.active == 3
+
+def test_circuit_opens_at_the_failure_rate_and_a_probe_closes_it(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    gate = controller()
+
+    gate.record(outcomes("success", "transient", "rate_limit"))
+    assert gate.state == CLOSED
+    gate.record(outcomes("transient"))
+    assert gate.state == OPEN
+
+    with pytest.raises(Overloaded) as excinfo:
+        with gate.admit():
+            pass
+    assert excinfo.value.status_code == 503
+
+    now[0] += 11
+    with gate.admit():
+        assert gate.state == HALF_OPEN
+        # Only the probe goes through while half open
+        with pytest.raises(Overloaded):
+            with gate.admit():
+                pass
+        gate.record(outcomes("success"))
+    assert gate.state == CLOSED
+
+def test_failed_probe_reopens_the_circuit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    gate = controller()
+    gate.record(outcomes("transient") * 4)
+
+    now[0] += 11
+    with gate.admit():
+        gate.record(outcomes("transient"))
+    assert gate.state == OPEN
+    assert gate.counters["circuit_opened"] == 2
+
+def test_fatal_outcomes_do_not_count_towards_the_circuit():
+    gate = controller()
+    gate.record(outcomes("fatal") * 10)
+    assert gate.state == CLOSED
+
+def test_disabled_controller_admits_everything():
+    gate = controller(enabled=False, max_concurrency=1)
+    with gate.admit(), gate.admit(), gate.admit():
+        pass
+
+def test_timed_out_and_cancelled_coroutines_leave_the_queue():
+    gate = controller(max_concurrency=1, reserve=0, queue_size=2, queue_timeout=0.1)
+
+    async def wait_for_slot():
+        async with gate.admit_async():
+            pass
+
+    async def main():
+        async with gate.admit_async():
+            with pytest.raises(Overloaded):
+                await wait_for_slot()
+            cancelled = asyncio.ensure_future(wait_for_slot())
+            await asyncio.sleep(0.02)
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            assert not gate.async_waiters
+            assert gate.waiting == 0
+        await wait_for_slot()
+
+    asyncio.run(main())
+    assert gate.active == 0
@@ -0,0 +1,146 @@
+import json
+import os
+
+import pytest
+
+from catalog import Catalog, decode_cursor, encode_cursor
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(tmp_path / "catalog.db", tmp_path / "metadata")
+    # Backfill the (empty) metadata directory before anything is indexed
+    catalog._ensure_backfilled()
+    return catalog
+
+def index(catalog, count, tags=None):
+    for i in range(count):
+        catalog.index_image({"id": f"img-{i:02d}", "tags": tags or []}, sort_ts=1000.0 + i)
+
+def ids(items):
+    return [item["id"] for item in items]
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(12.5, "abc")) == (12.5, "abc")
+
+def test_invalid_cursor_raises_value_error():
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+def test_pages_cover_every_image_once_newest_first(catalog):
+    index(catalog, 7)
+
+    seen = []
+    cursor = None
+    while True:
+        items, cursor = catalog.query(limit=3, cursor=cursor)
+        seen.extend(ids(items))
+        if cursor is None:
+            break
+
+    assert seen == [f"img-{i:02d}" for i in reversed(range(7))]
+
+def test_last_full_page_returns_cursor_to_empty_page(catalog):
+    index(catalog, 4)
+
+    items, cursor = catalog.query(limit=2)
+    items, cursor = catalog.query(limit=2, cursor=cursor)
+    assert ids(items) == ["img-01", "img-00"]
+    assert cursor is not None
+
+    items, cursor = catalog.query(limit=2, cursor=cursor)
+    assert items == [] and cursor is None
+
+def test_deletion_between_pages_does_not_skip_or_repeat(catalog):
+    index(catalog, 6)
+
+    first, cursor = catalog.query(limit=2)
+    assert ids(first) == ["img-05", "img-04"]
+
+    # One image already shown and one not yet shown disappear
+    catalog.remove_image("img-04")
+    catalog.remove_image("img-02")
+
+    rest = []
+    while cursor is not None:
+        items, cursor = catalog.query(limit=2, cursor=cursor)
+        rest.extend(ids(items))
+
+    assert rest == ["img-03", "img-01", "img-00"]
+
+def test_deleting_the_cursor_row_still_continues_after_it(catalog):
+    index(catalog, 5)
+
+    _, cursor = catalog.query(limit=2)
+    catalog.remove_image("img-03")
+
+    items, _ = catalog.query(limit=2, cursor=cursor)
+    assert ids(items) == ["img-02", "img-01"]
+
+def test_images_with_equal_sort_keys_are_ordered_by_id(catalog):
+    for image_id in ("b", "a", "c"):
+        catalog.index_image({"id": image_id}, sort_ts=5.0)
+
+    first, cursor = catalog.query(limit=2)
+    second, cursor = catalog.query(limit=2, cursor=cursor)
+
+    assert ids(first) + ids(second) == ["c", "b", "a"]
+    assert cursor is None
+
+def test_tag_pages(catalog):
+    index(catalog, 3, tags=["dress"])
+    catalog.index_image({"id": "other", "tags": "shoes"}, sort_ts=2000.0)
+
+    first, cursor = catalog.query(limit=2, tag="dress")
+    second, cursor = catalog.query(limit=2, tag="dress", cursor=cursor)
+
+    assert ids(first) + ids(second) == ["img-02", "img-01", "img-00"]
+    assert cursor is None
+    assert ids(catalog.query(tag="shoes")[0]) == ["other"]
+
+def test_reindexing_an_image_replaces_its_tags(catalog):
+    catalog.index_image({"id": "a", "tags": ["old"]}, sort_ts=1.0)
+    catalog.index_image({"id": "a", "tags": ["new"]}, sort_ts=1.0)
+
+    assert catalog.query(tag="old")[0] == []
+    assert ids(catalog.query(tag="new")[0]) == ["a"]
+
+def write_metadata(metadata_dir, count):
+    metadata_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        path = metadata_dir / f"img-{i:02d}.json"
+        path.write_text(json.dumps({"id": f"img-{i:02d}", "tags": ["even"] if i % 2 == 0 else []}))
+        os.utime(path, (1000.0 + i, 1000.0 + i))
+
+def all_pages(catalog, **kwargs):
+    seen, cursor = [], None
+    while True:
+        items, cursor = catalog.query(limit=2, cursor=cursor, **kwargs)
+        seen.extend(ids(items))
+        if cursor is None:
+            return seen
+
+def test_listings_scan_metadata_files_until_the_backfill_is_done(tmp_path, monkeypatch):
+    write_metadata(tmp_path / "metadata", 5)
+    catalog = Catalog(tmp_path / "catalog.db", tmp_path / "metadata")
+    monkeypatch.setattr(catalog, "start", lambda: None)  # Keep the backfill from running
+
+    scanned = all_pages(catalog)
+    scanned_tag = all_pages(catalog, tag="even")
+    assert scanned == ["img-04", "img-03", "img-02", "img-01", "img-00"]
+    assert scanned_tag == ["img-04", "img-02", "img-00"]
+
+    catalog._ensure_backfilled()
+    assert all_pages(catalog) == scanned
+    assert all_pages(catalog, tag="even") == scanned_tag
+
+def test_saving_does_not_backfill_on_the_request_path(tmp_path, monkeypatch):
+    write_metadata(tmp_path / "metadata", 3)
+    catalog = Catalog(tmp_path / "catalog.db", tmp_path / "metadata")
+    started = []
+    monkeypatch.setattr(catalog, "start", lambda: started.append(True))
+    monkeypatch.setattr(catalog, "rebuild", lambda: pytest.fail("rebuild ran on the request path"))
+
+    catalog.index_image({"id": "new"}, sort_ts=2000.0)
+
+    assert started
+    assert not catalog._is_backfilled()
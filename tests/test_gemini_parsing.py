@@ -0,0 +1,113 @@
+import base64
+import json
+
+import pytest
+
+from gemini_client import (
+    InlineDataExtractor, MalformedResponseError, _parse_body, parse_response, parse_response_stream
+)
+
+IMAGE = bytes(range(256)) * 3 + b"tail"
+
+def response_body(image=IMAGE, escape_slashes=False):
+    body = json.dumps({
+        "candidates": [{
+            "content": {"parts": [
+                {"text": "Here is \"your\" image \\ done"},
+                {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(image).decode()}}
+            ]},
+            "finishReason": "STOP"
+        }],
+        "usageMetadata": {"totalTokenCount": 12}
+    })
+    if escape_slashes:
+        body = body.replace("/", "\\/")
+    return body.encode()
+
+def parse_split(body, *offsets):
+    extractor = InlineDataExtractor()
+    start = 0
+    for offset in list(offsets) + [len(body)]:
+        extractor.feed(body[start:offset])
+        start = offset
+    return extractor.result()
+
+def assert_same(result, expected):
+    assert result.text == expected.text
+    assert result.image_bytes == expected.image_bytes
+    assert result.mime_type == expected.mime_type
+    assert result.finish_reason == expected.finish_reason
+
+@pytest.mark.parametrize("escape_slashes", [False, True])
+def test_every_single_split_matches_parse_response(escape_slashes):
+    body = response_body(escape_slashes=escape_slashes)
+    expected = parse_response(json.loads(body))
+    assert expected.image_bytes == IMAGE
+
+    for offset in range(len(body) + 1):
+        assert_same(parse_split(body, offset), expected)
+
+def test_byte_by_byte_chunks():
+    body = response_body()
+    result = parse_response_stream(body[i:i + 1] for i in range(len(body)))
+    assert_same(result, parse_response(json.loads(body)))
+
+def test_splits_around_the_data_key_and_escapes():
+    body = response_body(escape_slashes=True)
+    expected = parse_response(json.loads(body))
+    interesting = [body.index(b'"data"'), body.index(b'\\/'), body.index(b'\\"')]
+    for position in interesting:
+        for offset in range(position - 3, position + 4):
+            for second in (offset + 1, offset + 2, offset + 5):
+                assert_same(parse_split(body, offset, second), expected)
+
+def test_wrapped_base64_lines():
+    encoded = base64.encodebytes(IMAGE).decode().replace("\n", "\\n")
+    body = ('{"candidates":[{"content":{"parts":[{"inlineData":'
+            '{"mimeType":"image/jpeg","data":"' + encoded + '"}}]}}]}').encode()
+
+    for offset in range(0, len(body), 7):
+        assert parse_split(body, offset).image_bytes == IMAGE
+
+def test_data_outside_inline_data_is_left_alone():
+    body = json.dumps({"candidates": [{"content": {"parts": [
+        {"text": "x", "data": "not base64 !"},
+        {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(b"img").decode()}}
+    ]}}]}).encode()
+
+    result = parse_split(body, 40)
+    assert result.text == "x"
+    assert result.image_bytes == b"img"
+
+def test_truncated_body_is_malformed():
+    body = response_body()
+    for cut in (10, body.index(b'"data"') + 20, len(body) - 1):
+        with pytest.raises(MalformedResponseError):
+            _parse_body([body[:cut]])
+
+def test_invalid_base64_is_malformed():
+    body = (b'{"candidates":[{"content":{"parts":[{"inlineData":'
+            b'{"mimeType":"image/png","data":"ab$d"}}]}}]}')
+    with pytest.raises(MalformedResponseError):
+        _parse_body([body])
+
+def test_empty_inline_data_is_no_image():
+    body = json.dumps({"candidates": [{"content": {"parts": [
+        {"inlineData": {"mimeType": "image/png", "data": ""}},
+        {"text": "sorry"}
+    ]}}]}).encode()
+
+    for result in (parse_response(json.loads(body)), parse_split(body, 30)):
+        assert result.image_bytes is None
+        assert result.mime_type is None
+        assert result.text == "sorry"
+
+def test_image_after_an_empty_inline_data_part_is_used():
+    body = json.dumps({"candidates": [{"content": {"parts": [
+        {"inlineData": {"mimeType": "image/png", "data": ""}},
+        {"inlineData": {"mimeType": "image/webp", "data": base64.b64encode(b"img").decode()}}
+    ]}}]}).encode()
+
+    result = parse_split(body)
+    assert result.image_bytes == b"img"
+    assert result.mime_type == "image/webp"
@@ -0,0 +1,29 @@
+from image_cache import ImageCache
+
+def test_read_that_raced_an_invalidation_is_not_cached(tmp_path):
+    cache = ImageCache(tmp_path / "invalidations", enabled=True)
+    generation = cache.generation("a")
+    cache.invalidate("a")  # e.g. a metadata update lands while "a" is being read
+
+    cache.put("a", "old", {"v": 1}, generation)
+    assert cache.get("a") is None
+
+    cache.put("a", "new", {"v": 2}, cache.generation("a"))
+    assert cache.get("a") == ("new", {"v": 2})
+
+def test_invalidation_by_another_worker_also_counts(tmp_path):
+    reader = ImageCache(tmp_path / "invalidations", enabled=True)
+    writer = ImageCache(tmp_path / "invalidations", enabled=True)
+    generation = reader.generation("a")
+    writer.invalidate("a")
+
+    reader.put("a", "old", None, generation)
+    assert reader.get("a") is None
+
+def test_other_images_are_unaffected(tmp_path):
+    cache = ImageCache(tmp_path / "invalidations", enabled=True)
+    generation = cache.generation("a")
+    cache.invalidate("b")
+
+    cache.put("a", "data", None, generation)
+    assert cache.get("a") == ("data", None)
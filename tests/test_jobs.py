@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+import time
+
+from jobs import FAILED, RUNNING, SUCCEEDED, JobManager
+
+def read_record(manager, job_id):
+    with open(manager._job_path(job_id)) as f:
+        return json.load(f)
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_heartbeat_never_overwrites_a_finished_job(tmp_path, monkeypatch):
+    manager = JobManager(tmp_path, heartbeat_interval=0.01)
+    heartbeat_writing = threading.Event()
+    persist = manager._persist
+
+    def slow_persist(job):
+        # Hold a heartbeat write of the running job while the job finishes
+        if job["status"] == RUNNING and threading.current_thread().name == "job-heartbeat":
+            heartbeat_writing.set()
+            time.sleep(0.2)
+        persist(job)
+
+    monkeypatch.setattr(manager, "_persist", slow_persist)
+
+    def fn():
+        heartbeat_writing.wait(5)
+        return {"imageId": "abc"}, 200
+
+    job = manager.submit("generate", fn)
+    wait_for(lambda: manager.get(job["id"])["status"] == SUCCEEDED)
+    time.sleep(0.3)  # Let any delayed heartbeat write land
+
+    assert read_record(manager, job["id"])["status"] == SUCCEEDED
+
+def test_unfinished_job_of_a_dead_process_is_reported_failed(tmp_path):
+    manager = JobManager(tmp_path)
+    record = {
+        "id": "a" * 32, "type": "generate", "status": RUNNING, "ownerHost": manager.host,
+        "ownerPid": 2 ** 22 + 1, "createdAt": time.time(), "updatedAt": time.time(),
+        "heartbeatAt": time.time(), "version": 1, "result": None, "error": None
+    }
+    manager._persist(record)
+
+    job = manager.get(record["id"])
+    assert job["status"] == FAILED
+    assert job["version"] == 2
+    assert read_record(manager, record["id"])["status"] == FAILED
+
+def test_stale_heartbeat_is_reported_failed(tmp_path):
+    manager = JobManager(tmp_path, stale_after=60)
+    record = {
+        "id": "b" * 32, "type": "edit", "status": RUNNING, "ownerHost": "another-host",
+        "ownerPid": os.getpid(), "createdAt": 0, "updatedAt": 0,
+        "heartbeatAt": time.time() - 61, "version": 1, "result": None, "error": None
+    }
+    manager._persist(record)
+    assert manager.get(record["id"])["status"] == FAILED
+
+def test_malformed_job_ids_are_rejected(tmp_path):
+    manager = JobManager(tmp_path)
+    (tmp_path / ".json").write_text("{}")
+    for job_id in ("", "../secret", "A" * 32, "a" * 31):
+        assert manager.get(job_id) is None
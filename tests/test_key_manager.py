@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+import key_manager
+from key_manager import (
+    BASE_COOLDOWN_SECONDS, KeyManager, NoKeysAvailable, SharedKeyManager, create_key_manager
+)
+
+KEYS = ["key-a", "key-b", "key-c"]
+
+def test_selection_spreads_requests_over_keys():
+    manager = KeyManager(KEYS)
+    picked = [manager.get_key() for _ in range(6)]
+    assert sorted(picked) == sorted(KEYS * 2)
+
+def test_exclude_is_respected_while_other_keys_have_budget():
+    manager = KeyManager(KEYS)
+    assert manager.get_key(exclude={"key-a", "key-b"}) == "key-c"
+
+def test_rate_limited_key_is_skipped_until_its_cooldown_ends(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(key_manager.time, "time", lambda: now[0])
+    manager = KeyManager(KEYS)
+
+    manager.mark_rate_limited("key-a", retry_after=30)
+    picked = {manager.get_key() for _ in range(4)}
+    assert "key-a" not in picked
+
+    now[0] += 31
+    assert manager.get_key(exclude={"key-b", "key-c"}) == "key-a"
+
+def test_rotation_under_repeated_429s(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(key_manager.time, "time", lambda: now[0])
+    manager = KeyManager(KEYS)
+
+    tried = []
+    for _ in range(len(KEYS)):
+        key = manager.get_key(exclude=tried)
+        tried.append(key)
+        manager.mark_rate_limited(key)
+    assert sorted(tried) == sorted(KEYS)
+
+    assert manager.get_key(exclude=tried, require_ready=True) is None
+
+def test_all_keys_cooling_falls_back_to_the_soonest_ready(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(key_manager.time, "time", lambda: now[0])
+    manager = KeyManager(KEYS)
+    for key, retry_after in zip(KEYS, (30, 5, 60)):
+        manager.mark_rate_limited(key, retry_after=retry_after)
+
+    assert manager.get_key(require_ready=True) is None
+    assert manager.get_key() == "key-b"
+
+def test_cooldown_grows_with_consecutive_rate_limits(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(key_manager.time, "time", lambda: now[0])
+    manager = KeyManager(["key-a"])
+
+    manager.mark_rate_limited("key-a")
+    assert manager.states["key-a"].cooldown_until == now[0] + BASE_COOLDOWN_SECONDS
+
+    now[0] += BASE_COOLDOWN_SECONDS
+    manager.mark_rate_limited("key-a")
+    assert manager.states["key-a"].cooldown_until == now[0] + 2 * BASE_COOLDOWN_SECONDS
+
+def test_minute_budget_is_spent_per_selection(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(key_manager.time, "time", lambda: now[0])
+    manager = KeyManager(["key-a", "key-b"], rpm=2)
+
+    for _ in range(4):
+        manager.get_key()
+    assert manager.get_key(require_ready=True) is None
+
+    now[0] += 30  # One token per key per 30 seconds at 2 rpm
+    assert manager.get_key(require_ready=True) in ("key-a", "key-b")
+
+def test_no_keys_raises():
+    with pytest.raises(NoKeysAvailable):
+        KeyManager([]).get_key()
+
+def test_shared_manager_rotates_away_from_rate_limited_key(tmp_path):
+    manager = SharedKeyManager(KEYS, db_path=tmp_path / "keys.db")
+    first = manager.get_key()
+    manager.mark_rate_limited(first, retry_after=60)
+
+    other = SharedKeyManager(KEYS, db_path=tmp_path / "keys.db")
+    assert first not in {other.get_key() for _ in range(4)}
+
+def test_auto_backend_uses_memory_for_a_single_process(tmp_path, monkeypatch):
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    assert isinstance(create_key_manager(KEYS, tmp_path / "keys.db", backend="auto"), KeyManager)
+
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    assert isinstance(create_key_manager(KEYS, tmp_path / "keys.db", backend="auto"), SharedKeyManager)
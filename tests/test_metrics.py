@@ -0,0 +1,42 @@
+import json
+import os
+
+import metrics as metrics_module
+from metrics import MERGED_FILE, Metrics
+
+def requests_total(registry):
+    for line in registry.render().splitlines():
+        if line.startswith("fashion_ai_http_requests_total"):
+            return int(line.rsplit(" ", 1)[1])
+    return 0
+
+def write_snapshot(directory, pid, value, **fields):
+    snapshot = {"host": Metrics(directory).host, "counters": [["http_requests_total", [], value]],
+                "histograms": [], **fields}
+    (directory / f"{pid}.json").write_text(json.dumps(snapshot))
+
+def test_snapshot_left_under_this_pid_is_merged_before_it_is_overwritten(tmp_path):
+    write_snapshot(tmp_path, os.getpid(), 5, token="earlier-process")
+    registry = Metrics(tmp_path, enabled=True)
+    registry.inc("http_requests_total")
+
+    assert requests_total(registry) == 6
+    assert (tmp_path / MERGED_FILE).exists()
+
+def test_live_pid_with_another_start_time_is_merged(tmp_path, monkeypatch):
+    pid = os.getppid()
+    write_snapshot(tmp_path, pid, 3, token="exited-worker", started=1)
+    monkeypatch.setattr(metrics_module, "_process_start", lambda p: 2 if p == pid else None)
+
+    registry = Metrics(tmp_path, enabled=True)
+    assert requests_total(registry) == 3
+    assert not (tmp_path / f"{pid}.json").exists()
+
+def test_live_worker_snapshot_is_left_in_place(tmp_path, monkeypatch):
+    pid = os.getppid()
+    write_snapshot(tmp_path, pid, 3, token="live-worker", started=1)
+    monkeypatch.setattr(metrics_module, "_process_start", lambda p: 1 if p == pid else None)
+
+    registry = Metrics(tmp_path, enabled=True)
+    assert requests_total(registry) == 3
+    assert (tmp_path / f"{pid}.json").exists()
@@ -0,0 +1,141 @@
+import time
+
+import pytest
+import requests
+
+import retry_policy
+from gemini_client import GeminiAPIError, GeminiResult, MalformedResponseError
+from key_manager import KeyManager
+from retry_policy import (
+    FATAL, KEY_ERROR, RATE_LIMIT, TRANSIENT, RetryError, RetryPolicy, classify_api_error,
+    server_retry_delay
+)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(retry_policy, "backoff_delay", lambda attempt: 0)
+
+class FakeUpstream:
+    """A send callable answering with the queued replies, one per call"""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.keys = []
+
+    def __call__(self, api_key, timeout):
+        self.keys.append(api_key)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+def image():
+    return GeminiResult(image_bytes=b"png", mime_type="image/png")
+
+def rate_limited(retry_delay=None):
+    details = []
+    if retry_delay:
+        details.append({"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": retry_delay})
+    return GeminiAPIError("Quota exceeded", 429, status="RESOURCE_EXHAUSTED", details=details)
+
+def run(policy, send):
+    retry_info = policy.new_retry_info()
+    return policy.run(send, retry_info), retry_info
+
+@pytest.mark.parametrize("error, expected", [
+    (GeminiAPIError("bad", 400, status="INVALID_ARGUMENT"), FATAL),
+    (GeminiAPIError("bad key", 400, status="INVALID_ARGUMENT",
+                    details=[{"reason": "API_KEY_INVALID"}]), KEY_ERROR),
+    (rate_limited(), RATE_LIMIT),
+    (GeminiAPIError("slow down", 429), RATE_LIMIT),
+    (GeminiAPIError("down", 503, status="UNAVAILABLE"), TRANSIENT),
+    (GeminiAPIError("odd", 599), TRANSIENT),
+    (GeminiAPIError("gone", 410), FATAL),
+])
+def test_classify_api_error(error, expected):
+    assert classify_api_error(error) == expected
+
+def test_server_retry_delay_from_retry_info_and_header():
+    assert server_retry_delay(rate_limited("12s")) == 12.0
+    assert server_retry_delay(GeminiAPIError("x", 429, headers={"Retry-After": "3"})) == 3.0
+    assert server_retry_delay(GeminiAPIError("x", 429)) is None
+
+def test_bad_request_fails_without_retrying():
+    policy = RetryPolicy(KeyManager(["key-a", "key-b"]), max_attempts=3)
+    send = FakeUpstream(GeminiAPIError("Invalid image", 400, status="INVALID_ARGUMENT"), image())
+
+    with pytest.raises(RetryError) as excinfo:
+        run(policy, send)
+
+    assert excinfo.value.status_code == 400
+    assert len(send.keys) == 1
+
+def test_rate_limit_rotates_to_another_key_and_cools_the_first_down():
+    key_manager = KeyManager(["key-a", "key-b"])
+    policy = RetryPolicy(key_manager, max_attempts=3)
+    send = FakeUpstream(rate_limited("30s"), image())
+
+    result, retry_info = run(policy, send)
+
+    assert result.image_bytes == b"png"
+    first, second = send.keys
+    assert first != second
+    assert [outcome["outcome"] for outcome in retry_info["outcomes"]] == [RATE_LIMIT, "success"]
+    assert key_manager.states[first].cooldown_until >= time.time() + 25
+
+@pytest.mark.parametrize("error", [
+    requests.ConnectionError("Connection reset by peer"),
+    requests.Timeout("Read timed out"),
+    MalformedResponseError("Malformed response from API: truncated"),
+])
+def test_connection_errors_and_malformed_bodies_are_retried(error):
+    policy = RetryPolicy(KeyManager(["key-a", "key-b"]), max_attempts=3)
+    send = FakeUpstream(error, image())
+
+    result, retry_info = run(policy, send)
+
+    assert result.image_bytes == b"png"
+    assert retry_info["attempts"] == 2
+    assert retry_info["outcomes"][0]["outcome"] == TRANSIENT
+    assert retry_info["outcomes"][0]["status"] == 502
+
+def test_transient_errors_give_up_after_max_attempts():
+    policy = RetryPolicy(KeyManager(["key-a"]), max_attempts=3)
+    send = FakeUpstream(*[requests.ConnectionError("refused")] * 3)
+
+    with pytest.raises(RetryError) as excinfo:
+        run(policy, send)
+
+    assert excinfo.value.status_code == 502
+    assert len(send.keys) == 3
+
+def test_missing_image_is_retried_but_blocked_prompt_is_not():
+    policy = RetryPolicy(KeyManager(["key-a"]), max_attempts=3)
+    assert run(policy, FakeUpstream(GeminiResult(text="no image"), image()))[0].image_bytes == b"png"
+
+    blocked = GeminiResult(text="no")
+    blocked.block_reason = "SAFETY"
+    with pytest.raises(RetryError) as excinfo:
+        run(policy, FakeUpstream(blocked, image()))
+    assert excinfo.value.status_code == 400
+
+def test_send_gets_what_is_left_of_the_deadline():
+    policy = RetryPolicy(KeyManager(["key-a"]), max_attempts=1, deadline=7)
+    timeouts = []
+
+    def send(api_key, timeout):
+        timeouts.append(timeout)
+        return image()
+
+    run(policy, send)
+    assert 6 < timeouts[0] <= 7
+
+def test_no_keys_is_fatal():
+    policy = RetryPolicy(KeyManager([]), max_attempts=3)
+    send = FakeUpstream(image())
+
+    with pytest.raises(RetryError) as excinfo:
+        run(policy, send)
+
+    assert excinfo.value.status_code == 500
+    assert send.keys == []
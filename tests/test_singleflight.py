@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+def run_concurrently(flight, key, fn, count):
+    results = [None] * count
+    errors = [None] * count
+
+    def call(i):
+        try:
+            results[i] = flight.do(key, fn)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+def test_identical_calls_share_one_execution(tmp_path):
+    flight = SingleFlight(tmp_path, enabled=True, cross_worker=False)
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {"imageId": "abc"}
+
+    threads, results, errors = run_concurrently(flight, "key", fn, 5)
+    while flight.counters["coalesced_local"] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert errors == [None] * 5
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert all(result == {"imageId": "abc"} for result, _ in results)
+
+def test_followers_get_copies_of_the_result(tmp_path):
+    flight = SingleFlight(tmp_path, enabled=True, cross_worker=False)
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        return {"tags": ["a"]}
+
+    threads, results, _ = run_concurrently(flight, "key", fn, 3)
+    while flight.counters["coalesced_local"] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    results[0][0]["tags"].append("mutated")
+    assert [result["tags"] for result, _ in results[1:]] == [["a"], ["a"]]
+
+def test_leader_error_reaches_every_follower(tmp_path):
+    flight = SingleFlight(tmp_path, enabled=True, cross_worker=False)
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError("upstream failed")
+
+    threads, _, errors = run_concurrently(flight, "key", fn, 3)
+    while flight.counters["coalesced_local"] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(error, RuntimeError) for error in errors)
+    assert flight.calls == {}
+
+def test_later_calls_run_again(tmp_path):
+    flight = SingleFlight(tmp_path, enabled=True, cross_worker=False)
+    calls = []
+    for _ in range(2):
+        result, shared = flight.do("key", lambda: calls.append(1) or len(calls))
+        assert not shared
+    assert calls == [1, 1]
+
+@pytest.mark.parametrize("enabled, key", [(False, "key"), (True, None)])
+def test_uncoalesced_calls_run_directly(tmp_path, enabled, key):
+    flight = SingleFlight(tmp_path, enabled=enabled, cross_worker=False)
+    assert flight.do(key, lambda: 42) == (42, False)
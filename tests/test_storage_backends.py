@@ -0,0 +1,70 @@
+import os
+from io import BytesIO
+
+from storage_backends import LocalBackend
+
+def blob_files(backend):
+    return [
+        os.path.join(directory, name)
+        for directory, _, files in os.walk(backend.blobs_dir)
+        for name in files if not name.startswith(".")
+    ]
+
+def test_identical_content_is_stored_once(tmp_path):
+    backend = LocalBackend(tmp_path)
+    backend.write("images/a.png", b"same bytes", dedupe=True)
+    backend.write("images/b.png", BytesIO(b"same bytes"), dedupe=True)
+
+    assert backend.read("images/a.png") == backend.read("images/b.png") == b"same bytes"
+    blobs = blob_files(backend)
+    assert len(blobs) == 1
+    assert os.stat(blobs[0]).st_nlink == 3
+    assert os.path.samefile(backend.local_path("images/a.png"), blobs[0])
+
+def test_different_content_gets_its_own_blob(tmp_path):
+    backend = LocalBackend(tmp_path)
+    backend.write("images/a.png", b"one", dedupe=True)
+    backend.write("images/b.png", b"two", dedupe=True)
+    assert len(blob_files(backend)) == 2
+
+def test_overwriting_a_key_does_not_change_other_keys(tmp_path):
+    backend = LocalBackend(tmp_path)
+    backend.write("images/a.png", b"shared", dedupe=True)
+    backend.write("images/b.png", b"shared", dedupe=True)
+    backend.write("images/a.png", b"replaced", dedupe=True)
+
+    assert backend.read("images/a.png") == b"replaced"
+    assert backend.read("images/b.png") == b"shared"
+
+def test_gc_removes_only_unreferenced_blobs(tmp_path):
+    backend = LocalBackend(tmp_path)
+    backend.write("images/a.png", b"kept", dedupe=True)
+    backend.write("images/b.png", b"dropped", dedupe=True)
+    backend.delete("images/b.png")
+
+    assert backend.gc_blobs(min_age=0, dry_run=True)["removed"] == 1
+    assert len(blob_files(backend)) == 2
+
+    result = backend.gc_blobs(min_age=0)
+    assert result["removed"] == 1
+    assert result["referenced"] == 1
+    assert result["bytes_freed"] == len(b"dropped")
+    assert backend.read("images/a.png") == b"kept"
+
+def test_gc_keeps_recent_blobs(tmp_path):
+    backend = LocalBackend(tmp_path)
+    backend.write("images/a.png", b"young", dedupe=True)
+    backend.delete("images/a.png")
+
+    assert backend.gc_blobs(min_age=3600)["removed"] == 0
+    assert len(blob_files(backend)) == 1
+
+def test_rewriting_after_gc_stores_the_blob_again(tmp_path):
+    backend = LocalBackend(tmp_path)
+    backend.write("images/a.png", b"again", dedupe=True)
+    backend.delete("images/a.png")
+    backend.gc_blobs(min_age=0)
+
+    backend.write("images/b.png", b"again", dedupe=True)
+    assert backend.read("images/b.png") == b"again"
+    assert len(blob_files(backend)) == 1